@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from Metrics import annotate
+
+# Connections kept alive per host, shared by every download thread
+connection_pool_size = 16
+# Bytes read from the network per write to disk
+chunk_size = 1024 * 1024
+# Files at least this large are fetched as parallel HTTP Range requests
+range_threshold = 64 * 1024 * 1024
+# Number of parallel Range requests for a large file
+range_parts = 8
+# Seconds to wait for a connection and between received bytes
+request_timeout = (10, 60)
+max_retries = 5
+retry_delay = 2  # seconds, doubled after each failed attempt
+
+session_lock = threading.Lock()
+shared_session = None
+
+# Returns the keep-alive session shared by all downloads in this process.
+def get_session() -> requests.Session:
+    global shared_session
+    with session_lock:
+        if shared_session is None:
+            shared_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=connection_pool_size, pool_maxsize=connection_pool_size)
+            shared_session.mount('http://', adapter)
+            shared_session.mount('https://', adapter)
+    return shared_session
+
+# Raised for HTTP responses that retrying will not fix, like a 404
+class DownloadError(Exception):
+    pass
+
+# Calls request_function until it succeeds, retrying connection errors and 5xx responses
+# with exponential backoff.
+def with_retries(request_function):
+    delay = retry_delay
+    for attempt in range(max_retries):
+        try:
+            return request_function()
+        except DownloadError:
+            raise
+        except (requests.exceptions.RequestException, OSError) as e:
+            if attempt == max_retries - 1:
+                raise
+            print(f"\nDownload error ({e}), retrying in {delay} seconds... (attempt {attempt + 1}/{max_retries})")
+            time.sleep(delay)
+            delay *= 2
+
+# Raises for error responses: DownloadError for client errors, HTTPError (retried) for server errors.
+def check_response(response: requests.Response):
+    if 400 <= response.status_code < 500:
+        response.close()
+        raise DownloadError(f"{response.status_code} for {response.url}")
+    response.raise_for_status()
+
+# Builds If-None-Match / If-Modified-Since headers from a cached ETag and Last-Modified.
+def conditional_headers(validators: dict = None) -> dict:
+    headers = {}
+    if validators and validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators and validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+# Returns the HEAD response for url, a 304 if conditional headers match the remote
+# file, or None if the server does not support HEAD.
+def remote_file_headers(url: str, headers: dict) -> (requests.Response | None):
+    def head():
+        response = get_session().head(url, headers=headers, timeout=request_timeout, allow_redirects=True)
+        if response.status_code not in (304, 405):
+            check_response(response)
+        return response
+    response = with_retries(head)
+    if response.status_code == 405:
+        return None
+    return response
+
+# Whether url changed since the download that returned validators, asked with one HEAD
+# request. True when the file exists but there are no validators to compare, as for a
+# file never downloaded, or when the server does not answer HEAD. Raises DownloadError
+# for client errors such as the 404 of a file that is not published yet.
+def remote_changed(url: str, validators: dict = None) -> bool:
+    response = remote_file_headers(url, conditional_headers(validators))
+    if response is None or not validators:
+        return True
+    if response.status_code == 304:
+        return False
+    # Servers that ignore conditional HEAD requests still send the current validators
+    if validators.get('etag') and response.headers.get('ETag'):
+        return response.headers['ETag'] != validators['etag']
+    if validators.get('last_modified') and response.headers.get('Last-Modified'):
+        return response.headers['Last-Modified'] != validators['last_modified']
+    return True
+
+# Streams url to file_path. The body goes to a .part file in chunks and is renamed into
+# place when complete, so a reader never sees a half-written file. Large files are split
+# into parallel Range requests, and an interrupted download resumes from its .part file.
+# With validators (a cached etag and last_modified) the request is conditional and None is
+# returned if the file has not changed. Otherwise returns the new etag, last_modified and
+# the sha256 of the content. Raises DownloadError for client errors such as 404.
+def download(url: str, file_path: str, validators: dict = None) -> (dict | None):
+    part_file_path = file_path + '.part'
+    headers = conditional_headers(validators)
+    response = remote_file_headers(url, headers)
+    if response is None:
+        response = download_stream(url, part_file_path, headers)
+    elif response.status_code != 304:
+        size = int(response.headers.get('Content-Length', 0))
+        version = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        if size and response.headers.get('Accept-Ranges', '').lower() == 'bytes':
+            parts = range_parts if size >= range_threshold else 1
+            download_ranges(url, part_file_path, size, version, parts)
+        else:
+            download_stream(url, part_file_path, {})
+    if response.status_code == 304:
+        annotate(not_modified=True)
+        return None
+    os.replace(part_file_path, file_path)
+    file_size = os.path.getsize(file_path)
+    annotate(bytes_in=file_size, bytes_out=file_size)
+    return {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'sha256': file_sha256(file_path),
+    }
+
+# Fetches url into memory instead of a file, for callers that never need the file on
+# disk. Like download, the request is conditional with validators and None is returned if
+# the file has not changed. Otherwise returns the content and its etag, last_modified and
+# sha256. Raises DownloadError for client errors such as 404.
+def download_to_memory(url: str, validators: dict = None) -> (tuple | None):
+    headers = conditional_headers(validators)
+    def fetch():
+        with get_session().get(url, headers=headers, stream=True, timeout=request_timeout) as response:
+            if response.status_code == 304:
+                return response, None
+            check_response(response)
+            content = bytearray()
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                content += chunk
+            return response, bytes(content)
+    response, content = with_retries(fetch)
+    if content is None:
+        annotate(not_modified=True)
+        return None
+    annotate(bytes_in=len(content))
+    return content, {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'sha256': hashlib.sha256(content).hexdigest(),
+    }
+
+# Returns the hex sha256 of a file, read in chunks.
+def file_sha256(file_path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+# Downloads url to part_file_path in one request, for servers without Range support.
+# Returns the response, which is a 304 with nothing written if headers are conditional
+# and the file is unchanged.
+def download_stream(url: str, part_file_path: str, headers: dict) -> requests.Response:
+    def fetch():
+        with get_session().get(url, headers=headers, stream=True, timeout=request_timeout) as response:
+            if response.status_code == 304:
+                return response
+            check_response(response)
+            with open(part_file_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+            return response
+    return with_retries(fetch)
+
+# Downloads url to part_file_path as Range requests written in place, in parallel when
+# parts > 1. Finished bytes per range are kept in a .json sidecar next to the .part file,
+# so an interrupted download resumes each range if the remote version is unchanged.
+def download_ranges(url: str, part_file_path: str, size: int, version: str, parts: int):
+    progress_file_path = part_file_path + '.json'
+    part_size = -(-size // parts)
+    ranges = [(start, min(start + part_size, size)) for start in range(0, size, part_size)]
+    progress = {}
+    if os.path.exists(part_file_path) and os.path.exists(progress_file_path):
+        with open(progress_file_path) as f:
+            saved_progress = json.load(f)
+        if saved_progress.get('size') == size and saved_progress.get('version') == version and saved_progress.get('parts') == parts:
+            progress = saved_progress['ranges']
+    progress_lock = threading.Lock()
+
+    def save_progress():
+        with open(progress_file_path, 'w') as f:
+            json.dump({'size': size, 'version': version, 'parts': parts, 'ranges': progress}, f)
+
+    def fetch_range(start: int, end: int):
+        key = str(start)
+        def fetch():
+            offset = start + progress.get(key, 0)
+            if offset >= end:
+                return
+            headers = {'Range': f'bytes={offset}-{end - 1}'}
+            with get_session().get(url, headers=headers, stream=True, timeout=request_timeout) as response:
+                check_response(response)
+                if response.status_code != 206:
+                    raise DownloadError(f"Range request ignored for {url}")
+                position = offset
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    os.pwrite(fd, chunk, position)
+                    position += len(chunk)
+                    with progress_lock:
+                        progress[key] = position - start
+                        save_progress()
+        with_retries(fetch)
+
+    fd = os.open(part_file_path, os.O_RDWR | os.O_CREAT)
+    try:
+        os.ftruncate(fd, size)
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            for future in [executor.submit(fetch_range, start, end) for start, end in ranges]:
+                future.result()
+    finally:
+        os.close(fd)
+    os.remove(progress_file_path)
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import threading
+
+# Persistent record of what each run downloaded and uploaded, so unchanged forecast hours
+# can be skipped end to end. Downloaded files keep their ETag, Last-Modified and sha256
+# for conditional requests. Forecast hours keep the hash of their input data, the hash
+# that was last uploaded successfully and the tileset it was uploaded to, which is the
+# hour itself unless several hours were packed into one tileset.
+class CacheManifest:
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        self.files = {}
+        self.hours = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            self.files = manifest.get('files', {})
+            self.hours = manifest.get('hours', {})
+
+    # Writes the manifest to a temp file and renames it into place.
+    def save(self):
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'files': self.files, 'hours': self.hours}, f, indent=1)
+        os.replace(temp_path, self.manifest_path)
+
+    # Cached etag and last_modified of a downloaded file, or None if it was never downloaded.
+    def file_validators(self, filename: str) -> (dict | None):
+        with self.lock:
+            return self.files.get(filename)
+
+    # Records the etag, last_modified and sha256 returned by Downloader.download.
+    def record_file(self, filename: str, download_info: dict):
+        with self.lock:
+            self.files[filename] = download_info
+            self.save()
+
+    # Records the hash of a forecast hour's input data.
+    def record_hour(self, hour: str, content_hash: str):
+        with self.lock:
+            self.hours.setdefault(hour, {})['sha256'] = content_hash
+            self.save()
+
+    # Whether hour was uploaded to tileset (the hour's own tileset if not given) from
+    # input with its current hash.
+    def hour_uploaded(self, hour: str, tileset: str = None) -> bool:
+        with self.lock:
+            entry = self.hours.get(hour, {})
+            return (entry.get('sha256') is not None and entry.get('uploaded_sha256') == entry['sha256']
+                    and entry.get('uploaded_tileset', hour) == (tileset or hour))
+
+    # Hash identifying the input of a tileset made from hours: the hours with the hashes of
+    # their input data. None if any hour has no recorded hash or hours is empty.
+    def input_hash(self, hours: list) -> (str | None):
+        with self.lock:
+            hashes = [self.hours.get(hour, {}).get('sha256') for hour in hours]
+        if not hours or None in hashes:
+            return None
+        return hashlib.sha256('\n'.join(f'{hour}:{content_hash}' for hour, content_hash in zip(hours, hashes)).encode()).hexdigest()
+
+    # Whether every known forecast hour is uploaded, to the tileset hour_tilesets maps it
+    # to or else its own. False when no hours are known yet.
+    def all_hours_uploaded(self, hour_tilesets: dict = None) -> bool:
+        hours = self.known_hours()
+        hour_tilesets = hour_tilesets or {}
+        return len(hours) > 0 and all(self.hour_uploaded(hour, hour_tilesets.get(hour)) for hour in hours)
+
+    # Marks hour's current input hash as uploaded to tileset, the hour's own if not given.
+    def mark_uploaded(self, hour: str, tileset: str = None):
+        with self.lock:
+            entry = self.hours.setdefault(hour, {})
+            entry['uploaded_sha256'] = entry.get('sha256')
+            entry['uploaded_tileset'] = tileset or hour
+            self.save()
+
+    # Known forecast hours in time order.
+    def known_hours(self) -> list:
+        with self.lock:
+            return sorted(self.hours)
+
+    # Tilesets that hold the current data of at least one forecast hour.
+    def uploaded_tilesets(self) -> set:
+        with self.lock:
+            entries = list(self.hours.items())
+        return {entry.get('uploaded_tileset', hour) for hour, entry in entries
+                if entry.get('sha256') is not None and entry.get('uploaded_sha256') == entry['sha256']}
+
+    # Forgets forecast hours, and optionally files, that are no longer part of the forecast.
+    def prune(self, current_hours: list, current_files: list = None):
+        current_hours = set(current_hours)
+        with self.lock:
+            self.hours = {hour: entry for hour, entry in self.hours.items() if hour in current_hours}
+            if current_files is not None:
+                current_files = set(current_files)
+                self.files = {filename: entry for filename, entry in self.files.items() if filename in current_files}
+            self.save()
@@ -0,0 +1,288 @@
+import hashlib
+import io
+import numpy as np
+from Metrics import annotate
+
+# Minimum PM25 value for a grid cell to become a feature
+PM25_threshold = 5
+# Grid rows converted per chunk when streaming features
+feature_chunk_rows = 64
+# Write buffer size for GeoJSON output files
+write_buffer_size = 1024 * 1024
+# Lower PM25 bound of each band when cells are merged into band polygons. The first
+# band starts at PM25_threshold, the rest follow the AQI breakpoints.
+PM25_bands = [PM25_threshold, 9.1, 35.5, 55.5, 125.5, 225.5]
+# Decimal places kept for coordinates and PM25 values in serialized GeoJSON points, or
+# None for every digit. 5 decimals is about a meter, far below the grid spacing.
+coordinate_decimals = 5
+PM25_decimals = 2
+# Grids whose serialized geometries are kept by get_grid_cache in each process. Every
+# level of a GridPyramid zoom pyramid is a grid of its own.
+max_grid_caches = 16
+
+# Orients a PM25 grid indexed [lat, lon] for feature order. Returns the outer and inner
+# coordinate arrays and the grid as float64 with masked cells and fill values set to NaN.
+def prepare_grid(lon, lat, pm25, lon_major: bool = False) -> tuple:
+    lon = np.ma.filled(np.ma.asarray(lon, dtype=np.float64), np.nan)
+    lat = np.ma.filled(np.ma.asarray(lat, dtype=np.float64), np.nan)
+    grid = np.ma.filled(np.ma.asarray(pm25, dtype=np.float64), np.nan)
+    if lon_major:
+        return lon, lat, grid.T
+    return lat, lon, grid
+
+# Selects the cells of grid rows [start, stop) that pass the PM25 threshold.
+# Returns the outer and inner indices and the values of those cells.
+def select_rows(grid, start: int, stop: int) -> tuple:
+    block = grid[start:stop]
+    # NaN comparisons are False, so masked and missing cells drop out here
+    with np.errstate(invalid='ignore'):
+        mask = block >= PM25_threshold
+    outer, inner = np.nonzero(mask)
+    return outer + start, inner, block[mask]
+
+# Builds the lon, lat, PM25 and id columns for selected cells, numbering ids from first_id.
+def build_columns(outer_coords, inner_coords, outer, inner, values, first_id: int, lon_major: bool = False) -> tuple:
+    if lon_major:
+        feature_lon, feature_lat = outer_coords[outer], inner_coords[inner]
+    else:
+        feature_lon, feature_lat = inner_coords[inner], outer_coords[outer]
+    feature_ids = np.arange(first_id, first_id + values.size)
+    return feature_lon, feature_lat, values, feature_ids
+
+# Converts a PM25 grid into the lon, lat, PM25 and id columns of its features.
+# The grid is indexed [lat, lon]. Features are ordered row by row (lat outer, lon inner)
+# unless lon_major is set, in which case lon is the outer loop. Masked cells, fill values
+# and NaNs never pass the threshold.
+def grid_to_features(lon, lat, pm25, lon_major: bool = False) -> tuple:
+    outer_coords, inner_coords, grid = prepare_grid(lon, lat, pm25, lon_major)
+    outer, inner, values = select_rows(grid, 0, grid.shape[0])
+    return build_columns(outer_coords, inner_coords, outer, inner, values, 1, lon_major)
+
+# Same as grid_to_features, but yields the columns a few grid rows at a time so
+# memory stays bounded no matter how many cells pass the threshold. With serialized set,
+# the lon and lat columns are replaced by one column of the cells' cached GeoJSON
+# geometries, for format_serialized_features. With rows, a (start, stop, first_id) block
+# from feature_row_blocks, only that block's features are yielded. With slab also set,
+# pm25 holds only the block's rows of the oriented grid, so a worker converting a block
+# needs no more of the grid than that, while lon and lat stay whole.
+def iter_feature_chunks(lon, lat, pm25, lon_major: bool = False, chunk_rows: int = None, serialized: bool = False, rows: tuple = None, slab: bool = False):
+    chunk_rows = chunk_rows or feature_chunk_rows
+    outer_coords, inner_coords, grid = prepare_grid(lon, lat, pm25, lon_major)
+    grid_cache = get_grid_cache(outer_coords, inner_coords, lon_major) if serialized else None
+    start_row, stop_row, feature_id = rows or (0, grid.shape[0], 1)
+    # Grid row of the first row of pm25
+    first_row = start_row if slab else 0
+    for start in range(start_row, stop_row, chunk_rows):
+        outer, inner, values = select_rows(grid, start - first_row, min(start + chunk_rows, stop_row) - first_row)
+        outer += first_row
+        if values.size:
+            if grid_cache:
+                yield grid_cache.geometries[outer, inner], values, np.arange(feature_id, feature_id + values.size)
+            else:
+                yield build_columns(outer_coords, inner_coords, outer, inner, values, feature_id, lon_major)
+            feature_id += values.size
+
+# Splits the rows of a PM25 grid, in the order iter_feature_chunks walks them, into up to
+# blocks blocks of about as many features each. Returns a (start, stop, first_id) row
+# block for each, first_id being the id of the block's first feature, so blocks converted
+# apart and joined in order are the same as converting the whole grid at once.
+def feature_row_blocks(lon, lat, pm25, lon_major: bool = False, blocks: int = 1) -> list:
+    _, _, grid = prepare_grid(lon, lat, pm25, lon_major)
+    with np.errstate(invalid='ignore'):
+        row_features = np.count_nonzero(grid >= PM25_threshold, axis=1)
+    features_before = np.concatenate(([0], np.cumsum(row_features)))
+    # Rows where each block's share of the features starts
+    targets = features_before[-1] * np.arange(1, blocks) / blocks
+    boundaries = np.unique(np.concatenate(([0], np.searchsorted(features_before, targets, side='right') - 1, [grid.shape[0]])))
+    return [(int(start), int(stop), int(features_before[start]) + 1) for start, stop in zip(boundaries[:-1], boundaries[1:]) if stop > start]
+
+# Serialized GeoJSON Point geometries of every cell of one lon/lat grid, indexed
+# [outer, inner] like the oriented grid. The grid is the same for every forecast hour, so
+# its coordinates are formatted once instead of once per feature per hour.
+class GridCache:
+    def __init__(self, outer_coords, inner_coords, lon_major: bool):
+        lon, lat = (outer_coords, inner_coords) if lon_major else (inner_coords, outer_coords)
+        lon_text = [repr(value) for value in round_values(lon, coordinate_decimals).tolist()]
+        lat_text = [repr(value) for value in round_values(lat, coordinate_decimals).tolist()]
+        if lon_major:
+            geometries = [f'"geometry":{{"type":"Point","coordinates":[{x},{y},0]}}}}\n' for x in lon_text for y in lat_text]
+        else:
+            geometries = [f'"geometry":{{"type":"Point","coordinates":[{x},{y},0]}}}}\n' for y in lat_text for x in lon_text]
+        self.geometries = np.array(geometries, dtype=object).reshape(outer_coords.size, inner_coords.size)
+
+grid_caches = {}
+
+# Returns the GridCache of an oriented grid, built on first use in this process. Grids are
+# keyed by a hash of their coordinates, orientation and coordinate_decimals.
+def get_grid_cache(outer_coords, inner_coords, lon_major: bool) -> GridCache:
+    key = hashlib.sha256(outer_coords.tobytes() + b'|' + inner_coords.tobytes() + repr((lon_major, coordinate_decimals)).encode()).hexdigest()
+    if key not in grid_caches:
+        if len(grid_caches) >= max_grid_caches:
+            grid_caches.clear()
+        grid_caches[key] = GridCache(outer_coords, inner_coords, lon_major)
+    return grid_caches[key]
+
+# Rounds values to decimals places, or leaves them as they are if decimals is None
+def round_values(values, decimals: int = None):
+    if decimals is None:
+        return values
+    return np.round(values, decimals)
+
+# Cell edge coordinates from cell center coordinates: midpoints between centers, with
+# the outer edges half a cell beyond the first and last centers.
+def cell_edges(centers):
+    midpoints = (centers[1:] + centers[:-1]) / 2
+    if centers.size < 2:
+        return np.concatenate([centers - 0.5, centers + 0.5])
+    return np.concatenate([[2 * centers[0] - midpoints[0]], midpoints, [2 * centers[-1] - midpoints[-1]]])
+
+# Merges cells of a PM25 grid indexed [lat, lon] into rectangles of one PM25 band.
+# Cells are run-length merged along each lat row, then runs with the same lon span and
+# band in consecutive rows are stacked. Returns the west, south, east, north, band and
+# id columns of the rectangles; band is the 1-based index into PM25_bands.
+def grid_to_band_polygons(lon, lat, pm25) -> tuple:
+    lat, lon, grid = prepare_grid(lon, lat, pm25)
+    # NaN sorts above every band, so masked and missing cells are set to band 0 explicitly
+    bands = np.where(np.isnan(grid), 0, np.digitize(grid, PM25_bands))
+    padded = np.pad(bands, ((0, 0), (1, 1)), constant_values=-1)
+    run_rows, run_starts = np.nonzero(padded[:, 1:-1] != padded[:, :-2])
+    _, run_stops = np.nonzero(padded[:, 2:] != padded[:, 1:-1])
+    run_stops += 1
+    run_bands = bands[run_rows, run_starts]
+    keep = run_bands > 0
+    run_rows, run_starts, run_stops, run_bands = run_rows[keep], run_starts[keep], run_stops[keep], run_bands[keep]
+
+    # Runs sorted by span and band, then row, so stackable runs are neighbours
+    order = np.lexsort((run_rows, run_bands, run_stops, run_starts))
+    run_rows, run_starts, run_stops, run_bands = run_rows[order], run_starts[order], run_stops[order], run_bands[order]
+    new_rectangle = np.ones(run_rows.size, dtype=bool)
+    new_rectangle[1:] = ((run_starts[1:] != run_starts[:-1]) | (run_stops[1:] != run_stops[:-1])
+                         | (run_bands[1:] != run_bands[:-1]) | (run_rows[1:] != run_rows[:-1] + 1))
+    firsts = np.flatnonzero(new_rectangle)
+    lasts = np.append(firsts[1:], run_rows.size) - 1
+
+    lon_edges, lat_edges = cell_edges(lon), cell_edges(lat)
+    west, east = lon_edges[run_starts[firsts]], lon_edges[run_stops[firsts]]
+    first_lat, last_lat = lat_edges[run_rows[firsts]], lat_edges[run_rows[lasts] + 1]
+    south, north = np.minimum(first_lat, last_lat), np.maximum(first_lat, last_lat)
+    return west, south, east, north, run_bands[firsts], np.arange(1, firsts.size + 1)
+
+# Formats band rectangles as newline-delimited GeoJSON Polygon features. PM25 holds the
+# band's lower bound so styles written for point features still apply.
+def format_band_polygons(west, south, east, north, band, feature_ids) -> str:
+    return ''.join([
+        f'{{"type":"Feature","properties":{{"id":"{feature_id}","band":{band_index},"PM25":{PM25_bands[band_index - 1]!r}}},'
+        f'"geometry":{{"type":"Polygon","coordinates":[[[{w!r},{s!r}],[{e!r},{s!r}],[{e!r},{n!r}],[{w!r},{n!r}],[{w!r},{s!r}]]]}}}}\n'
+        for w, s, e, n, band_index, feature_id in zip(west.tolist(), south.tolist(), east.tolist(), north.tolist(), band.tolist(), feature_ids.tolist())
+    ])
+
+# Attribute that holds the PM25 of the hour at position in a multi-hour tileset
+def packed_attribute(position: int) -> str:
+    return f'PM25_{position:02}'
+
+# Like iter_feature_chunks for a stack of hourly grids on the same lon/lat grid, indexed
+# [hour, lat, lon]. A cell becomes a feature if any hour passes the threshold. Yields
+# lon, lat, hour values and id columns, where hour values is indexed [hour, feature]
+# and is NaN for hours below the threshold. With serialized set, lon and lat are replaced
+# by the cells' cached geometries, for format_serialized_packed_features.
+def iter_packed_feature_chunks(lon, lat, pm25_stack, lon_major: bool = False, chunk_rows: int = None, serialized: bool = False):
+    chunk_rows = chunk_rows or feature_chunk_rows
+    grids = [prepare_grid(lon, lat, pm25, lon_major) for pm25 in pm25_stack]
+    outer_coords, inner_coords = grids[0][0], grids[0][1]
+    stack = np.stack([grid for _, _, grid in grids])
+    grid_cache = get_grid_cache(outer_coords, inner_coords, lon_major) if serialized else None
+    feature_id = 1
+    for start in range(0, stack.shape[1], chunk_rows):
+        block = stack[:, start:start + chunk_rows]
+        with np.errstate(invalid='ignore'):
+            passing = block >= PM25_threshold
+        mask = passing.any(axis=0)
+        outer, inner = np.nonzero(mask)
+        if outer.size:
+            hour_values = np.where(passing, block, np.nan)[:, mask]
+            if grid_cache:
+                yield grid_cache.geometries[outer + start, inner], hour_values, np.arange(feature_id, feature_id + outer.size)
+            else:
+                feature_lon, feature_lat, _, feature_ids = build_columns(outer_coords, inner_coords, outer + start, inner, hour_values[0], feature_id, lon_major)
+                yield feature_lon, feature_lat, hour_values, feature_ids
+            feature_id += outer.size
+
+# Same as iter_packed_feature_chunks, but returns the columns of every feature at once.
+def packed_grid_to_features(lon, lat, pm25_stack, lon_major: bool = False) -> tuple:
+    pm25_stack = list(pm25_stack)
+    chunks = list(iter_packed_feature_chunks(lon, lat, pm25_stack, lon_major, chunk_rows=max(np.size(lon), np.size(lat))))
+    if chunks:
+        return chunks[0]
+    return np.empty(0), np.empty(0), np.empty((len(pm25_stack), 0)), np.empty(0, dtype=np.int64)
+
+# Formats packed feature columns as newline-delimited GeoJSON Point features with one
+# PM25_NN property per hour that passes the threshold.
+def format_packed_features(feature_lon, feature_lat, hour_values, feature_ids) -> str:
+    attributes = [packed_attribute(position) for position in range(hour_values.shape[0])]
+    lines = []
+    for lon_value, lat_value, values, feature_id in zip(feature_lon.tolist(), feature_lat.tolist(), hour_values.T.tolist(), feature_ids.tolist()):
+        # NaN != NaN, so hours below the threshold are left out
+        properties = ''.join([f',"{attribute}":{value!r}' for attribute, value in zip(attributes, values) if value == value])
+        lines.append(f'{{"type":"Feature","properties":{{"id":"{feature_id}"{properties}}},"geometry":{{"type":"Point","coordinates":[{lon_value!r},{lat_value!r},0]}}}}\n')
+    return ''.join(lines)
+
+# Same as format_packed_features for serialized chunks, with the geometry from the grid
+# cache and PM25 values rounded to PM25_decimals.
+def format_serialized_packed_features(geometries, hour_values, feature_ids) -> str:
+    attributes = [packed_attribute(position) for position in range(hour_values.shape[0])]
+    lines = []
+    for geometry, values, feature_id in zip(geometries.tolist(), round_values(hour_values, PM25_decimals).T.tolist(), feature_ids.tolist()):
+        # NaN != NaN, so hours below the threshold are left out
+        properties = ''.join([f',"{attribute}":{value!r}' for attribute, value in zip(attributes, values) if value == value])
+        lines.append(f'{{"type":"Feature","properties":{{"id":"{feature_id}"{properties}}},{geometry}')
+    return ''.join(lines)
+
+# Formats feature columns as newline-delimited GeoJSON Point features with the
+# PM25 schema. Floats use repr, the same text json.dumps writes.
+def format_features(feature_lon, feature_lat, feature_pm25, feature_ids) -> str:
+    return ''.join([
+        f'{{"type":"Feature","properties":{{"id":"{feature_id}","PM25":{pm25_value!r}}},"geometry":{{"type":"Point","coordinates":[{lon_value!r},{lat_value!r},0]}}}}\n'
+        for lon_value, lat_value, pm25_value, feature_id in zip(feature_lon.tolist(), feature_lat.tolist(), feature_pm25.tolist(), feature_ids.tolist())
+    ])
+
+# Same as format_features for serialized chunks, where only the id and PM25 of each
+# feature are formatted and the geometry comes from the grid cache. PM25 is rounded to
+# PM25_decimals.
+def format_serialized_features(geometries, feature_pm25, feature_ids) -> str:
+    return ''.join([
+        f'{{"type":"Feature","properties":{{"id":"{feature_id}","PM25":{pm25_value!r}}},{geometry}'
+        for geometry, pm25_value, feature_id in zip(geometries.tolist(), round_values(feature_pm25, PM25_decimals).tolist(), feature_ids.tolist())
+    ])
+
+# Streams chunks of feature columns to a newline-delimited GeoJSON file, one feature
+# per line, which tippecanoe can parse in parallel with -P. Returns the bytes written.
+def write_geojson_seq(geojson_file_path: str, feature_chunks, formatter=format_features) -> int:
+    with open(geojson_file_path, 'w', buffering=write_buffer_size) as f:
+        bytes_written = write_features(f, feature_chunks, formatter)
+    annotate(bytes_out=bytes_written)
+    return bytes_written
+
+# Formats chunks of feature columns as one string of newline-delimited GeoJSON, for a
+# block of features converted apart from the file it goes in.
+def format_feature_chunks(feature_chunks, formatter=format_features) -> str:
+    stream = io.StringIO()
+    write_features(stream, feature_chunks, formatter)
+    return stream.getvalue()
+
+# Writes blocks of formatted GeoJSON to a file in order, as they come. Returns the bytes written.
+def write_geojson_text(geojson_file_path: str, texts) -> int:
+    with open(geojson_file_path, 'w', buffering=write_buffer_size) as f:
+        bytes_written = sum(f.write(text) for text in texts)
+    annotate(bytes_out=bytes_written)
+    return bytes_written
+
+# Writes chunks of feature columns to an open text stream as newline-delimited GeoJSON.
+# Returns the bytes written.
+def write_features(stream, feature_chunks, formatter=format_features) -> int:
+    bytes_written = 0
+    feature_count = 0
+    for feature_columns in feature_chunks:
+        bytes_written += stream.write(formatter(*feature_columns))
+        feature_count += feature_columns[-1].size
+    annotate(features=feature_count)
+    return bytes_written
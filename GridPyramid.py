@@ -0,0 +1,118 @@
+import json
+import numpy as np
+from GridFeatures import iter_feature_chunks, iter_packed_feature_chunks
+from MBTiles import guess_max_zoom
+
+# Zoom pyramids of point features. Instead of handing tippecanoe the full grid at every
+# zoom and letting it thin points as it sees fit, each zoom below the grid's own gets a
+# grid coarsened by NumPy block reductions, so low-zoom tiles keep the peak (or mean)
+# concentration of every block. Every feature carries its level's zoom range for tippecanoe.
+
+# Levels of the zoom pyramid of a lon/lat grid as (factor, minzoom, maxzoom), highest zoom
+# first. The full grid is shown at the zoom where its cells become distinguishable, like
+# MBTiles.guess_max_zoom, and every zoom below halves the resolution. The coarsest level
+# also covers every zoom under it.
+def pyramid_levels(lon, lat) -> list:
+    full_zoom = guess_max_zoom(lon, lat)
+    levels = [(1, full_zoom, full_zoom)]
+    for zoom in range(full_zoom - 1, -1, -1):
+        factor = 2 ** (full_zoom - zoom)
+        coarsest = zoom == 0 or factor >= max(np.size(lon), np.size(lat))
+        levels.append((factor, 0 if coarsest else zoom, zoom))
+        if coarsest:
+            break
+    return levels
+
+# Coarsens a PM25 grid indexed [lat, lon] by factor along both axes, reducing each block
+# of cells to its 'max' or 'mean' over the cells that have a value. Blocks at the edges
+# may be partial. Returns the block center lon and lat and the reduced grid, which is NaN
+# where a block has no values.
+def reduce_grid(lon, lat, pm25, factor: int, reduction: str = 'max') -> tuple:
+    lon = np.ma.filled(np.ma.asarray(lon, dtype=np.float64), np.nan)
+    lat = np.ma.filled(np.ma.asarray(lat, dtype=np.float64), np.nan)
+    grid = np.ma.filled(np.ma.asarray(pm25, dtype=np.float64), np.nan)
+    rows, columns = -(-grid.shape[0] // factor), -(-grid.shape[1] // factor)
+    padded = np.full((rows * factor, columns * factor), np.nan)
+    padded[:grid.shape[0], :grid.shape[1]] = grid
+    blocks = padded.reshape(rows, factor, columns, factor)
+    if reduction == 'max':
+        # fmax skips NaN and only returns NaN for blocks with no values
+        reduced = np.fmax.reduce(np.fmax.reduce(blocks, axis=3), axis=1)
+    elif reduction == 'mean':
+        valid = ~np.isnan(blocks)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            reduced = np.where(valid, blocks, 0).sum(axis=(1, 3)) / valid.sum(axis=(1, 3))
+    else:
+        raise ValueError(f"Unknown pyramid reduction: {reduction}")
+    return block_centers(lon, factor, columns), block_centers(lat, factor, rows), reduced
+
+# Mean of each block of factor coordinates, ignoring the padding of the last block
+def block_centers(centers, factor: int, blocks: int):
+    padded = np.full(blocks * factor, np.nan)
+    padded[:centers.size] = centers
+    return np.nanmean(padded.reshape(blocks, factor), axis=1)
+
+# Feature chunks of every level of a zoom pyramid, highest zoom first. Each chunk is
+# (minzoom, maxzoom, *columns) with the columns of iter_feature_chunks, or of
+# iter_packed_feature_chunks for a packed stack of hourly grids, and ids numbered across
+# levels. max_zoom is the zoom of the full grid, which tippecanoe should tile up to.
+class PyramidChunks:
+    def __init__(self, lon, lat, pm25, reduction: str = 'max', lon_major: bool = False, serialized: bool = False, packed: bool = False):
+        self.lon, self.lat = lon, lat
+        self.grids = list(pm25) if packed else [pm25]
+        self.reduction = reduction
+        self.lon_major = lon_major
+        self.serialized = serialized
+        self.packed = packed
+        self.levels = pyramid_levels(lon, lat)
+        self.max_zoom = self.levels[0][2]
+
+    def __iter__(self):
+        first_id = 0
+        for factor, minzoom, maxzoom in self.levels:
+            if factor == 1:
+                level_lon, level_lat, level_grids = self.lon, self.lat, self.grids
+            else:
+                reduced = [reduce_grid(self.lon, self.lat, grid, factor, self.reduction) for grid in self.grids]
+                level_lon, level_lat = reduced[0][0], reduced[0][1]
+                level_grids = [grid for _, _, grid in reduced]
+            if self.packed:
+                chunks = iter_packed_feature_chunks(level_lon, level_lat, level_grids, self.lon_major, serialized=self.serialized)
+            else:
+                chunks = iter_feature_chunks(level_lon, level_lat, level_grids[0], self.lon_major, serialized=self.serialized)
+            level_features = 0
+            for *columns, feature_ids in chunks:
+                yield (minzoom, maxzoom, *columns, feature_ids + first_id)
+                level_features = int(feature_ids[-1])
+            first_id += level_features
+
+# Wraps a formatter of feature columns so it formats PyramidChunks, adding each level's
+# zoom range to its features as tippecanoe's minzoom and maxzoom.
+def pyramid_formatter(formatter):
+    def format_level(minzoom: int, maxzoom: int, *columns) -> str:
+        return formatter(*columns).replace('{"type":"Feature",', f'{{"type":"Feature","tippecanoe":{{"minzoom":{minzoom},"maxzoom":{maxzoom}}},')
+    return format_level
+
+# tippecanoe options for pyramid features: tile up to the full grid's zoom and keep every
+# feature at every zoom it is given, since each level is already thinned.
+def pyramid_options(max_zoom: int) -> list:
+    return [f'-z{max_zoom}', '-r1', '-P', '--drop-fraction-as-needed']
+
+# tippecanoe options for feature chunks, or None to use the defaults if they are not PyramidChunks
+def chunk_options(feature_chunks) -> (list | None):
+    if isinstance(feature_chunks, PyramidChunks):
+        return pyramid_options(feature_chunks.max_zoom)
+    return None
+
+# tippecanoe options for a GeoJSON file, or None to use the defaults if it was not written
+# from PyramidChunks. Levels are written highest zoom first, so the first feature carries
+# the zoom to tile up to.
+def file_options(geojson_file_path: str) -> (list | None):
+    with open(geojson_file_path) as f:
+        first_line = f.readline()
+    if not first_line:
+        return None
+    zoom_range = json.loads(first_line).get('tippecanoe')
+    if zoom_range is None:
+        return None
+    return pyramid_options(zoom_range['maxzoom'])
@@ -0,0 +1,219 @@
+import gzip
+import json
+import math
+import os
+import sqlite3
+import numpy as np
+from GridFeatures import packed_attribute
+from Metrics import annotate
+
+# Vector tile layer name, the same as tippecanoe's -l PM25
+layer_name = 'PM25'
+# Tile coordinate resolution and the buffer around each tile, in tile coordinates
+tile_extent = 4096
+tile_buffer = 80
+# Points kept per tile are thinned to one per cell of this size, keeping the highest PM25
+thinning_cell = 16
+# Highest zoom level generated, and the finest zoom needed to tell grid cells apart
+max_zoom_limit = 14
+min_cell_pixels = 2
+# Latitude limit of web mercator
+max_latitude = 85.0511287798
+
+# Guesses a max zoom from the grid spacing, like tippecanoe -zg: the lowest zoom at which
+# neighbouring grid cells are min_cell_pixels apart on a 256 pixel tile.
+def guess_max_zoom(lon, lat) -> int:
+    spacing = min(np.min(np.abs(np.diff(np.unique(lon)))) if np.size(lon) > 1 else 360,
+                  np.min(np.abs(np.diff(np.unique(lat)))) if np.size(lat) > 1 else 180)
+    zoom = math.ceil(math.log2(min_cell_pixels * 360 / (256 * spacing)))
+    return max(0, min(max_zoom_limit, zoom))
+
+# Projects lon/lat to web mercator in units of zoom-0 tiles, from 0 to 1.
+def project(feature_lon, feature_lat) -> tuple:
+    lat_radians = np.radians(np.clip(feature_lat, -max_latitude, max_latitude))
+    x = (feature_lon + 180) / 360
+    y = (1 - np.log(np.tan(lat_radians) + 1 / np.cos(lat_radians)) / math.pi) / 2
+    return x, y
+
+# Encodes an unsigned protobuf varint.
+def varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 31)
+
+# Encodes a length-delimited protobuf field.
+def length_field(field_number: int, payload: bytes) -> bytes:
+    return varint((field_number << 3) | 2) + varint(len(payload)) + payload
+
+# Varints of small numbers, precomputed because tile encoding needs millions of them
+varint_table = [varint(value) for value in range(1 << 16)]
+
+def small_varint(value: int) -> bytes:
+    return varint_table[value] if value < 65536 else varint(value)
+
+# Encodes one Mapbox Vector Tile with a single point layer. Every feature has a string
+# id, like the GeoJSON features given to tippecanoe, plus the numeric properties given as
+# (name, values) pairs; NaN values are left out. Field tags are written as literal bytes:
+# 0x12 is a layer's feature or a feature's tags, 0x22 a layer's value or a feature's
+# geometry, 0x0a a string value and 0x19 a double value.
+def encode_tile(tile_x, tile_y, feature_ids, properties: list) -> bytes:
+    values = []
+    features = []
+    property_bytes = [np.ascontiguousarray(property_values, dtype='<f8').tobytes() for _, property_values in properties]
+    property_values = [property_values.tolist() for _, property_values in properties]
+    for index, (x, y, feature_id) in enumerate(zip(tile_x.tolist(), tile_y.tolist(), feature_ids.tolist())):
+        id_bytes = str(feature_id).encode()
+        tags = b'\x00' + small_varint(len(values))
+        values.append(b'\x22' + varint_table[len(id_bytes) + 2] + b'\x0a' + varint_table[len(id_bytes)] + id_bytes)
+        for key_index, (encoded, decoded) in enumerate(zip(property_bytes, property_values), start=1):
+            # NaN != NaN marks a missing value
+            if decoded[index] == decoded[index]:
+                tags += small_varint(key_index) + small_varint(len(values))
+                values.append(b'\x22\x09\x19' + encoded[8 * index:8 * index + 8])
+        geometry = b'\x09' + small_varint(zigzag(x)) + small_varint(zigzag(y))
+        feature = b'\x12' + varint_table[len(tags)] + tags + b'\x18\x01\x22' + varint_table[len(geometry)] + geometry
+        features.append(b'\x12' + varint_table[len(feature)] + feature)
+    keys = length_field(3, b'id') + b''.join(length_field(3, name.encode()) for name, _ in properties)
+    layer = (
+        b'\x78\x02'
+        + length_field(1, layer_name.encode())
+        + b''.join(features)
+        + keys
+        + b''.join(values)
+        + b'\x28' + varint(tile_extent)
+    )
+    return length_field(3, layer)
+
+# Thins points to one per thinning_cell of tile coordinates at zoom, keeping the highest
+# PM25 in each cell so low zooms preserve peak concentrations. Returns the kept indexes.
+def thin_points(x, y, feature_pm25, zoom: int):
+    cells_per_tile = tile_extent // thinning_cell
+    cells = 2 ** zoom * cells_per_tile
+    cell_x = np.minimum((x * cells).astype(np.int64), cells - 1)
+    cell_y = np.minimum((y * cells).astype(np.int64), cells - 1)
+    cell = cell_y * cells + cell_x
+    # Sort by cell, highest PM25 first, and keep the first point of every cell
+    order = np.lexsort((-feature_pm25, cell))
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = cell[order][1:] != cell[order][:-1]
+    return np.sort(order[first])
+
+# Assigns points to tiles at zoom, including the copies that fall in a neighbour's buffer.
+# Yields (column, row, local x, local y, point indexes) for every tile with points.
+def tile_points(x, y, zoom: int, indexes):
+    tiles = 2 ** zoom
+    global_x = x[indexes] * tiles * tile_extent
+    global_y = y[indexes] * tiles * tile_extent
+    columns, rows, local_x, local_y, point_indexes = [], [], [], [], []
+    base_column = np.minimum(global_x // tile_extent, tiles - 1).astype(np.int64)
+    base_row = np.minimum(global_y // tile_extent, tiles - 1).astype(np.int64)
+    for column_offset in (-1, 0, 1):
+        for row_offset in (-1, 0, 1):
+            column = base_column + column_offset
+            row = base_row + row_offset
+            point_x = np.round(global_x - column * tile_extent).astype(np.int64)
+            point_y = np.round(global_y - row * tile_extent).astype(np.int64)
+            inside = (
+                (column >= 0) & (column < tiles) & (row >= 0) & (row < tiles)
+                & (point_x >= -tile_buffer) & (point_x <= tile_extent + tile_buffer)
+                & (point_y >= -tile_buffer) & (point_y <= tile_extent + tile_buffer)
+            )
+            columns.append(column[inside])
+            rows.append(row[inside])
+            local_x.append(point_x[inside])
+            local_y.append(point_y[inside])
+            point_indexes.append(indexes[inside])
+    columns, rows = np.concatenate(columns), np.concatenate(rows)
+    local_x, local_y = np.concatenate(local_x), np.concatenate(local_y)
+    point_indexes = np.concatenate(point_indexes)
+    # Group by tile, keeping feature order within each tile
+    order = np.lexsort((point_indexes, rows, columns))
+    columns, rows = columns[order], rows[order]
+    local_x, local_y, point_indexes = local_x[order], local_y[order], point_indexes[order]
+    boundaries = np.flatnonzero((np.diff(columns) != 0) | (np.diff(rows) != 0)) + 1
+    starts = np.concatenate(([0], boundaries))
+    stops = np.concatenate((boundaries, [order.size]))
+    for start, stop in zip(starts.tolist(), stops.tolist()):
+        if stop > start:
+            yield int(columns[start]), int(rows[start]), local_x[start:stop], local_y[start:stop], point_indexes[start:stop]
+
+# Creates an empty MBTiles file, replacing any existing one.
+def create_mbtiles(mbtiles_file_path: str) -> sqlite3.Connection:
+    if os.path.exists(mbtiles_file_path):
+        os.remove(mbtiles_file_path)
+    connection = sqlite3.connect(mbtiles_file_path)
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.execute('CREATE TABLE metadata (name TEXT, value TEXT)')
+    connection.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+    connection.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)')
+    return connection
+
+# Stores a tile given in XYZ coordinates; MBTiles rows count from the bottom (TMS).
+def insert_tile(connection: sqlite3.Connection, zoom: int, column: int, row: int, tile_data: bytes):
+    connection.execute('INSERT INTO tiles VALUES (?, ?, ?, ?)', (zoom, column, 2 ** zoom - 1 - row, tile_data))
+
+# Writes the metadata rows MBTiles readers and Mapbox expect.
+def write_metadata(connection: sqlite3.Connection, name: str, tile_format: str, min_zoom: int, max_zoom: int, bounds: list, extra: dict = None):
+    center = [(bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2, min_zoom]
+    metadata = {
+        'name': name,
+        'format': tile_format,
+        'type': 'overlay',
+        'minzoom': str(min_zoom),
+        'maxzoom': str(max_zoom),
+        'bounds': ','.join(str(value) for value in bounds),
+        'center': ','.join(str(value) for value in center),
+    }
+    metadata.update(extra or {})
+    connection.executemany('INSERT INTO metadata VALUES (?, ?)', metadata.items())
+
+# Writes feature columns from GridFeatures.grid_to_features as a vector MBTiles file with
+# one PM25 point layer, tiled from zoom 0 to max_zoom (guessed from the grid if not given).
+# Returns the number of tiles written.
+def write_vector_mbtiles(mbtiles_file_path: str, feature_columns: tuple, lon, lat, max_zoom: int = None) -> int:
+    feature_lon, feature_lat, feature_pm25, feature_ids = feature_columns
+    return write_point_mbtiles(mbtiles_file_path, feature_lon, feature_lat, feature_ids, [('PM25', feature_pm25)], lon, lat, max_zoom)
+
+# Writes packed feature columns from GridFeatures.iter_packed_feature_chunks as a vector
+# MBTiles file with one PM25_NN attribute per hour. Returns the number of tiles written.
+def write_packed_vector_mbtiles(mbtiles_file_path: str, packed_columns: tuple, lon, lat, max_zoom: int = None) -> int:
+    feature_lon, feature_lat, hour_values, feature_ids = packed_columns
+    properties = [(packed_attribute(position), hour_values[position]) for position in range(hour_values.shape[0])]
+    return write_point_mbtiles(mbtiles_file_path, feature_lon, feature_lat, feature_ids, properties, lon, lat, max_zoom)
+
+# Writes points with an id and numeric (name, values) properties as a vector MBTiles file.
+# Low zooms are thinned by the highest of the property values.
+def write_point_mbtiles(mbtiles_file_path: str, feature_lon, feature_lat, feature_ids, properties: list, lon, lat, max_zoom: int = None) -> int:
+    max_zoom = guess_max_zoom(lon, lat) if max_zoom is None else max_zoom
+    x, y = project(feature_lon, feature_lat)
+    peak_values = np.nanmax(np.stack([values for _, values in properties]), axis=0) if feature_ids.size else np.empty(0)
+    tile_count = 0
+    connection = create_mbtiles(mbtiles_file_path)
+    try:
+        for zoom in range(0, max_zoom + 1):
+            indexes = thin_points(x, y, peak_values, zoom) if zoom < max_zoom else np.arange(feature_ids.size)
+            if indexes.size == 0:
+                continue
+            for column, row, local_x, local_y, point_indexes in tile_points(x, y, zoom, indexes):
+                tile_properties = [(name, values[point_indexes]) for name, values in properties]
+                tile_data = gzip.compress(encode_tile(local_x, local_y, feature_ids[point_indexes], tile_properties), compresslevel=6)
+                insert_tile(connection, zoom, column, row, tile_data)
+                tile_count += 1
+        fields = {'id': 'String'}
+        fields.update({name: 'Number' for name, _ in properties})
+        vector_layers = [{'id': layer_name, 'description': '', 'minzoom': 0, 'maxzoom': max_zoom, 'fields': fields}]
+        bounds = [float(np.min(lon)), float(np.min(lat)), float(np.max(lon)), float(np.max(lat))]
+        name = os.path.basename(mbtiles_file_path).removesuffix('.mbtiles')
+        write_metadata(connection, name, 'pbf', 0, max_zoom, bounds, {'json': json.dumps({'vector_layers': vector_layers})})
+        connection.commit()
+    finally:
+        connection.close()
+    annotate(features=int(feature_ids.size), tiles=tile_count, bytes_out=os.path.getsize(mbtiles_file_path))
+    return tile_count
@@ -0,0 +1,466 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import boto3
+import requests
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+
+# Mapbox API and S3 endpoints, overridable for local stand-ins
+mapbox_api_url = 'https://api.mapbox.com'
+s3_endpoint_url = None
+# Connections kept alive to the Mapbox API and to S3
+connection_pool_size = 16
+# Staging credentials are refreshed this long before they expire
+credential_refresh_margin = 5 * 60  # seconds
+# Lifetime assumed for staging credentials that do not say when they expire
+credential_lifetime = 60 * 60  # seconds
+# Stage every file under one cached credentials response, at its staging key plus the
+# filename, instead of requesting credentials for each file and using the exact key Mapbox
+# issued. Mapbox does not document sub-keys, so this is only for accounts where it is known
+# to work; a session that S3 refuses a sub-key goes back to exact keys.
+shared_staging_keys = False
+# Multipart settings for staging mbtiles on S3
+transfer_config = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True,
+)
+# Uploads an UploadEngine stages at once. Uploads waiting on Mapbox processing only poll,
+# so many more than this can be in flight.
+max_staging_uploads = 16
+# Concurrent Mapbox API requests an UploadEngine starts with and may grow to. The limit
+# halves on every 429 and grows back by one after each full round of successful requests.
+initial_api_concurrency = 8
+max_api_concurrency = 32
+# Seconds between status checks of a Mapbox upload job
+upload_poll_interval = 5
+# Attempts per upload before it is reported as failed, and the wait between them
+max_upload_attempts = 3
+upload_retry_delay = 5  # seconds
+# Wait after a 429 that carries no Retry-After or X-Rate-Limit-Reset header
+default_rate_limit_wait = 1  # seconds
+# Tilesets per listing page, and concurrent DELETE requests when sweeping stale tilesets
+tileset_page_size = 500
+tileset_delete_workers = 8
+
+# Raised for a 429 response; wait is how long the API asked us to back off in seconds.
+class RateLimited(Exception):
+    def __init__(self, wait: float):
+        super().__init__(f'Rate limited for {wait:.1f} s')
+        self.wait = wait
+
+# Raised when Mapbox reports an upload job as failed.
+class UploadFailed(Exception):
+    pass
+
+# Raises RateLimited for a 429 response.
+def check_rate_limit(response: requests.Response):
+    if response.status_code == 429:
+        raise RateLimited(rate_limit_wait(response.headers))
+
+# Calls function, sleeping out and retrying any 429 it gets.
+def with_rate_limit_retries(function, *args):
+    while True:
+        try:
+            return function(*args)
+        except RateLimited as e:
+            time.sleep(e.wait)
+
+# Seconds to back off after a 429, from Retry-After or Mapbox's X-Rate-Limit-Reset epoch time.
+def rate_limit_wait(headers) -> float:
+    try:
+        if 'Retry-After' in headers:
+            return max(float(headers['Retry-After']), 0)
+        if 'X-Rate-Limit-Reset' in headers:
+            return max(float(headers['X-Rate-Limit-Reset']) - time.time(), 0)
+    except ValueError:
+        pass
+    return default_rate_limit_wait
+
+# Holds everything an upload needs that can be shared across uploads: one requests.Session
+# for all Mapbox API calls, the boto3 session whose loaded service models make new S3
+# clients cheap, and the current staging credentials with their S3 client.
+#
+# Mapbox hands out one staging key per credentials request, and each file is staged at
+# the exact key issued for it. The S3 client is reused for as long as Mapbox hands out the
+# same AWS credentials with its keys. With shared_staging_keys set, the credentials are
+# cached instead and files are staged under their key as a prefix while they are valid.
+class UploadSession:
+    def __init__(self, mapbox_username: str, mapbox_access_token: str):
+        self.mapbox_username = mapbox_username
+        self.mapbox_access_token = mapbox_access_token
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=connection_pool_size, pool_maxsize=connection_pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.boto_session = boto3.session.Session()
+        self.lock = threading.Lock()
+        # Held while the shared credentials are refreshed, so uploads starting together
+        # wait for one credentials request instead of each making their own
+        self.credentials_lock = threading.Lock()
+        self.cached_credentials = None
+        self.cached_s3_client = None
+        self.credentials_expire_at = 0
+        # AWS credentials of the last exact staging key and their S3 client
+        self.exact_credentials = None
+        self.exact_s3_client = None
+        self.shared_staging_keys = shared_staging_keys
+        self.inventory = TilesetInventory(self)
+
+    # URL of a Mapbox API path with the access token added
+    def api_url(self, path: str) -> str:
+        separator = '&' if '?' in path else '?'
+        return f'{mapbox_api_url}{path}{separator}access_token={self.mapbox_access_token}'
+
+    # Requests new staging credentials from Mapbox.
+    def request_credentials(self) -> dict:
+        response = self.session.post(self.api_url(f'/uploads/v1/{self.mapbox_username}/credentials'))
+        check_rate_limit(response)
+        response.raise_for_status()
+        return response.json()
+
+    # Builds an S3 client for staging credentials. Clients are thread-safe, so one is shared
+    # by every upload using the same credentials.
+    def s3_client(self, credentials: dict):
+        with self.lock:
+            # Creating clients from one boto3 session is not thread-safe
+            return self.boto_session.client(
+                's3',
+                aws_access_key_id=credentials['accessKeyId'],
+                aws_secret_access_key=credentials['secretAccessKey'],
+                aws_session_token=credentials['sessionToken'],
+                endpoint_url=s3_endpoint_url,
+                config=Config(
+                    max_pool_connections=connection_pool_size,
+                    retries={'max_attempts': 5, 'mode': 'adaptive'},
+                    # Local S3 stand-ins are addressed by path, not by bucket subdomain
+                    s3={'addressing_style': 'path'} if s3_endpoint_url else None,
+                ),
+            )
+
+    # Returns cached staging credentials and their S3 client, refreshing them near expiry.
+    def shared_credentials(self) -> tuple:
+        with self.credentials_lock:
+            with self.lock:
+                if self.cached_credentials is not None and time.time() < self.credentials_expire_at - credential_refresh_margin:
+                    return self.cached_credentials, self.cached_s3_client
+            credentials = self.request_credentials()
+            s3 = self.s3_client(credentials)
+            expire_at = time.time() + credential_lifetime
+            if credentials.get('expiration'):
+                expire_at = min(expire_at, parse_timestamp(credentials['expiration']))
+            with self.lock:
+                self.cached_credentials, self.cached_s3_client = credentials, s3
+                self.credentials_expire_at = expire_at
+            return credentials, s3
+
+    # Returns the S3 client for a set of credentials with an exact staging key, reusing the
+    # last one while the AWS credentials handed out with the keys stay the same.
+    def exact_key_client(self, credentials: dict):
+        aws_credentials = (credentials['accessKeyId'], credentials['secretAccessKey'], credentials['sessionToken'])
+        with self.lock:
+            if self.exact_credentials == aws_credentials:
+                return self.exact_s3_client
+        s3 = self.s3_client(credentials)
+        with self.lock:
+            self.exact_credentials, self.exact_s3_client = aws_credentials, s3
+        return s3
+
+    # Stages an mbtiles file on the Mapbox S3 bucket and returns its (bucket, key).
+    def stage_file(self, mbtiles_file_path: str, mbtiles_filename: str) -> tuple:
+        if self.shared_staging_keys:
+            credentials, s3 = self.shared_credentials()
+            bucket = credentials['bucket']
+            key = f"{credentials['key']}/{mbtiles_filename}"
+            try:
+                s3.upload_file(mbtiles_file_path, bucket, key, Config=transfer_config)
+                return bucket, key
+            except S3UploadFailedError as e:
+                if 'AccessDenied' not in str(e):
+                    raise
+                self.shared_staging_keys = False
+        credentials = self.request_credentials()
+        bucket = credentials['bucket']
+        key = credentials['key']
+        self.exact_key_client(credentials).upload_file(mbtiles_file_path, bucket, key, Config=transfer_config)
+        return bucket, key
+
+    # Deletes a tileset, ignoring whether it existed.
+    def delete_tileset(self, tileset_id: str):
+        check_rate_limit(self.session.delete(self.api_url(f'/tilesets/v1/{tileset_id}')))
+
+    # Starts the Mapbox upload job that turns a staged file into a tileset.
+    def create_upload(self, bucket: str, key: str, tileset_id: str, name: str) -> dict:
+        upload_payload = {
+            "url": f"https://{bucket}.s3.amazonaws.com/{key}",
+            "tileset": tileset_id,
+            "name": name
+        }
+        response = self.session.post(self.api_url(f'/uploads/v1/{self.mapbox_username}'), json=upload_payload)
+        check_rate_limit(response)
+        return response.json()
+
+    # One page of the account's tilesets, newest first. Returns the tilesets and the URL of
+    # the next page from the Link header, or None on the last page.
+    def list_tilesets(self, url: str = None) -> tuple:
+        response = self.session.get(url or self.api_url(f'/tilesets/v1/{self.mapbox_username}?limit={tileset_page_size}&sortby=modified'))
+        check_rate_limit(response)
+        response.raise_for_status()
+        next_url = response.links.get('next', {}).get('url')
+        if next_url and 'access_token=' not in next_url:
+            next_url += f"{'&' if '?' in next_url else '?'}access_token={self.mapbox_access_token}"
+        return response.json(), next_url
+
+    # Current state of a Mapbox upload job: complete, error and progress.
+    def upload_status(self, upload_id: str) -> dict:
+        response = self.session.get(self.api_url(f'/uploads/v1/{self.mapbox_username}/{upload_id}'))
+        check_rate_limit(response)
+        response.raise_for_status()
+        return response.json()
+
+# Index of the account's tilesets by id and modified time, listed once per run on first
+# use. It answers whether an upload replaces an existing tileset, so only those need a
+# DELETE first, and which tilesets are stale, without listing again. Uploads and deletes
+# made through it keep it current.
+class TilesetInventory:
+    def __init__(self, upload_session: UploadSession):
+        self.upload_session = upload_session
+        self.lock = threading.Lock()
+        self.modified = None
+
+    # Pages through the full tileset listing unless it was already loaded.
+    # Returns {tileset id: modified time in epoch seconds}.
+    def load(self) -> dict:
+        with self.lock:
+            if self.modified is None:
+                modified = {}
+                tilesets, next_url = with_rate_limit_retries(self.upload_session.list_tilesets)
+                while True:
+                    modified.update({tileset['id']: parse_timestamp(tileset['modified']) for tileset in tilesets})
+                    if not next_url:
+                        break
+                    tilesets, next_url = with_rate_limit_retries(self.upload_session.list_tilesets, next_url)
+                self.modified = modified
+            return self.modified
+
+    # Forgets the loaded listing, so the next use pages through it again. Sessions outlive
+    # runs under UploadDaemon, so each run starts from the account as it is now.
+    def reset(self):
+        with self.lock:
+            self.modified = None
+
+    # Whether the tileset exists.
+    def contains(self, tileset_id: str) -> bool:
+        modified = self.load()
+        with self.lock:
+            return tileset_id in modified
+
+    # Records a tileset as just uploaded.
+    def record_upload(self, tileset_id: str):
+        modified = self.load()
+        with self.lock:
+            modified[tileset_id] = time.time()
+
+    # Tilesets modified before older_than (epoch seconds) that are not in keep.
+    def stale_tileset_ids(self, keep: set, older_than: float) -> list:
+        modified = self.load()
+        with self.lock:
+            return [tileset_id for tileset_id, modified_time in modified.items() if modified_time < older_than and tileset_id not in keep]
+
+    # Deletes tilesets with up to tileset_delete_workers requests in flight.
+    def delete_tilesets(self, tileset_ids: list):
+        def delete(tileset_id: str):
+            with_rate_limit_retries(self.upload_session.delete_tileset, tileset_id)
+            with self.lock:
+                modified.pop(tileset_id, None)
+
+        modified = self.load()
+        with ThreadPoolExecutor(max_workers=tileset_delete_workers) as executor:
+            for _ in executor.map(delete, tileset_ids):
+                pass
+
+# Concurrency limit for Mapbox API requests that adapts to rate limiting: it halves on
+# a 429 and every request waits out the back-off the API asked for, then grows by one
+# after each limit's worth of successful requests. Used from one event loop only.
+class AdaptiveLimit:
+    def __init__(self, limit: int, max_limit: int):
+        self.limit = limit
+        self.max_limit = max_limit
+        # Lowest limit rate limiting brought it to, as it grows back afterwards
+        self.lowest_limit = limit
+        self.in_flight = 0
+        self.successes = 0
+        self.resume_at = 0
+        self.throttled = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        while True:
+            async with self.condition:
+                wait = self.resume_at - time.monotonic()
+                if wait <= 0:
+                    if self.in_flight < self.limit:
+                        self.in_flight += 1
+                        return
+                    await self.condition.wait()
+                    continue
+            await asyncio.sleep(wait)
+
+    # Ends a request. rate_limit_wait is set if it was rate limited.
+    async def release(self, rate_limit_wait: float = None):
+        async with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if rate_limit_wait is not None:
+                self.throttled += 1
+                # Requests already in flight get the same 429, so halve once per back-off
+                if now >= self.resume_at:
+                    self.limit = max(1, self.limit // 2)
+                    self.lowest_limit = min(self.lowest_limit, self.limit)
+                    self.successes = 0
+                self.resume_at = max(self.resume_at, now + rate_limit_wait)
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+    # Waits out a back-off without taking a request slot.
+    async def wait_for_resume(self):
+        wait = self.resume_at - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+# Runs uploads for one UploadSession on an asyncio event loop in a background thread, so
+# any number of threads can hand it files. Blocking requests and boto3 calls run in the
+# loop's thread pool. Each upload deletes the old tileset, stages the file, starts the
+# Mapbox upload job and polls it until it completes. A job that fails is retried from the
+# start, up to max_upload_attempts times; a 429 only delays the request that got it.
+class UploadEngine:
+    def __init__(self, upload_session: UploadSession):
+        self.upload_session = upload_session
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=max_staging_uploads + max_api_concurrency))
+        self.api_limit = AdaptiveLimit(initial_api_concurrency, max_api_concurrency)
+        self.staging_slots = asyncio.Semaphore(max_staging_uploads)
+        self.retried = 0
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    # Schedules an upload and returns a concurrent.futures.Future of its final job status.
+    def submit(self, mbtiles_file_path: str, tileset_id: str, name: str) -> Future:
+        return asyncio.run_coroutine_threadsafe(self.upload(mbtiles_file_path, tileset_id, name), self.loop)
+
+    # Uploads a file and returns the completed upload job with the attempts it took added,
+    # raising if every attempt failed. The exception then carries upload_attempts.
+    async def upload(self, mbtiles_file_path: str, tileset_id: str, name: str) -> dict:
+        for attempt in range(max_upload_attempts):
+            try:
+                upload = await self.upload_once(mbtiles_file_path, tileset_id, name)
+                upload['attempts'] = attempt + 1
+                return upload
+            except Exception as e:
+                if attempt == max_upload_attempts - 1:
+                    e.upload_attempts = max_upload_attempts
+                    raise
+                self.retried += 1
+                print(f"\nUpload of {name} failed, retrying in {upload_retry_delay} seconds... (attempt {attempt + 1}/{max_upload_attempts}) Error: {e}")
+                await asyncio.sleep(upload_retry_delay)
+
+    # One upload attempt. The returned job also holds staging_seconds, the time to delete,
+    # stage and start it, and processing_seconds, the time Mapbox took to finish it.
+    async def upload_once(self, mbtiles_file_path: str, tileset_id: str, name: str) -> dict:
+        upload_session = self.upload_session
+        start_time = time.perf_counter()
+        async with self.staging_slots:
+            # Only tilesets that exist need deleting before they are replaced
+            if await self.call(upload_session.inventory.contains, tileset_id):
+                await self.call_api(upload_session.delete_tileset, tileset_id)
+            bucket, key = await self.call(upload_session.stage_file, mbtiles_file_path, os.path.basename(mbtiles_file_path))
+            upload = await self.call_api(upload_session.create_upload, bucket, key, tileset_id, name)
+        staged_time = time.perf_counter()
+        while True:
+            if upload.get('error'):
+                raise UploadFailed(upload['error'])
+            if upload.get('complete'):
+                upload_session.inventory.record_upload(tileset_id)
+                upload['staging_seconds'] = staged_time - start_time
+                upload['processing_seconds'] = time.perf_counter() - staged_time
+                return upload
+            if 'id' not in upload:
+                raise UploadFailed(upload.get('message', 'Mapbox did not start an upload job'))
+            await asyncio.sleep(upload_poll_interval)
+            upload = await self.call_api(upload_session.upload_status, upload['id'])
+
+    # Runs a blocking Mapbox API call within the adaptive concurrency limit.
+    async def call_api(self, function, *args):
+        while True:
+            await self.api_limit.acquire()
+            try:
+                result = await self.loop.run_in_executor(None, function, *args)
+            except RateLimited as e:
+                await self.api_limit.release(e.wait)
+                continue
+            except BaseException:
+                await self.api_limit.release()
+                raise
+            await self.api_limit.release()
+            return result
+
+    # Runs a blocking call outside the API limit, waiting out any back-off it runs into.
+    async def call(self, function, *args):
+        while True:
+            await self.api_limit.wait_for_resume()
+            try:
+                return await self.loop.run_in_executor(None, function, *args)
+            except RateLimited as e:
+                async with self.api_limit.condition:
+                    self.api_limit.resume_at = max(self.api_limit.resume_at, time.monotonic() + e.wait)
+
+# Parses an ISO 8601 time like '2024-08-01T06:00:00.000Z' to epoch seconds.
+def parse_timestamp(timestamp: str) -> float:
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp()
+
+upload_sessions_lock = threading.Lock()
+upload_sessions = {}
+
+# Returns the UploadSession shared by every upload for this Mapbox account.
+def get_upload_session(mapbox_username: str, mapbox_access_token: str) -> UploadSession:
+    with upload_sessions_lock:
+        key = (mapbox_username, mapbox_access_token)
+        if key not in upload_sessions:
+            upload_sessions[key] = UploadSession(mapbox_username, mapbox_access_token)
+        return upload_sessions[key]
+
+upload_engines = {}
+
+# Returns the UploadEngine shared by every upload for this Mapbox account.
+def get_upload_engine(mapbox_username: str, mapbox_access_token: str) -> UploadEngine:
+    upload_session = get_upload_session(mapbox_username, mapbox_access_token)
+    with upload_sessions_lock:
+        key = (mapbox_username, mapbox_access_token)
+        if key not in upload_engines:
+            upload_engines[key] = UploadEngine(upload_session)
+        return upload_engines[key]
+
+# Reads the Mapbox username and access token for runs without a terminal, from the
+# MAPBOX_USERNAME and MAPBOX_ACCESS_TOKEN environment variables or else from the JSON file
+# {"username": ..., "access_token": ...} that MAPBOX_CREDENTIALS_FILE points to. Returns
+# None if neither is set.
+def mapbox_credentials() -> (tuple | None):
+    if os.environ.get('MAPBOX_USERNAME') and os.environ.get('MAPBOX_ACCESS_TOKEN'):
+        return os.environ['MAPBOX_USERNAME'], os.environ['MAPBOX_ACCESS_TOKEN']
+    credentials_path = os.environ.get('MAPBOX_CREDENTIALS_FILE')
+    if not credentials_path:
+        return None
+    with open(credentials_path) as f:
+        credentials = json.load(f)
+    return credentials['username'], credentials['access_token']
@@ -0,0 +1,189 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Fields added with annotate land in the record of the stage running in this thread
+current_stage = threading.local()
+
+# Adds fields, like bytes_out or features, to the record of the stage this thread is
+# running. Numbers given for the same field more than once are added up. Does nothing
+# outside a stage.
+def annotate(**fields):
+    stage_fields = getattr(current_stage, 'fields', None)
+    if stage_fields is None:
+        return
+    for name, value in fields.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and isinstance(stage_fields.get(name), (int, float)):
+            stage_fields[name] += value
+        else:
+            stage_fields[name] = value
+
+# Calls function(item) and returns its result along with the fields it annotated. Used to
+# carry annotations made in a worker process back to the stage that waits for it.
+def collect_annotations(function, item) -> tuple:
+    current_stage.fields = {}
+    try:
+        return function(item), current_stage.fields
+    finally:
+        current_stage.fields = None
+
+# Peak resident memory in MB of this process, or of the largest finished child process
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    peak_rss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform == 'darwin':
+        return peak_rss / (1024 * 1024)
+    return peak_rss / 1024
+
+# Name an item is traced under: a pack's tileset name, or the item itself
+def item_label(item) -> str:
+    if isinstance(item, tuple):
+        return str(item[0])
+    return str(item)
+
+# Per-item, per-stage metrics for one run. Every finished stage of every item is appended
+# to trace_path as one JSON line with its wall time, outcome and annotated fields.
+# finish() writes stage totals and peak memory to prometheus_path for the node_exporter
+# textfile collector and prints a summary.
+class RunMetrics:
+    def __init__(self, job: str, trace_path: str = None, prometheus_path: str = None):
+        self.job = job
+        self.trace_path = trace_path
+        self.prometheus_path = prometheus_path
+        self.lock = threading.Lock()
+        self.records = []
+        self.started_at = time.time()
+        if trace_path:
+            # One trace per run
+            open(trace_path, 'w').close()
+
+    # Times the enclosed block as stage for item and records it, including any exception,
+    # which is re-raised. Yields the record's fields for the block to fill in.
+    @contextmanager
+    def stage(self, stage: str, item: str):
+        fields = {}
+        previous_fields = getattr(current_stage, 'fields', None)
+        current_stage.fields = fields
+        start_time = time.perf_counter()
+        error = None
+        try:
+            yield fields
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            current_stage.fields = previous_fields
+            self.record(stage, item, time.perf_counter() - start_time, error, fields)
+
+    # Wraps function so every call is recorded as stage, labelled by its first argument.
+    def traced(self, stage: str, function):
+        def run(item, *args, **kwargs):
+            with self.stage(stage, item_label(item)):
+                return function(item, *args, **kwargs)
+        return run
+
+    # Records one stage of one item. A stage that annotated an error failed, even if it
+    # handled the error itself.
+    def record(self, stage: str, item: str, seconds: float, error: str = None, fields: dict = None):
+        record = {'time': time.time(), 'job': self.job, 'stage': stage, 'item': item, 'seconds': seconds}
+        record.update(fields or {})
+        if error is not None:
+            record['error'] = error
+        record['ok'] = 'error' not in record
+        with self.lock:
+            self.records.append(record)
+            if self.trace_path:
+                with open(self.trace_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+    # Totals per stage, in the order stages first finished an item.
+    def summary(self) -> dict:
+        with self.lock:
+            records = list(self.records)
+        stages = {}
+        for record in records:
+            totals = stages.setdefault(record['stage'], {
+                'ok': 0, 'failed': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'slowest_item': None,
+                'bytes_in': 0, 'bytes_out': 0, 'features': 0, 'retries': 0, 'cpu_seconds': 0.0, 'peak_rss_mb': 0.0,
+                'disk_bytes_avoided': 0,
+            })
+            totals['ok' if record['ok'] else 'failed'] += 1
+            totals['seconds'] += record['seconds']
+            if record['seconds'] >= totals['max_seconds']:
+                totals['max_seconds'], totals['slowest_item'] = record['seconds'], record['item']
+            for field in ('bytes_in', 'bytes_out', 'features', 'cpu_seconds', 'disk_bytes_avoided'):
+                totals[field] += record.get(field, 0)
+            totals['peak_rss_mb'] = max(totals['peak_rss_mb'], record.get('peak_rss_mb', 0))
+            totals['retries'] += max(record.get('upload_attempts', 1) - 1, 0)
+        return stages
+
+    # Writes the Prometheus textfile and prints the end-of-run summary.
+    def finish(self):
+        stages = self.summary()
+        if self.prometheus_path:
+            self.write_prometheus(stages)
+        print(f"Run finished in {time.time() - self.started_at:.1f} s.")
+        for stage, totals in stages.items():
+            items = totals['ok'] + totals['failed']
+            line = (f"  {stage}: {totals['ok']} ok, {totals['failed']} failed, {totals['seconds']:.1f} s total, "
+                    f"{totals['seconds'] / items:.2f} s mean, {totals['max_seconds']:.2f} s max ({totals['slowest_item']})")
+            if totals['bytes_out']:
+                line += f", {totals['bytes_out'] / (1024 * 1024):.1f} MB out"
+            if totals['features']:
+                line += f", {totals['features']} features"
+            if totals['retries']:
+                line += f", {totals['retries']} retries"
+            if totals['cpu_seconds']:
+                line += f", {totals['cpu_seconds']:.1f} s CPU, {totals['peak_rss_mb']:.0f} MB peak RSS"
+            print(line)
+        # Children count once they have exited, so a worker pool the run shares with later
+        # runs only shows up after it shuts down
+        print(f"  Peak RSS: {peak_rss_mb():.0f} MB main process, {peak_rss_mb(resource.RUSAGE_CHILDREN):.0f} MB largest worker or subprocess.")
+        disk_bytes_avoided = sum(totals['disk_bytes_avoided'] for totals in stages.values())
+        if disk_bytes_avoided:
+            print(f"  {disk_bytes_avoided / (1024 * 1024):.1f} MB of scratch disk reads and writes avoided.")
+        failures = [record for record in self.records if not record['ok']]
+        for record in failures[:10]:
+            print(f"  Failed {record['stage']} of {record['item']}: {record['error']}")
+
+    # Stage totals in the Prometheus text format, written to a temp file and renamed into
+    # place so the collector never reads a partial file.
+    def write_prometheus(self, stages: dict):
+        metrics = [
+            ('pm25_stage_items', 'Items that finished each stage in the last run.', lambda stage, totals: [
+                (f'stage="{stage}",status="ok"', totals['ok']), (f'stage="{stage}",status="failed"', totals['failed'])]),
+            ('pm25_stage_seconds', 'Wall time spent in each stage in the last run, summed over items.', lambda stage, totals: [(f'stage="{stage}"', totals['seconds'])]),
+            ('pm25_stage_max_seconds', 'Wall time of the slowest item in each stage in the last run.', lambda stage, totals: [(f'stage="{stage}"', totals['max_seconds'])]),
+            ('pm25_stage_bytes_in', 'Bytes read by each stage in the last run.', lambda stage, totals: [(f'stage="{stage}"', totals['bytes_in'])]),
+            ('pm25_stage_bytes_out', 'Bytes written by each stage in the last run.', lambda stage, totals: [(f'stage="{stage}"', totals['bytes_out'])]),
+            ('pm25_stage_features', 'Features emitted by each stage in the last run.', lambda stage, totals: [(f'stage="{stage}"', totals['features'])]),
+            ('pm25_stage_retries', 'Upload retries in each stage in the last run.', lambda stage, totals: [(f'stage="{stage}"', totals['retries'])]),
+            ('pm25_stage_cpu_seconds', 'CPU time of the subprocesses run by each stage in the last run.', lambda stage, totals: [(f'stage="{stage}"', totals['cpu_seconds'])]),
+            ('pm25_stage_disk_bytes_avoided', 'Disk reads and writes each stage skipped by keeping files in memory in the last run.', lambda stage, totals: [(f'stage="{stage}"', totals['disk_bytes_avoided'])]),
+            ('pm25_stage_peak_rss_bytes', 'Peak RSS of the largest subprocess run by each stage in the last run.', lambda stage, totals: [(f'stage="{stage}"', totals['peak_rss_mb'] * 1024 * 1024)]),
+        ]
+        lines = []
+        for name, help_text, samples in metrics:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for stage, totals in stages.items():
+                for labels, value in samples(stage, totals):
+                    lines.append(f'{name}{{job="{self.job}",{labels}}} {value}')
+        lines.append('# HELP pm25_run_seconds Wall time of the last run.')
+        lines.append('# TYPE pm25_run_seconds gauge')
+        lines.append(f'pm25_run_seconds{{job="{self.job}"}} {time.time() - self.started_at}')
+        lines.append('# HELP pm25_run_peak_rss_bytes Peak RSS of the main process, and of its largest exited child, by the end of the last run.')
+        lines.append('# TYPE pm25_run_peak_rss_bytes gauge')
+        lines.append(f'pm25_run_peak_rss_bytes{{job="{self.job}",process="main"}} {peak_rss_mb() * 1024 * 1024}')
+        lines.append(f'pm25_run_peak_rss_bytes{{job="{self.job}",process="children"}} {peak_rss_mb(resource.RUSAGE_CHILDREN) * 1024 * 1024}')
+        lines.append('# HELP pm25_run_finished_timestamp_seconds When the last run finished.')
+        lines.append('# TYPE pm25_run_finished_timestamp_seconds gauge')
+        lines.append(f'pm25_run_finished_timestamp_seconds{{job="{self.job}"}} {time.time()}')
+        temp_path = self.prometheus_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.prometheus_path)
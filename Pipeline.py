@@ -0,0 +1,116 @@
+import queue
+import sys
+import threading
+from functools import partial
+from Metrics import annotate, collect_annotations, item_label
+
+# Items that may wait between two stages before the earlier stage blocks
+pipeline_queue_size = 8
+# Marks the end of a stage's input
+end_of_input = object()
+
+# Runs items through a chain of stages, each a (name, function, workers) tuple.
+# Every item moves on as soon as its stage finishes it, so one forecast hour can upload
+# while others are still converting. The queues between stages are bounded, so a slow
+# stage holds back the ones before it and intermediate files on disk stay capped.
+# A stage function returning None or raising drops the item. Returns the results of
+# the last stage. With metrics, a Metrics.RunMetrics, every stage of every item is
+# recorded under the label of the item it started as. With journal, a RunJournal.RunJournal,
+# every stage goes through the journal, which records its result and skips stages an
+# earlier, interrupted run already finished.
+def run_pipeline(items: list, stages: list, queue_size: int = None, metrics=None, journal=None) -> list:
+    queue_size = queue_size or pipeline_queue_size
+    stage_names = [name for name, _, _ in stages]
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    completed_jobs = [0] * len(stages)
+    total_jobs = len(items)
+    progress_lock = threading.Lock()
+
+    def print_progress():
+        stage_progress = ', '.join(f"{completed_jobs[index]} {name}" for index, (name, _, _) in enumerate(stages))
+        print(f"\r({stage_progress}) of {total_jobs} forecast hours.", end="")
+        sys.stdout.flush()
+
+    def feed():
+        for item in items:
+            queues[0].put((item_label(item), item))
+        queues[0].put(end_of_input)
+
+    def work(stage_index: int, function, running_workers: list):
+        input_queue = queues[stage_index]
+        output_queue = queues[stage_index + 1]
+        stage_name = stages[stage_index][0]
+        while True:
+            entry = input_queue.get()
+            if entry is end_of_input:
+                # Hand the marker to the next sibling; the last worker out closes the next stage
+                input_queue.put(end_of_input)
+                with progress_lock:
+                    running_workers[0] -= 1
+                    last_worker = running_workers[0] == 0
+                if last_worker:
+                    output_queue.put(end_of_input)
+                return
+            label, item = entry
+            result = None
+            call = function if journal is None else partial(journal.run_stage, stage_names, stage_index, label, function)
+            try:
+                if metrics is None:
+                    result = call(item)
+                else:
+                    with metrics.stage(stage_name, label) as fields:
+                        result = call(item)
+                        if result is None:
+                            fields['dropped'] = True
+            except Exception as e:
+                print(f"\nException occurred: {e}")
+            with progress_lock:
+                completed_jobs[stage_index] += 1
+                print_progress()
+            if result is not None:
+                output_queue.put((label, result))
+
+    print_progress()
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for stage_index, (_, function, workers) in enumerate(stages):
+        running_workers = [workers]
+        for _ in range(workers):
+            threads.append(threading.Thread(target=work, args=(stage_index, function, running_workers), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    results = []
+    while True:
+        entry = queues[-1].get()
+        if entry is end_of_input:
+            break
+        results.append(entry[1])
+    for thread in threads:
+        thread.join()
+    print()
+    return results
+
+# Wraps function so each call runs in executor, letting a pipeline stage hand
+# CPU-bound work to a process pool while its thread waits for the result. Fields the
+# function annotates in the worker are added to the waiting stage's metrics.
+def in_executor(executor, function):
+    def run(item):
+        result, fields = executor.submit(collect_annotations, function, item).result()
+        annotate(**fields)
+        return result
+    return run
+
+# Runs function on every item in executor at once and yields the results in item order,
+# each as soon as it and those before it are ready, so one large job split into parts
+# keeps every worker busy. Fields the function annotates in the workers are added to
+# the caller's metrics.
+def map_in_executor(executor, function, items):
+    futures = [executor.submit(collect_annotations, function, item) for item in items]
+    try:
+        for future in futures:
+            result, fields = future.result()
+            annotate(**fields)
+            yield result
+    finally:
+        for future in futures:
+            future.cancel()
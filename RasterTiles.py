@@ -0,0 +1,150 @@
+import math
+import os
+import struct
+import zlib
+import numpy as np
+from GridFeatures import PM25_bands, cell_edges
+from GridPyramid import reduce_grid
+from MBTiles import create_mbtiles, guess_max_zoom, insert_tile, max_latitude, write_metadata
+from Metrics import annotate
+
+# Raster tilesets of PM25 grids. The grid is a dense regular lon/lat grid, so each tile is
+# sampled straight from it with NumPy instead of going through point features: web
+# mercator is separable, so every tile pixel column maps to one grid column and every
+# pixel row to one grid row. Zooms where a pixel spans several cells sample a grid
+# reduced with GridPyramid.reduce_grid, so peaks survive at low zooms. Tiles are PNGs
+# encoded with zlib; cells below PM25_threshold and missing cells are transparent.
+
+# Tile width and height in pixels
+raster_tile_size = 256
+# 'color' paints each cell with the colour of its GridFeatures.PM25_bands band as an
+# 8-bit palette PNG. 'value' packs PM25 in hundredths into the red, green and blue bytes
+# of an RGBA PNG, like Mapbox Terrain-RGB, for clients that colour the data themselves.
+raster_encoding = 'color'
+# Block reduction of the grid at zooms where a pixel spans several cells, 'max' or 'mean'
+raster_reduction = 'max'
+# zlib level of PNG data
+png_compression = 6
+# US EPA AQI colours of the PM25_bands bands, index 0 being transparent
+band_colors = [(0, 0, 0), (0, 228, 0), (255, 255, 0), (255, 126, 0), (255, 0, 0), (143, 63, 151), (126, 0, 35)]
+# PM25 units per step of the 'value' encoding
+value_scale = 0.01
+
+# Encodes pixels as a PNG: an 8-bit palette image with palette colours and index 0
+# transparent, or an RGBA image from a (height, width, 4) array. Rows are unfiltered,
+# which compresses band images and smooth fields about as well as filtering would.
+def encode_png(pixels, palette: list = None) -> bytes:
+    height, width = pixels.shape[:2]
+    color_type = 3 if palette is not None else 6
+    rows = np.zeros((height, 1 + pixels[0].size), dtype=np.uint8)
+    rows[:, 1:] = pixels.reshape(height, -1)
+    chunks = [png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0))]
+    if palette is not None:
+        chunks.append(png_chunk(b'PLTE', bytes(channel for color in palette for channel in color)))
+        chunks.append(png_chunk(b'tRNS', b'\x00'))
+    chunks.append(png_chunk(b'IDAT', zlib.compress(rows.tobytes(), png_compression)))
+    chunks.append(png_chunk(b'IEND', b''))
+    return b'\x89PNG\r\n\x1a\n' + b''.join(chunks)
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+# Pixels of a tile's PM25 values for raster_encoding, and the palette if there is one.
+# NaN and values below PM25_threshold are transparent.
+def encode_values(values) -> tuple:
+    present = ~np.isnan(values) & (np.nan_to_num(values, nan=0) >= PM25_bands[0])
+    if raster_encoding == 'color':
+        bands = np.where(present, np.digitize(np.nan_to_num(values, nan=0), PM25_bands), 0)
+        return bands.astype(np.uint8), band_colors
+    if raster_encoding == 'value':
+        steps = np.clip(np.round(np.nan_to_num(values, nan=0) / value_scale), 0, 2 ** 24 - 1).astype(np.uint32)
+        pixels = np.empty(values.shape + (4,), dtype=np.uint8)
+        pixels[..., 0] = steps >> 16
+        pixels[..., 1] = (steps >> 8) & 0xff
+        pixels[..., 2] = steps & 0xff
+        pixels[..., 3] = np.where(present, 255, 0)
+        return pixels, None
+    raise ValueError(f"Unknown raster encoding: {raster_encoding}")
+
+# Grid cell of each coordinate, by the cell edges around the given centers, which may be
+# ascending or descending. Returns the cell indexes and whether each falls inside the grid.
+def nearest_cells(centers, coords) -> tuple:
+    descending = centers.size > 1 and centers[-1] < centers[0]
+    ascending_centers = centers[::-1] if descending else centers
+    index = np.searchsorted(cell_edges(ascending_centers), coords, side='right') - 1
+    inside = (index >= 0) & (index < centers.size)
+    index = np.clip(index, 0, centers.size - 1)
+    if descending:
+        index = centers.size - 1 - index
+    return index, inside
+
+# Lon of the centers of pixel columns, and lat of the centers of pixel rows, of tiles
+# first to last (inclusive) along one axis at zoom
+def pixel_lons(first: int, last: int, zoom: int):
+    x = (np.arange(first * raster_tile_size, (last + 1) * raster_tile_size) + 0.5) / (raster_tile_size * 2 ** zoom)
+    return x * 360 - 180
+
+def pixel_lats(first: int, last: int, zoom: int):
+    y = (np.arange(first * raster_tile_size, (last + 1) * raster_tile_size) + 0.5) / (raster_tile_size * 2 ** zoom)
+    return np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * y))))
+
+# Range of tile columns and rows at zoom covering the lon/lat bounds
+def tile_range(west: float, south: float, east: float, north: float, zoom: int) -> tuple:
+    tiles = 2 ** zoom
+    def tile_y(lat):
+        lat_radians = math.radians(min(max(lat, -max_latitude), max_latitude))
+        return (1 - math.log(math.tan(lat_radians) + 1 / math.cos(lat_radians)) / math.pi) / 2
+    def clamp(tile):
+        return min(max(int(tile), 0), tiles - 1)
+    return (clamp((west + 180) / 360 * tiles), clamp(tile_y(north) * tiles),
+            clamp((east + 180) / 360 * tiles), clamp(tile_y(south) * tiles))
+
+# Writes a PM25 grid indexed [lat, lon] as a raster MBTiles file of PNG tiles, from zoom 0
+# to max_zoom (guessed from the grid if not given). Tiles without a visible pixel are left
+# out. Returns the number of tiles written.
+def write_raster_mbtiles(mbtiles_file_path: str, lon, lat, pm25, max_zoom: int = None) -> int:
+    lon = np.ma.filled(np.ma.asarray(lon, dtype=np.float64), np.nan)
+    lat = np.ma.filled(np.ma.asarray(lat, dtype=np.float64), np.nan)
+    grid = np.ma.filled(np.ma.asarray(pm25, dtype=np.float64), np.nan)
+    max_zoom = guess_max_zoom(lon, lat) if max_zoom is None else max_zoom
+    lon_edges, lat_edges = cell_edges(lon), cell_edges(lat)
+    bounds = [float(np.min(lon_edges)), float(np.min(lat_edges)), float(np.max(lon_edges)), float(np.max(lat_edges))]
+    cell_degrees = min(np.min(np.abs(np.diff(lon))) if lon.size > 1 else 360, np.min(np.abs(np.diff(lat))) if lat.size > 1 else 180)
+    tile_count = 0
+    connection = create_mbtiles(mbtiles_file_path)
+    try:
+        for zoom in range(0, max_zoom + 1):
+            # Where a pixel spans several cells, the grid is reduced in power of two blocks at
+            # least a pixel wide, so every block, and with it every peak, lands on a pixel
+            pixel_degrees = 360 / (raster_tile_size * 2 ** zoom)
+            factor = 2 ** max(0, math.ceil(math.log2(pixel_degrees / cell_degrees)))
+            if factor > 1:
+                level_lon, level_lat, level_grid = reduce_grid(lon, lat, grid, factor, raster_reduction)
+            else:
+                level_lon, level_lat, level_grid = lon, lat, grid
+            first_column, first_row, last_column, last_row = tile_range(*bounds, zoom)
+            columns, column_inside = nearest_cells(level_lon, pixel_lons(first_column, last_column, zoom))
+            rows, row_inside = nearest_cells(level_lat, pixel_lats(first_row, last_row, zoom))
+            for row in range(first_row, last_row + 1):
+                row_slice = slice((row - first_row) * raster_tile_size, (row - first_row + 1) * raster_tile_size)
+                if not row_inside[row_slice].any():
+                    continue
+                for column in range(first_column, last_column + 1):
+                    column_slice = slice((column - first_column) * raster_tile_size, (column - first_column + 1) * raster_tile_size)
+                    if not column_inside[column_slice].any():
+                        continue
+                    values = level_grid[np.ix_(rows[row_slice], columns[column_slice])]
+                    values[~(row_inside[row_slice][:, None] & column_inside[column_slice][None, :])] = np.nan
+                    pixels, palette = encode_values(values)
+                    visible = pixels.any() if palette is not None else pixels[..., 3].any()
+                    if not visible:
+                        continue
+                    insert_tile(connection, zoom, column, row, encode_png(pixels, palette))
+                    tile_count += 1
+        name = os.path.basename(mbtiles_file_path).removesuffix('.mbtiles')
+        write_metadata(connection, name, 'png', 0, max_zoom, bounds, {'encoding': raster_encoding})
+        connection.commit()
+    finally:
+        connection.close()
+    annotate(tiles=tile_count, bytes_out=os.path.getsize(mbtiles_file_path))
+    return tile_count
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from Metrics import annotate
+
+# Bytes read per hash update when checksumming artifacts
+hash_chunk_size = 1024 * 1024
+
+# Crash-safe record of how far each pipeline item got, kept in SQLite next to the forecast
+# cache so a run that died partway resumes instead of starting over. Every finished stage
+# of an item is stored with the version of the item's input, the stage's result and the
+# sha256, size and mtime of every file in folder_path the result names. A stage is skipped
+# on a later run when it, or a later stage of the item, finished from the same input
+# version and its files are still intact. Files are only hashed again once their size or
+# mtime changes. version(label) returns an item's current input version, or None
+# if unknown. Stages in recheck_stages always run, because they are what finds out
+# whether an item's input changed.
+class RunJournal:
+    def __init__(self, journal_path: str, folder_path: str, version, recheck_stages: tuple = ()):
+        self.folder_path = folder_path
+        self.version = version
+        self.recheck_stages = set(recheck_stages)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(journal_path, check_same_thread=False, isolation_level=None)
+        # Every record is committed on its own, and WAL keeps a crash from corrupting the file
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS progress (
+            item TEXT NOT NULL, stage TEXT NOT NULL, version TEXT NOT NULL,
+            result TEXT NOT NULL, artifacts TEXT NOT NULL, finished REAL NOT NULL,
+            PRIMARY KEY (item, stage))''')
+
+    # Runs function(item) as stage stage_index of stage_names for the item labelled label,
+    # unless it can be skipped, in which case the stage's recorded result is returned.
+    # The result is recorded, and once the last stage finishes the item is forgotten.
+    def run_stage(self, stage_names: list, stage_index: int, label: str, function, item):
+        stage = stage_names[stage_index]
+        if stage not in self.recheck_stages:
+            version = self.version(label)
+            if version is not None and self.resume_stage(label, version, stage_names[stage_index:]) is not None:
+                recorded = self.recorded_result(label, stage, version)
+                if recorded is not None:
+                    annotate(resumed=True)
+                    return recorded
+        result = function(item)
+        if result is not None:
+            if stage_index == len(stage_names) - 1:
+                self.forget(label)
+            else:
+                self.record(label, stage, result)
+        return result
+
+    # Records a finished stage of an item, unless its result can not be stored as JSON,
+    # like a file held in memory.
+    def record(self, label: str, stage: str, result):
+        version = self.version(label)
+        try:
+            result_text = json.dumps(result)
+        except TypeError:
+            return
+        if version is None:
+            return
+        artifacts = {filename: artifact_record(os.path.join(self.folder_path, filename)) for filename in result_filenames(result)
+                     if os.path.isfile(os.path.join(self.folder_path, filename))}
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO progress VALUES (?, ?, ?, ?, ?, ?)',
+                                    (label, stage, version, result_text, json.dumps(artifacts), time.time()))
+
+    # The furthest of stages the item finished from input version with every file it
+    # produced still intact, or None. A stage whose result named no files is never intact,
+    # since nothing of it survives to resume from.
+    def resume_stage(self, label: str, version: str, stages: list) -> (str | None):
+        with self.lock:
+            rows = self.connection.execute('SELECT stage, artifacts FROM progress WHERE item = ? AND version = ?', (label, version)).fetchall()
+        artifacts = dict(rows)
+        for stage in reversed(stages):
+            if stage in artifacts and self.intact(json.loads(artifacts[stage])):
+                return stage
+        return None
+
+    # Whether the item has any intact progress from its current input version.
+    def has_progress(self, label: str) -> bool:
+        version = self.version(label)
+        if version is None:
+            return False
+        with self.lock:
+            stages = [stage for stage, in self.connection.execute('SELECT stage FROM progress WHERE item = ? AND version = ?', (label, version))]
+        return self.resume_stage(label, version, stages) is not None
+
+    # Recorded result of a stage from input version, or None
+    def recorded_result(self, label: str, stage: str, version: str):
+        with self.lock:
+            row = self.connection.execute('SELECT result FROM progress WHERE item = ? AND stage = ? AND version = ?', (label, stage, version)).fetchone()
+        if row is None:
+            return None
+        return as_tuples(json.loads(row[0]))
+
+    # Whether every file is present with the recorded sha256. A file with its recorded size
+    # and mtime is taken to be unchanged without reading it.
+    def intact(self, artifacts: dict) -> bool:
+        if not artifacts:
+            return False
+        for filename, recorded in artifacts.items():
+            file_path = os.path.join(self.folder_path, filename)
+            if not os.path.isfile(file_path):
+                return False
+            # Journals written before sizes and mtimes were kept hold just the sha256
+            sha256, size, mtime_ns = recorded if isinstance(recorded, list) else (recorded, None, None)
+            stat = os.stat(file_path)
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns) and file_sha256(file_path) != sha256:
+                return False
+        return True
+
+    def forget(self, label: str):
+        with self.lock:
+            self.connection.execute('DELETE FROM progress WHERE item = ?', (label,))
+
+    # Forgets items that are not in current_labels, like hours that left the forecast, and
+    # progress from an input version other than the item's current one, deleting the files
+    # it produced that no remaining progress needs.
+    def prune(self, current_labels: list):
+        current_labels = set(current_labels)
+        with self.lock:
+            rows = self.connection.execute('SELECT item, stage, version, artifacts FROM progress').fetchall()
+        stale_files = set()
+        for label, stage, version, artifacts in rows:
+            if label not in current_labels or version != self.version(label):
+                with self.lock:
+                    self.connection.execute('DELETE FROM progress WHERE item = ? AND stage = ?', (label, stage))
+                stale_files.update(json.loads(artifacts))
+        for filename in stale_files - self.artifact_files():
+            file_path = os.path.join(self.folder_path, filename)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+
+    # Files in folder_path that recorded stages produced, which clearing the folder keeps.
+    def artifact_files(self) -> set:
+        with self.lock:
+            rows = self.connection.execute('SELECT artifacts FROM progress').fetchall()
+        return {filename for artifacts, in rows for filename in json.loads(artifacts)}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+# Every string in a stage result, which may name files, like a filename or a pack of them
+def result_filenames(result) -> list:
+    if isinstance(result, str):
+        return [result]
+    if isinstance(result, (list, tuple)):
+        return [filename for part in result for filename in result_filenames(part)]
+    return []
+
+# Stage results stored as JSON come back with lists where they had tuples
+def as_tuples(value):
+    if isinstance(value, list):
+        return tuple(as_tuples(part) for part in value)
+    return value
+
+# Returns the [sha256, size, mtime_ns] a journal records for a file. The file is stat'ed
+# before it is hashed, so a write during hashing changes its mtime and gets it rehashed.
+def artifact_record(file_path: str) -> list:
+    stat = os.stat(file_path)
+    return [file_sha256(file_path), stat.st_size, stat.st_mtime_ns]
+
+# Returns the hex sha256 of a file, read in chunks.
+def file_sha256(file_path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(hash_chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
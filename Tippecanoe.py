@@ -0,0 +1,212 @@
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import threading
+import time
+from GridFeatures import format_features, write_features
+from Metrics import annotate, item_label
+
+# Threads each tippecanoe job may use, passed as TIPPECANOE_MAX_THREADS. Fewer threads per
+# job let more files tile at once, which suits many small hourly files.
+tippecanoe_threads = 2
+# Share of the memory available when the scheduler starts that tippecanoe jobs may reserve
+memory_budget_fraction = 0.75
+# Starting estimate of a job's peak memory: a fixed base plus this many bytes per input
+# byte. Estimates are scaled up whenever a job is seen to use more than estimated.
+base_job_memory = 64 * 1024 * 1024
+memory_per_input_byte = 1.0
+# Lines of tippecanoe's stderr kept for the error of a failed job
+stderr_tail_lines = 20
+# Zoom and feature dropping options of a job, unless the caller passes its own
+tippecanoe_options = ['-zg', '-P', '--drop-fraction-as-needed']
+
+# Raised when tippecanoe exits with an error, carrying the end of its stderr
+class TippecanoeError(Exception):
+    pass
+
+# CPUs this process may run on
+def usable_cpus() -> int:
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+# Bytes of memory available to new processes, or None if the platform does not say
+def available_memory() -> (int | None):
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+# ru_maxrss of a finished process in bytes. Linux reports kilobytes, macOS reports bytes.
+def max_rss_bytes(rusage) -> int:
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss
+    return rusage.ru_maxrss * 1024
+
+# Runs tippecanoe jobs within the CPU and memory budget of the machine. At most
+# max_jobs = usable CPUs / threads per job run at once, and a job only starts when its
+# estimated peak memory fits in what the running jobs have not reserved, so a few huge
+# hours cannot push the box into swap while many small ones still run side by side.
+class TippecanoeScheduler:
+    def __init__(self, threads: int = None, memory_budget: int = None):
+        self.threads = threads or tippecanoe_threads
+        self.max_jobs = max(1, usable_cpus() // self.threads)
+        if memory_budget is None:
+            memory = available_memory()
+            memory_budget = int(memory * memory_budget_fraction) if memory else None
+        self.memory_budget = memory_budget
+        self.memory_scale = 1.0
+        self.condition = threading.Condition()
+        self.running_jobs = 0
+        self.reserved_memory = 0
+
+    # Estimated peak memory of tiling input_bytes of GeoJSON
+    def estimate_memory(self, input_bytes: int) -> int:
+        return int((base_job_memory + input_bytes * memory_per_input_byte) * self.memory_scale)
+
+    # Waits for a job slot and memory for a job of this estimate. A job that is larger than
+    # the whole budget still runs, but only on its own.
+    def reserve(self, estimate: int):
+        def fits():
+            if self.running_jobs >= self.max_jobs:
+                return False
+            return self.memory_budget is None or self.running_jobs == 0 or self.reserved_memory + estimate <= self.memory_budget
+        with self.condition:
+            self.condition.wait_for(fits)
+            self.running_jobs += 1
+            self.reserved_memory += estimate
+
+    def release(self, estimate: int):
+        with self.condition:
+            self.running_jobs -= 1
+            self.reserved_memory -= estimate
+            self.condition.notify_all()
+
+    # Returns paths ordered largest file first, so the longest jobs start early instead of
+    # finishing last on an otherwise idle machine.
+    def largest_first(self, paths: list) -> list:
+        return sorted(paths, key=os.path.getsize, reverse=True)
+
+    # Tiles geojson_file_path into mbtiles_file_path once the budget allows.
+    def run(self, geojson_file_path: str, mbtiles_file_path: str, layer: str = 'PM25', options: list = None):
+        input_bytes = os.path.getsize(geojson_file_path)
+        annotate(bytes_in=input_bytes)
+        self.run_job(input_bytes, geojson_file_path, lambda: run_tippecanoe(mbtiles_file_path, self.threads, layer, geojson_file_path, options=options))
+
+    # Wraps a pipeline stage function that pipes an item's features into tippecanoe, like
+    # pipe_features, so its job runs within the budget. Returns the output filename.
+    # Piped input has no size until it is written, so these jobs are estimated from the
+    # memory earlier jobs used.
+    def piped(self, function):
+        def run(item):
+            return self.run_job(0, item_label(item), lambda: function(item))['output']
+        return run
+
+    # Calls start_job, which runs a tippecanoe job and returns run_tippecanoe's result, once
+    # the budget has room for a job on input_bytes of GeoJSON. Annotates the job's exit
+    # code, wall and CPU seconds and peak RSS, and raises TippecanoeError with the end of
+    # tippecanoe's stderr if it fails. Returns the job.
+    def run_job(self, input_bytes: int, source: str, start_job) -> dict:
+        estimate = self.estimate_memory(input_bytes)
+        self.reserve(estimate)
+        try:
+            job = start_job()
+        finally:
+            self.release(estimate)
+        with self.condition:
+            self.memory_scale = max(self.memory_scale, job['peak_rss'] / (base_job_memory + input_bytes * memory_per_input_byte))
+        annotate(tippecanoe_exit_code=job['exit_code'], tippecanoe_seconds=job['seconds'], cpu_seconds=job['cpu_seconds'],
+                 peak_rss_mb=job['peak_rss'] / (1024 * 1024), tippecanoe_threads=self.threads)
+        if job['exit_code'] != 0:
+            stderr_tail = '\n'.join(job['stderr'].strip().splitlines()[-stderr_tail_lines:])
+            raise TippecanoeError(f"tippecanoe exited with {job['exit_code']} on {source}: {stderr_tail}")
+        return job
+
+# Runs one tippecanoe job without a shell and waits for it with wait4, which also returns
+# the resource usage of that one process. Input comes from geojson_file_path or, with
+# write_geojson set, from write_geojson(stream) writing to tippecanoe's stdin, where the
+# pipe's fixed buffer holds the writer back whenever tippecanoe falls behind. Temporary
+# files go next to the output rather than to /tmp, which is often a small tmpfs. options
+# replace tippecanoe_options. Returns the exit code, wall and CPU seconds, peak RSS in
+# bytes and stderr.
+def run_tippecanoe(mbtiles_file_path: str, threads: int = None, layer: str = 'PM25', geojson_file_path: str = None, write_geojson=None, options: list = None) -> dict:
+    temp_dir = os.path.dirname(os.path.abspath(mbtiles_file_path))
+    command = ['tippecanoe', '-o', mbtiles_file_path, '-l', layer, *(options or tippecanoe_options),
+               '--no-progress-indicator', '-t', temp_dir]
+    if geojson_file_path:
+        command.append(geojson_file_path)
+    env = dict(os.environ, TIPPECANOE_MAX_THREADS=str(threads or tippecanoe_threads))
+    start_time = time.perf_counter()
+    process = subprocess.Popen(command, stdin=subprocess.PIPE if write_geojson else subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+    if write_geojson:
+        # stderr is drained on its own thread, so a full stderr pipe cannot stall tippecanoe
+        # while it is being fed
+        stderr_chunks = []
+        stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+        stderr_reader.start()
+        stream = io.TextIOWrapper(process.stdin, encoding='utf-8')
+        try:
+            write_geojson(stream)
+            stream.close()
+        except BrokenPipeError:
+            # tippecanoe exited early; its exit code and stderr say why
+            with contextlib.suppress(BrokenPipeError):
+                stream.close()
+        except BaseException:
+            # A half-written input must not become a tileset
+            process.kill()
+            process.wait()
+            raise
+        stderr_reader.join()
+        stderr = stderr_chunks[0]
+    else:
+        # stderr closes when tippecanoe exits; reading it to the end first keeps a full pipe
+        # from stalling the job
+        stderr = process.stderr.read()
+    process.stderr.close()
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        'exit_code': process.returncode,
+        'seconds': time.perf_counter() - start_time,
+        'cpu_seconds': rusage.ru_utime + rusage.ru_stime,
+        'peak_rss': max_rss_bytes(rusage),
+        'stderr': stderr.decode(errors='replace'),
+    }
+
+# Child function, tiles chunks of feature columns into mbtiles_file_path by writing them to
+# tippecanoe's stdin, so no GeoJSON file is written. Returns run_tippecanoe's result with
+# the mbtiles filename under 'output', for TippecanoeScheduler.piped.
+def pipe_features(mbtiles_file_path: str, feature_chunks, formatter=format_features, layer: str = 'PM25', options: list = None) -> dict:
+    bytes_written = []
+    def write_geojson(stream):
+        bytes_written.append(write_features(stream, feature_chunks, formatter))
+    job = run_tippecanoe(mbtiles_file_path, layer=layer, write_geojson=write_geojson, options=options)
+    if bytes_written:
+        # The GeoJSON would have been written to disk and read back by tippecanoe
+        annotate(disk_bytes_avoided=2 * bytes_written[0])
+    if job['exit_code'] == 0:
+        annotate(bytes_out=os.path.getsize(mbtiles_file_path))
+    job['output'] = os.path.basename(mbtiles_file_path)
+    return job
+
+scheduler_lock = threading.Lock()
+shared_scheduler = None
+
+# Returns the scheduler shared by every tippecanoe job in this process.
+def get_scheduler() -> TippecanoeScheduler:
+    global shared_scheduler
+    with scheduler_lock:
+        if shared_scheduler is None:
+            shared_scheduler = TippecanoeScheduler()
+    return shared_scheduler
@@ -1,14 +1,28 @@
 import numpy as np
-import boto3
+import contextlib
+import hashlib
 import json
 import os
 import pwinput
+import re
 import requests
-import subprocess
+import resource
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
+from functools import partial
+from Downloader import DownloadError, download, remote_changed
+from ForecastCache import CacheManifest
+from GridFeatures import feature_row_blocks, format_band_polygons, format_feature_chunks, format_serialized_features, format_serialized_packed_features, grid_to_band_polygons, grid_to_features, iter_feature_chunks, iter_packed_feature_chunks, packed_attribute, packed_grid_to_features, write_geojson_seq, write_geojson_text
+from GridPyramid import PyramidChunks, chunk_options, file_options, pyramid_formatter
+from MBTiles import write_packed_vector_mbtiles, write_vector_mbtiles
+from MapboxUpload import get_upload_engine, get_upload_session, mapbox_credentials
+from Metrics import RunMetrics, annotate, item_label, peak_rss_mb
+from Pipeline import in_executor, map_in_executor, run_pipeline
+from RasterTiles import write_raster_mbtiles
+from RunJournal import RunJournal
+from Tippecanoe import get_scheduler, pipe_features
 
 base_url = 'https://home.chpc.utah.edu/~u0703457/people_share/CREATE_AQI/forecast_output/'
 folder_path = 'npyfiles/'
@@ -16,10 +30,66 @@ PM25_path = 'aq_PM25_array.npy'
 time_path = 'forecast_time.npy'
 lat_path = 'forecast_lat.npy'
 lon_path = 'forecast_lon.npy'
+# The downloaded forecast files. They stay in folder_path between runs while hours of
+# their forecast are not uploaded yet, so the next run only downloads those that changed.
+numpy_filenames = [PM25_path, time_path, lat_path, lon_path]
+# Number of worker processes for the CPU-bound conversion stage
+conversion_workers = os.cpu_count() or 1
+# Blocks of grid rows each hour's point features are split into for the GeoJSON stage.
+# The blocks convert on several workers at once, so a single large hour uses every core
+# instead of one. 1 converts each hour as one job. Applies to per-hour points without a
+# zoom pyramid.
+hour_blocks = conversion_workers
+# 'tippecanoe' tiles GeoJSON with tippecanoe, 'native' writes mbtiles straight from the grid,
+# 'raster' writes a PNG raster tileset of the grid with RasterTiles, one hour per tileset
+tile_engine = 'tippecanoe'
+# With the tippecanoe engine, write features straight into tippecanoe's stdin instead of
+# to a GeoJSON file for it to read, so only the mbtiles outputs touch scratch disk
+pipe_geojson = False
+# 'points' writes a feature per grid cell, 'bands' merges neighbouring cells of the same
+# GridFeatures.PM25_bands band into polygons. Bands apply to per-hour tippecanoe tilesets.
+feature_mode = 'points'
+# 'max' or 'mean' gives point features a zoom pyramid: every zoom below the full grid's
+# gets a grid coarsened by that block reduction instead of tippecanoe thinning the full
+# grid. None tiles every zoom from the full grid. Applies to the tippecanoe engine.
+pyramid_reduction = None
+# Per-file, per-stage metrics; upload_forecast replaces this with a run that writes trace_path
+# as JSON lines and prometheus_path for the node_exporter textfile collector
+run_metrics = RunMetrics('npyfiles')
+trace_path = 'npyfiles_trace.jsonl'
+prometheus_path = 'npyfiles_metrics.prom'
+# Threads handing files to the upload engine, each waiting for its upload job to finish
+upload_workers = 32
+# Forecast hours per tileset. Above 1, hours share one point layer with a PM25_NN
+# attribute per hour, and pack_index_path maps each hour to its tileset and attribute.
+# The index is written locally only; whatever serves the map has to publish it.
+hours_per_tileset = 1
+pack_index_path = 'npyfiles_pack_index.json'
+# Forecast hours of each tileset name in this run, filled in by forecast_packs
+packed_hours = {}
+# Prefix of this source's tileset names on Mapbox. Run on its own the script publishes
+# plain names; UploadDaemon sets different prefixes for sources sharing an account, so
+# neither replaces or sweeps away the other's tilesets.
+tileset_prefix = ''
+# Forecast hours in time index order, filled in by record_forecast_hours
+forecast_hours = []
+# Record of downloaded files and uploaded hours, kept between runs
+forecast_cache = CacheManifest('npyfiles_cache.json')
+# Forecast files opened by load_forecast_cube, and the identity of the PM25 file they were
+# opened from
+forecast_cube = None
+forecast_cube_identity = None
+# Crash-safe record of each item's finished stages, so an interrupted run resumes where it
+# stopped. upload_forecast opens it at journal_path.
+run_journal = None
+journal_path = 'npyfiles_journal.sqlite'
 
-# Function to clear old files in the ncfiles directory
-def clear_directory():
+# Function to clear old files in the ncfiles directory, except those in keep
+def clear_directory(keep: set = frozenset()):
     for file in os.listdir(folder_path):
+        # Keep partial downloads so they can resume
+        if file.endswith(('.part', '.part.json')) or file in keep:
+            continue
         delete_file_path = os.path.join(folder_path, file)
         os.remove(delete_file_path)
 
@@ -34,46 +104,178 @@ def verify_credentials(mapbox_username, mapbox_access_token):
         print("Invalid Mapbox username or token. Please try again.")
         return False
 
-def download_files():
-    futures = []
+# Downloads the forecast files. Returns False if the forecast is unchanged since every
+# one of its hours was last uploaded, True if it is on disk and needs processing.
+def download_files() -> bool:
+    futures = {}
     completed_jobs = 0
-    total_jobs = 4
+    total_jobs = len(numpy_filenames)
+    downloaded_filenames = []
+    # Ask for changes when the cached forecast is fully uploaded with this packing, or when
+    # an unfinished run left the file on disk
+    uploaded = forecast_uploaded()
     print(f"\r({completed_jobs}/{total_jobs}) .npy forecast files downloaded.", end="")
     
     with ThreadPoolExecutor(max_workers=4) as executor:  # Adjust max_workers as needed
-        futures.append(executor.submit(download_file, PM25_path))
-        futures.append(executor.submit(download_file, time_path))
-        futures.append(executor.submit(download_file, lat_path))
-        futures.append(executor.submit(download_file, lon_path))
+        for numpy_filename in numpy_filenames:
+            conditional = uploaded or os.path.exists(os.path.join(folder_path, numpy_filename))
+            futures[executor.submit(run_metrics.traced('downloaded', download_file), numpy_filename, conditional)] = numpy_filename
 
         for future in as_completed(futures):
+            if future.result():
+                downloaded_filenames.append(future.result())
             completed_jobs += 1
             print(f"\r({completed_jobs}/{total_jobs}) .npy files downloaded.", end="")
             sys.stdout.flush()
 
+    if uploaded and len(downloaded_filenames) == 0:
+        print("\nForecast unchanged since the last upload.")
+        return False
+    # Part of the forecast changed, fetch the unchanged files that are not on disk too
+    for numpy_filename in numpy_filenames:
+        if not os.path.exists(os.path.join(folder_path, numpy_filename)):
+            download_file(numpy_filename)
+    return True
+
 # Child function, downloads a single forecast file.
-def download_file(numpy_filename: str) -> (str | None):
+# With conditional set, returns None when the file is unchanged since the last download.
+def download_file(numpy_filename: str, conditional: bool = False) -> (str | None):
     file_url = base_url + numpy_filename
-    response = requests.get(file_url)
     numpy_file_path = os.path.join(folder_path, numpy_filename)
-    if response.status_code == 200:
-        with open(numpy_file_path, 'wb') as f:
-            f.write(response.content)
-        return numpy_filename
-    else:
+    validators = forecast_cache.file_validators(numpy_filename) if conditional else None
+    try:
+        download_info = download(file_url, numpy_file_path, validators)
+    except DownloadError as e:
+        annotate(error=f'DownloadError: {e}')
         print(f'Failed to download: {numpy_filename}')
         return None
+    if download_info is None:
+        return None
+    forecast_cache.record_file(numpy_filename, download_info)
+    return numpy_filename
+
+# Converts a forecast time like '2024-08-01 06:00:00 UTC' to the hour name '2024-08-01_06'
+def forecast_hour(forecast_time: str) -> str:
+    return datetime.strptime(forecast_time, '%Y-%m-%d %H:%M:%S %Z').strftime('%Y-%m-%d_%H')
+
+# Groups forecast hours in time order into tilesets of hours_per_tileset hours.
+# Returns {tileset name: hours}; with one hour per tileset the name is the hour.
+# The packs are recorded in packed_hours unless record is unset.
+def forecast_packs(hours: list, record: bool = True) -> dict:
+    packs = {}
+    for start in range(0, len(hours), hours_per_tileset):
+        pack = hours[start:start + hours_per_tileset]
+        packs[pack[0] if hours_per_tileset == 1 else f'{pack[0]}_{len(pack)}h'] = pack
+    if record:
+        packed_hours.update(packs)
+    return packs
+
+# Name on Mapbox of a tileset from forecast_packs, as forecast_cache records it
+def mapbox_tileset_name(tileset_name: str) -> str:
+    return tileset_prefix + tileset_name
+
+# Whether a tileset id on the account is one of this source's forecast tilesets
+def own_tileset(tileset_id: str, mapbox_username: str) -> bool:
+    name_pattern = rf'{re.escape(mapbox_username)}\.{re.escape(tileset_prefix)}\d{{4}}-\d{{2}}-\d{{2}}_\d{{2}}(_\d+h)?'
+    return re.fullmatch(name_pattern, tileset_id) is not None
+
+# Writes the index that tells map clients where each forecast hour lives:
+# {hour: {tileset, layer, attribute}}. It goes to pack_index_path on local disk and is not
+# uploaded to Mapbox, which only hosts tilesets.
+def write_pack_index(packs: dict, mapbox_username: str):
+    pack_index = {}
+    for tileset_name, hours in packs.items():
+        for position, hour in enumerate(hours):
+            attribute = 'PM25' if hours_per_tileset == 1 else packed_attribute(position)
+            pack_index[hour] = {'tileset': f'{mapbox_username}.{mapbox_tileset_name(tileset_name)}', 'layer': 'PM25', 'attribute': attribute}
+    with open(pack_index_path, 'w') as f:
+        json.dump(pack_index, f, indent=1)
+
+# Hashes every time slab of the forecast cube together with its grid, records the hashes,
+# and returns the forecast hours in time index order.
+def record_forecast_hours() -> list:
+    PM25, forecast_time, lat, lon = load_forecast_cube()
+    grid_hash = hashlib.sha256(np.ascontiguousarray(lat).tobytes() + np.ascontiguousarray(lon).tobytes()).digest()
+    hours = []
+    for time_index in range(forecast_time.size):
+        hour = forecast_hour(forecast_time[time_index])
+        slab_hash = hashlib.sha256(grid_hash)
+        slab_hash.update(np.ascontiguousarray(PM25[time_index]))
+        forecast_cache.record_hour(hour, slab_hash.hexdigest())
+        hours.append(hour)
+    forecast_cache.prune(hours)
+    forecast_hours[:] = hours
+    return hours
+
+# Version of a pipeline item's input for run_journal: the hashes of the forecast hours of
+# the tileset it becomes. Items are time indexes, or packs labelled by tileset name.
+def item_version(label: str) -> (str | None):
+    if label in packed_hours:
+        return forecast_cache.input_hash(packed_hours[label])
+    if label.isdigit() and int(label) < len(forecast_hours):
+        return forecast_cache.input_hash([forecast_hours[int(label)]])
+    return None
+
+# Records the forecast hours and returns the time indexes whose uploaded tileset is not
+# from identical data.
+def changed_time_indexes() -> list:
+    hours = record_forecast_hours()
+    forecast_packs(hours)
+    return [time_index for time_index, hour in enumerate(hours) if not forecast_cache.hour_uploaded(hour, mapbox_tileset_name(hour))]
+
+# Records the forecast hours and returns a (tileset name, time indexes) pack for every
+# tileset with an hour whose upload to that tileset is not from identical data.
+def changed_packs() -> list:
+    hours = record_forecast_hours()
+    packs = []
+    for tileset_name, pack in forecast_packs(hours).items():
+        if not all(forecast_cache.hour_uploaded(hour, mapbox_tileset_name(tileset_name)) for hour in pack):
+            packs.append((tileset_name, tuple(hours.index(hour) for hour in pack)))
+    return packs
+
+# Opens the forecast files once per process, and again once a new forecast is downloaded,
+# so long-lived workers never read a replaced file. The PM25 cube is memory-mapped so
+# workers read only the time slab they convert instead of loading the full cube.
+def load_forecast_cube() -> tuple:
+    global forecast_cube, forecast_cube_identity
+    PM25_stat = os.stat(folder_path + PM25_path)
+    identity = (PM25_stat.st_ino, PM25_stat.st_mtime_ns, PM25_stat.st_size)
+    if forecast_cube is None or forecast_cube_identity != identity:
+        forecast_cube_identity = identity
+        PM25 = np.load(folder_path + PM25_path, mmap_mode='r')
+        time = np.load(folder_path + time_path)
+        lat = np.load(folder_path + lat_path)
+        lon = np.load(folder_path + lon_path)
+        forecast_cube = (PM25, time, lat, lon)
+    return forecast_cube
+
+# Drops the cached forecast cube so its memory map is released.
+def close_forecast_cube():
+    global forecast_cube
+    forecast_cube = None
+
+# Closes the forecast cube and deletes the downloaded forecast files.
+def remove_forecast_files():
+    close_forecast_cube()
+    for numpy_filename in numpy_filenames:
+        os.remove(folder_path + numpy_filename)
 
 # Parent function, schedules individial nc to geojson jobs.
-def numpy_to_geojsons() -> list:
+def numpy_to_geojsons(max_workers: int = None, use_processes: bool = True) -> list:
     geojson_filenames = []
     futures = []
     completed_jobs = 0
-    total_jobs =  np.load(folder_path + time_path).size
+    PM25, forecast_time, lat, lon = load_forecast_cube()
+    total_jobs = forecast_time.size
     print(f"\r({completed_jobs}/{total_jobs}) .geojson files generated from .npy forecast file.", end="")
     
-    with ThreadPoolExecutor(max_workers=8) as executor:  # Adjust max_workers as needed
-        for i in range(np.load(folder_path + time_path).size):
+    geojson_bytes = 0
+    start_time = time.perf_counter()
+    # Worker processes sidestep the GIL. They are handed file names or time indexes
+    # only and open the data themselves, so no arrays are pickled between processes.
+    pool_executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool_executor(max_workers=max_workers or conversion_workers) as executor:
+        for i in range(total_jobs):
             futures.append(executor.submit(array_to_geojson, i))
 
         for future in as_completed(futures):
@@ -81,69 +283,117 @@ def numpy_to_geojsons() -> list:
                 geojson_filename = future.result()  # Retrieve the result from the future
                 if geojson_filename:
                     geojson_filenames.append(geojson_filename)
+                    geojson_bytes += os.path.getsize(os.path.join(folder_path, geojson_filename))
             except Exception as e:
                 print(f"Exception occurred: {e}")
             completed_jobs += 1
             print(f"\r({completed_jobs}/{total_jobs}) .geojson files generated from .npy forecast file.", end="")
             sys.stdout.flush()
-    os.remove(folder_path + PM25_path)
-    os.remove(folder_path + time_path)
-    os.remove(folder_path + lat_path)
-    os.remove(folder_path + lon_path)
+    geojson_mb = geojson_bytes / (1024 * 1024)
+    elapsed_time = time.perf_counter() - start_time
+    print(f"\nWrote {geojson_mb:.1f} MB of GeoJSON at {geojson_mb / elapsed_time:.1f} MB/s.")
+    # One time slab per worker should be resident, never the full cube
+    time_slab_mb = PM25[0].nbytes / (1024 * 1024) if total_jobs else 0
+    print(f"Peak RSS: {peak_rss_mb():.1f} MB main, {peak_rss_mb(resource.RUSAGE_CHILDREN):.1f} MB largest worker ({time_slab_mb:.1f} MB per time slab).")
+    del PM25
+    remove_forecast_files()
     return geojson_filenames
             
+# Returns the forecast hour of a time index, its feature chunks and their formatter for
+# feature_mode.
+def array_features(time_index: int) -> tuple:
+    PM25, time, lat, lon = load_forecast_cube()
+    hour = forecast_hour(time[time_index])
+    annotate(hour=hour, bytes_in=PM25[time_index].nbytes)
+    # PM25[time_index] is a zero-copy view of this hour's slab of the memory map
+    if feature_mode == 'bands':
+        return hour, [grid_to_band_polygons(lon, lat, PM25[time_index])], format_band_polygons
+    if pyramid_reduction:
+        return hour, PyramidChunks(lon, lat, PM25[time_index], pyramid_reduction, serialized=True), pyramid_formatter(format_serialized_features)
+    # Select every cell above the PM25 threshold, lat outer and lon inner
+    return hour, iter_feature_chunks(lon, lat, PM25[time_index], serialized=True), format_serialized_features
+
 # Child function, converts individual nc files to geojson.
 def array_to_geojson(time_index: int) -> str:
-    PM25 = np.load(folder_path + PM25_path)
-    time = np.load(folder_path + time_path)
-    lat = np.load(folder_path + lat_path)
-    lon = np.load(folder_path + lon_path)
-    formatted_date = datetime.strptime(time[time_index], '%Y-%m-%d %H:%M:%S %Z')
-    geojson_filename = formatted_date.strftime("%Y-%m-%d_%H.geojson")
-    geojson_file_path = os.path.join(folder_path, geojson_filename)
+    hour, feature_chunks, formatter = array_features(time_index)
+    geojson_filename = hour + '.geojson'
+    write_geojson_seq(os.path.join(folder_path, geojson_filename), feature_chunks, formatter)
+    return geojson_filename
 
-    features = []
-    feature_id = 1
-    # Iterate over the lon, lat, and PM25 arrays and combine them into features
-    for j in range(lat.size):
-        for k in range(lon.size):
-            pm25_value = float(PM25[time_index][j][k])
-            # Filter PM25 values between 8 and 200
-            if 5 <= pm25_value:
-                feature = {
-                    "type": "Feature",
-                    "properties": {
-                        "id": str(feature_id),
-                        "PM25": pm25_value
-                    },
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": [float(lon[k]), float(lat[j]), 0]
-                    }
-                }
-                features.append(feature)
-                feature_id += 1
-
-    # Start writing the JSON file
-    with open(geojson_file_path, 'w') as f:
-        f.write('{\n')
-        f.write('"type": "FeatureCollection",\n')
-        f.write('"crs": { "type": "name", "properties": { "name": "urn:ogc:def:crs:OGC:1.3:CRS84" } },\n')
-        f.write('"features": [\n')
-
-        # Write each feature in one line
-        for idx, feature in enumerate(features):
-            feature_str = json.dumps(feature)
-            if idx < len(features) - 1:
-                feature_str += ','
-            f.write(feature_str + '\n')
-
-        # End the JSON file
-        f.write(']\n')
-        f.write('}\n')
+# Child function, formats the point features of a (time index, rows) block of a forecast
+# hour, rows being a row block from feature_row_blocks. Only the block's rows of the hour
+# are read from the memory map.
+def array_block_to_geojson(block: tuple) -> str:
+    time_index, rows = block
+    PM25, time, lat, lon = load_forecast_cube()
+    return format_feature_chunks(iter_feature_chunks(lon, lat, PM25[time_index, rows[0]:rows[1]], serialized=True, rows=rows, slab=True), format_serialized_features)
 
+# Converts a forecast hour to geojson in hour_blocks row blocks that convert on
+# conversion_pool at once and are written in order as they finish.
+def array_blocks_to_geojson(conversion_pool, time_index: int) -> str:
+    PM25, time, lat, lon = load_forecast_cube()
+    hour = forecast_hour(time[time_index])
+    annotate(hour=hour, bytes_in=PM25[time_index].nbytes)
+    blocks = [(time_index, rows) for rows in feature_row_blocks(lon, lat, PM25[time_index], blocks=hour_blocks)]
+    geojson_filename = hour + '.geojson'
+    write_geojson_text(os.path.join(folder_path, geojson_filename), map_in_executor(conversion_pool, array_block_to_geojson, blocks))
     return geojson_filename
 
+# Child function, converts a forecast hour to mbtiles by piping its features into tippecanoe.
+def array_to_tippecanoe(time_index: int) -> dict:
+    hour, feature_chunks, formatter = array_features(time_index)
+    return pipe_features(os.path.join(folder_path, hour + '.mbtiles'), feature_chunks, formatter, options=chunk_options(feature_chunks))
+
+# Child function, converts a forecast hour straight to mbtiles without tippecanoe.
+def array_to_mbtiles(time_index: int) -> str:
+    PM25, time, lat, lon = load_forecast_cube()
+    mbtiles_filename = forecast_hour(time[time_index]) + '.mbtiles'
+    mbtiles_file_path = os.path.join(folder_path, mbtiles_filename)
+    annotate(hour=forecast_hour(time[time_index]), bytes_in=PM25[time_index].nbytes)
+    write_vector_mbtiles(mbtiles_file_path, grid_to_features(lon, lat, PM25[time_index]), lon, lat)
+    return mbtiles_filename
+
+# Child function, converts a forecast hour to raster mbtiles.
+def array_to_raster_mbtiles(time_index: int) -> str:
+    PM25, time, lat, lon = load_forecast_cube()
+    mbtiles_filename = forecast_hour(time[time_index]) + '.mbtiles'
+    annotate(hour=forecast_hour(time[time_index]), bytes_in=PM25[time_index].nbytes)
+    write_raster_mbtiles(os.path.join(folder_path, mbtiles_filename), lon, lat, PM25[time_index])
+    return mbtiles_filename
+
+# Returns the feature chunks of a pack's time indexes and their formatter.
+def packed_features(time_indexes: tuple) -> tuple:
+    PM25, time, lat, lon = load_forecast_cube()
+    annotate(bytes_in=sum(PM25[time_index].nbytes for time_index in time_indexes))
+    pm25_stack = [PM25[time_index] for time_index in time_indexes]
+    if pyramid_reduction:
+        return PyramidChunks(lon, lat, pm25_stack, pyramid_reduction, serialized=True, packed=True), pyramid_formatter(format_serialized_packed_features)
+    return iter_packed_feature_chunks(lon, lat, pm25_stack, serialized=True), format_serialized_packed_features
+
+# Child function, converts the time indexes of a pack to one geojson with an attribute per hour.
+def array_pack_to_geojson(pack: tuple) -> str:
+    tileset_name, time_indexes = pack
+    geojson_filename = tileset_name + '.geojson'
+    feature_chunks, formatter = packed_features(time_indexes)
+    write_geojson_seq(os.path.join(folder_path, geojson_filename), feature_chunks, formatter)
+    return geojson_filename
+
+# Child function, converts the time indexes of a pack to one mbtiles by piping their features into tippecanoe.
+def array_pack_to_tippecanoe(pack: tuple) -> dict:
+    tileset_name, time_indexes = pack
+    feature_chunks, formatter = packed_features(time_indexes)
+    return pipe_features(os.path.join(folder_path, tileset_name + '.mbtiles'), feature_chunks, formatter, options=chunk_options(feature_chunks))
+
+# Child function, converts the time indexes of a pack straight to one mbtiles without tippecanoe.
+def array_pack_to_mbtiles(pack: tuple) -> str:
+    tileset_name, time_indexes = pack
+    PM25, time, lat, lon = load_forecast_cube()
+    mbtiles_filename = tileset_name + '.mbtiles'
+    mbtiles_file_path = os.path.join(folder_path, mbtiles_filename)
+    annotate(bytes_in=sum(PM25[time_index].nbytes for time_index in time_indexes))
+    write_packed_vector_mbtiles(mbtiles_file_path, packed_grid_to_features(lon, lat, [PM25[time_index] for time_index in time_indexes]), lon, lat)
+    return mbtiles_filename
+
 # Parent function, schedules individial geojson to mbtile jobs.
 def geojsons_to_mbtiles(geojson_filenames: list) -> list:
     mbtile_filenames = []
@@ -152,9 +402,12 @@ def geojsons_to_mbtiles(geojson_filenames: list) -> list:
     total_jobs = len(geojson_filenames)
     print(f"\r({completed_jobs}/{total_jobs}) .geojson files converted to .mbtiles.", end="")
 
-    with ThreadPoolExecutor(max_workers=8) as executor:  # Adjust max_workers as needed
-        for geojson_filename in geojson_filenames:
-            futures.append(executor.submit(geojson_to_mbtiles, geojson_filename))
+    scheduler = get_scheduler()
+    geojson_file_paths = scheduler.largest_first([os.path.join(folder_path, geojson_filename) for geojson_filename in geojson_filenames])
+    tile = run_metrics.traced('tiled', geojson_to_mbtiles)
+    with ThreadPoolExecutor(max_workers=scheduler.max_jobs) as executor:
+        for geojson_file_path in geojson_file_paths:
+            futures.append(executor.submit(tile, os.path.basename(geojson_file_path)))
 
         for future in as_completed(futures):
             try:
@@ -174,21 +427,20 @@ def geojson_to_mbtiles(geojson_filename: str) -> str:
     geojson_file_path = os.path.join(folder_path, geojson_filename)
     mbtiles_filename = geojson_filename.replace('.geojson', '.mbtiles')
     mbtiles_file_path = os.path.join(folder_path, mbtiles_filename)
-    tippe_canoe_command = f"tippecanoe -o {mbtiles_file_path} -l PM25 -zg --drop-fraction-as-needed {geojson_file_path}"
-    subprocess.run(tippe_canoe_command, shell=True, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    get_scheduler().run(geojson_file_path, mbtiles_file_path, options=file_options(geojson_file_path))
+    annotate(bytes_out=os.path.getsize(mbtiles_file_path))
     os.remove(geojson_file_path)
     return mbtiles_filename
 
-# Parent function, schedules individial mbtile upload jobs.
+# Parent function, hands every mbtiles file to the upload engine and waits for them all.
 def upload_mbtiles_to_mapbox(mbtiles_filenames: list, mapbox_username: str, mapbox_access_token: str):
-    futures = []
     completed_jobs = 0
     total_jobs = len(mbtiles_filenames)
     print(f"\r({completed_jobs}/{total_jobs}) .mbtiles uploaded to MapBox.", end="")
 
-    with ThreadPoolExecutor(max_workers=8) as executor:  # Adjust max_workers as needed
-        for mbtiles_filename in mbtiles_filenames:
-            futures.append(executor.submit(upload_mbtile_file_to_mapbox, mbtiles_filename, mapbox_username, mapbox_access_token))
+    upload = run_metrics.traced('uploaded', upload_mbtile_file_to_mapbox)
+    with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+        futures = [executor.submit(upload, mbtiles_filename, mapbox_username, mapbox_access_token) for mbtiles_filename in mbtiles_filenames]
 
         for future in as_completed(futures):
             try:
@@ -198,93 +450,139 @@ def upload_mbtiles_to_mapbox(mbtiles_filenames: list, mapbox_username: str, mapb
             completed_jobs += 1
             print(f"\r({completed_jobs}/{total_jobs}) .mbtiles uploaded to MapBox.", end="")
             sys.stdout.flush()
+    print()
+
+# Child function, uploads an mbtiles file to Mapbox and waits until its tileset is processed.
+# Failed upload jobs are retried by the engine. Returns None if every attempt failed.
+def upload_mbtile_file_to_mapbox(mbtiles_filename: str, mapbox_username: str, mapbox_access_token: str) -> (str | None):
+    mbtiles_file_path = os.path.join(folder_path, mbtiles_filename)
+    tileset_name = mbtiles_filename.removesuffix('.mbtiles')
+    tileset_id = f"{mapbox_username}.{mapbox_tileset_name(tileset_name)}"
+    annotate(bytes_in=os.path.getsize(mbtiles_file_path))
+    try:
+        upload = get_upload_engine(mapbox_username, mapbox_access_token).submit(mbtiles_file_path, tileset_id, mapbox_tileset_name(tileset_name)).result()
+    except Exception as e:
+        annotate(upload_attempts=getattr(e, 'upload_attempts', 1), error=f'{type(e).__name__}: {e}')
+        print(f"\nError uploading {mbtiles_filename} to Mapbox: {e}")
+        return None
+    annotate(upload_attempts=upload['attempts'], staging_seconds=upload['staging_seconds'], processing_seconds=upload['processing_seconds'])
+    os.remove(mbtiles_file_path)
+    for hour in packed_hours.get(tileset_name, [tileset_name]):
+        forecast_cache.mark_uploaded(hour, mapbox_tileset_name(tileset_name))
+    return mbtiles_filename
 
-# Child function, uploads individual mbtile files to Mapbox.
-def upload_mbtile_file_to_mapbox(mbtiles_filename: str, mapbox_username: str, mapbox_access_token: str):
-    max_retries = 3
-    retry_delay = 5  # seconds
+# Pipeline stages that turn a forecast time index, or pack of them, into an .mbtiles file
+def conversion_stages(conversion_pool) -> list:
+    packed = hours_per_tileset > 1
+    if tile_engine == 'native':
+        return [('tiled', in_executor(conversion_pool, array_pack_to_mbtiles if packed else array_to_mbtiles), conversion_workers)]
+    if tile_engine == 'raster':
+        if packed:
+            raise ValueError("Raster tilesets hold one forecast hour each, set hours_per_tileset to 1")
+        return [('tiled', in_executor(conversion_pool, array_to_raster_mbtiles), conversion_workers)]
+    if pipe_geojson:
+        scheduler = get_scheduler()
+        return [('tiled', scheduler.piped(in_executor(conversion_pool, array_pack_to_tippecanoe if packed else array_to_tippecanoe)), scheduler.max_jobs)]
+    if hour_blocks > 1 and not packed and feature_mode == 'points' and not pyramid_reduction:
+        convert = partial(array_blocks_to_geojson, conversion_pool)
+    else:
+        convert = in_executor(conversion_pool, array_pack_to_geojson if packed else array_to_geojson)
+    return [
+        ('converted', convert, conversion_workers),
+        ('tiled', geojson_to_mbtiles, get_scheduler().max_jobs),
+    ]
 
-    for attempt in range(max_retries):
-        try:
-            mbtiles_file_path = os.path.join(folder_path, mbtiles_filename)
-            # Delete existing tileset if it exists
-            tileset_id = f"{mapbox_username}.{mbtiles_filename.removesuffix('.mbtiles')}"
-            mapbox_delete_tileset_url = f'https://api.mapbox.com/tilesets/v1/{tileset_id}?access_token={mapbox_access_token}'
-            requests.delete(mapbox_delete_tileset_url)
-
-            # Get Mapbox credentials
-            mapbox_credentials_url = f'https://api.mapbox.com/uploads/v1/{mapbox_username}/credentials?access_token={mapbox_access_token}'
-            mapbox_credentials_response = requests.post(mapbox_credentials_url)
-            mapbox_credentials = mapbox_credentials_response.json()
-
-            # Upload the tileset to AWS S3
-            s3 = boto3.client(
-                's3',
-                aws_access_key_id=mapbox_credentials['accessKeyId'],
-                aws_secret_access_key=mapbox_credentials['secretAccessKey'],
-                aws_session_token=mapbox_credentials['sessionToken'],
-            )
-            bucket = mapbox_credentials['bucket']
-            key = mapbox_credentials['key']
-            s3.upload_file(mbtiles_file_path, bucket, key)
-
-            # Upload S3 tileset to Mapbox Studio
-            upload_url = f'https://api.mapbox.com/uploads/v1/{mapbox_username}?access_token={mapbox_access_token}'
-            upload_payload = {
-                "url": f"https://{bucket}.s3.amazonaws.com/{key}",
-                "tileset": tileset_id,
-                "name": f"{mbtiles_filename.removesuffix('.mbtiles')}"
-            }
-            response = requests.post(upload_url, json=upload_payload)
-            upload_response = response.json()
-            if upload_response.get('error'):
-                print("Error uploading tileset to Mapbox.")
-            else:
-                os.remove(mbtiles_file_path)
-                break
-        except requests.exceptions.SSLError as e:
-            if attempt < max_retries - 1:
-                print(f"SSL error occurred, retrying in {retry_delay} seconds... (attempt {attempt + 1}/{max_retries})")
-                time.sleep(retry_delay)
-            else:
-                print(f"SSL error occurred, all retries failed. Error: {e}")
-        except Exception as e:
-            print(f"Exception occurred: {e}")
-            break
-
-# Deletes tilesets that are older than 5 hours
+# Lists .mbtiles files left behind by failed uploads
+def pending_mbtiles() -> list:
+    return [file for file in os.listdir(folder_path) if file.endswith('.mbtiles')]
+
+# Of the files pending_mbtiles listed before this run's pipeline, those still waiting to
+# upload that are not one of this run's tilesets, which the pipeline already uploaded and
+# retried itself
+def leftover_mbtiles(pending: list) -> list:
+    return [file for file in pending if file.removesuffix('.mbtiles') not in packed_hours and os.path.exists(os.path.join(folder_path, file))]
+
+# Deletes this source's forecast tilesets that are older than 5 hours and no longer current
 def clear_depreciated_tilesets(mapbox_username: str, mapbox_access_token: str):
     print("Removing depriciated tilesets.")
-    all_tilesets_url = f'https://api.mapbox.com/tilesets/v1/{mapbox_username}?access_token={mapbox_access_token}&limit=500&sortby=modified'
-    response = requests.get(all_tilesets_url)
-    tilesets = json.loads(response.text)
-    current_time = datetime.now(timezone.utc)
-    for i in range(len(tilesets) - 1, -1, -1):
-        index = int("{:03}".format(i))
-        tileset = tilesets[index]
-        date_modified = datetime.strptime(tileset['modified'], '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
-        time_threshold = current_time - timedelta(hours=5)
-        # Tileset is older than 5 hours, delete
-        if date_modified < time_threshold:
-            tileset_id = tilesets[index]['id']
-            mapbox_delete_tileset_url = f'https://api.mapbox.com/tilesets/v1/{tileset_id}?access_token={mapbox_access_token}'
-            requests.delete(mapbox_delete_tileset_url)
-        # Tileset is too new to delete
-        else:
-            break
+    inventory = get_upload_session(mapbox_username, mapbox_access_token).inventory
+    time_threshold = datetime.now(timezone.utc) - timedelta(hours=5)
+    # Skipped unchanged hours keep their older tilesets, which are still current
+    current_tileset_ids = {f"{mapbox_username}.{tileset_name}" for tileset_name in forecast_cache.uploaded_tilesets()}
+    with run_metrics.stage('cleaned', 'stale tilesets') as fields:
+        # Stale tilesets wait for the next run if Mapbox cannot be reached, as the uploads
+        # are done either way
+        try:
+            # Tilesets of other sources on the account are theirs to sweep
+            stale_tileset_ids = [tileset_id for tileset_id in inventory.stale_tileset_ids(current_tileset_ids, time_threshold.timestamp())
+                                 if own_tileset(tileset_id, mapbox_username)]
+            fields['deleted'] = len(stale_tileset_ids)
+            inventory.delete_tilesets(stale_tileset_ids)
+        except requests.exceptions.RequestException as e:
+            annotate(error=f'{type(e).__name__}: {e}')
+            print(f"Error removing depriciated tilesets: {e}")
     print("All files processed and uploaded.")
 
+# Whether a forecast file is new or changed since it was last downloaded, asked with a HEAD
+# request per file. Files that are not published count as unchanged.
+def forecast_changed() -> bool:
+    for numpy_filename in numpy_filenames:
+        try:
+            if remote_changed(base_url + numpy_filename, forecast_cache.file_validators(numpy_filename)):
+                return True
+        except DownloadError:
+            pass
+    return False
+
+# Whether every hour of the cached forecast is uploaded unchanged to its tileset.
+def forecast_uploaded() -> bool:
+    cached_packs = forecast_packs(forecast_cache.known_hours(), record=False)
+    return forecast_cache.all_hours_uploaded({hour: mapbox_tileset_name(tileset_name) for tileset_name, hours in cached_packs.items() for hour in hours})
+
+# Runs the upload once: the forecast is downloaded, every changed hour, or pack of hours,
+# is converted, tiled and uploaded, then stale tilesets are deleted. Conversion runs on
+# conversion_pool, or on a pool of its own if not given.
+def upload_forecast(mapbox_username: str, mapbox_access_token: str, conversion_pool=None):
+    global run_metrics, run_journal
+    run_metrics = RunMetrics('npyfiles', trace_path, prometheus_path)
+    # The upload session is kept between runs, but the account's tilesets may have changed
+    get_upload_session(mapbox_username, mapbox_access_token).inventory.reset()
+    packed_hours.clear()
+    # Files of stages an interrupted run finished are kept until the forecast says
+    # whether they are still current, and so is the forecast they were made from
+    run_journal = RunJournal(journal_path, folder_path, item_version)
+    keep = run_journal.artifact_files()
+    if not forecast_uploaded():
+        keep |= set(numpy_filenames)
+    clear_directory(keep=keep)
+    # Listed now, so this run's own failed uploads are not uploaded again after the pipeline
+    pending_mbtiles_before = pending_mbtiles()
+    if download_files():
+        pipeline_items = changed_packs() if hours_per_tileset > 1 else changed_time_indexes()
+        run_journal.prune([item_label(item) for item in pipeline_items])
+        write_pack_index(packed_hours, mapbox_username)
+        # Each changed forecast hour, or pack of hours, moves to its next stage as soon as it
+        # is ready, and hours an interrupted run left tiled or converted pick up from there
+        with contextlib.nullcontext(conversion_pool) if conversion_pool else ProcessPoolExecutor(max_workers=conversion_workers) as conversion_pool:
+            run_pipeline(pipeline_items, [
+                *conversion_stages(conversion_pool),
+                ('uploaded', partial(upload_mbtile_file_to_mapbox, mapbox_username=mapbox_username, mapbox_access_token=mapbox_access_token), upload_workers),
+            ], metrics=run_metrics, journal=run_journal)
+        if forecast_uploaded():
+            remove_forecast_files()
+        else:
+            close_forecast_cube()
+    # Files left over from an earlier run that stopped before uploading them
+    retry_mbtiles = leftover_mbtiles(pending_mbtiles_before)
+    if len(retry_mbtiles) > 0:
+        upload_mbtiles_to_mapbox(retry_mbtiles, mapbox_username, mapbox_access_token)
+    clear_depreciated_tilesets(mapbox_username, mapbox_access_token)
+    run_journal.close()
+    run_metrics.finish()
+
 if __name__ == '__main__':
-    mapbox_username = input('Input Mapbox username: ')
-    mapbox_access_token = pwinput.pwinput('Input Mapbox access token: ')
-    clear_directory()
+    # Credentials from the environment let cron run the script without a terminal
+    mapbox_username, mapbox_access_token = mapbox_credentials() or (input('Input Mapbox username: '), pwinput.pwinput('Input Mapbox access token: '))
     valid_auth = verify_credentials(mapbox_username, mapbox_access_token)
     if valid_auth:
-        download_files()
-        geojson_filenames = numpy_to_geojsons()
-        mbtile_filenames = geojsons_to_mbtiles(geojson_filenames)
-        upload_mbtiles_to_mapbox(mbtile_filenames, mapbox_username, mapbox_access_token)
-        while len(os.listdir(folder_path)) > 0:
-            upload_mbtiles_to_mapbox(os.listdir(folder_path), mapbox_username, mapbox_access_token)
-        clear_depreciated_tilesets(mapbox_username, mapbox_access_token)
-        
\ No newline at end of file
+        upload_forecast(mapbox_username, mapbox_access_token)
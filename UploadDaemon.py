@@ -0,0 +1,106 @@
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+import UploadCMAQ
+import UploadNetCDFs
+from MapboxUpload import mapbox_credentials
+
+# Seconds between checks for a new forecast
+poll_interval = 60
+# Seconds before a source whose last run left hours not uploaded runs again, unless its
+# forecast changes first
+retry_interval = 15 * 60
+# Forecast sources to watch: modules with forecast_changed, forecast_uploaded, upload_forecast
+# and tileset_prefix
+sources = [UploadNetCDFs, UploadCMAQ]
+# tileset_prefix each source gets when several are watched, as they upload to one account.
+# CMAQ keeps the plain names upload.sh publishes.
+source_tileset_prefixes = {'UploadNetCDFs': 'nc_', 'UploadCMAQ': ''}
+
+# Prints a timestamped line
+def log(message: str):
+    print(f"\n[{datetime.now():%Y-%m-%d %H:%M:%S}] {message}")
+    sys.stdout.flush()
+
+# Long-running service that uploads every source's forecast as soon as it is published.
+# Each source is polled with HEAD requests and runs as soon as its forecast changes, while
+# the other keeps polling or running alongside it. Sources share one process pool for
+# conversion, and with it the keep-alive download session, the Mapbox upload engine and
+# the tippecanoe scheduler, so a run starts warm instead of paying for a cold start.
+class ForecastWatcher:
+    def __init__(self, mapbox_username: str, mapbox_access_token: str, watched_sources: list = None):
+        self.mapbox_username = mapbox_username
+        self.mapbox_access_token = mapbox_access_token
+        self.sources = watched_sources or sources
+        if len(self.sources) > 1:
+            for source in self.sources:
+                source.tileset_prefix = source_tileset_prefixes.get(source.__name__, source.tileset_prefix)
+        tileset_prefixes = [source.tileset_prefix for source in self.sources]
+        if len(set(tileset_prefixes)) < len(tileset_prefixes):
+            raise ValueError("Sources uploading to one Mapbox account need different tileset_prefix values")
+        self.stop_event = threading.Event()
+        # monotonic start time of each source's last run
+        self.last_runs = {}
+
+    # Whether source should run: its forecast changed, or its last run left hours that are
+    # not uploaded and retry_interval has passed.
+    def due(self, source) -> bool:
+        if source.forecast_changed():
+            return True
+        last_run = self.last_runs.get(source.__name__)
+        return not source.forecast_uploaded() and (last_run is None or time.monotonic() - last_run >= retry_interval)
+
+    # Polls every poll_interval seconds until stop() is called, then waits for running uploads.
+    def run(self):
+        conversion_workers = max(source.conversion_workers for source in self.sources)
+        running = {}
+        with ProcessPoolExecutor(max_workers=conversion_workers) as conversion_pool, ThreadPoolExecutor(max_workers=len(self.sources)) as runners:
+            while not self.stop_event.is_set():
+                for source in self.sources:
+                    if source.__name__ in running:
+                        if not running[source.__name__].done():
+                            continue
+                        self.finished(source, running.pop(source.__name__))
+                    try:
+                        due = self.due(source)
+                    except Exception as e:
+                        log(f"Checking {source.__name__} for a new forecast failed: {e}")
+                        continue
+                    if due:
+                        log(f"New forecast for {source.__name__}, uploading.")
+                        self.last_runs[source.__name__] = time.monotonic()
+                        running[source.__name__] = runners.submit(source.upload_forecast, self.mapbox_username, self.mapbox_access_token, conversion_pool)
+                self.stop_event.wait(poll_interval)
+            if running:
+                log("Waiting for running uploads to finish.")
+            for source in self.sources:
+                if source.__name__ in running:
+                    self.finished(source, running.pop(source.__name__))
+
+    # Reports how a source's run ended
+    def finished(self, source, run):
+        try:
+            run.result()
+            log(f"{source.__name__} upload finished.")
+        except Exception as e:
+            log(f"{source.__name__} upload failed: {e}")
+
+    def stop(self, *_):
+        self.stop_event.set()
+
+if __name__ == '__main__':
+    credentials = mapbox_credentials()
+    if credentials is None:
+        print("Set MAPBOX_USERNAME and MAPBOX_ACCESS_TOKEN, or MAPBOX_CREDENTIALS_FILE, to run the upload service.")
+        sys.exit(1)
+    mapbox_username, mapbox_access_token = credentials
+    if not UploadNetCDFs.verify_credentials(mapbox_username, mapbox_access_token):
+        sys.exit(1)
+    watcher = ForecastWatcher(mapbox_username, mapbox_access_token)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    signal.signal(signal.SIGINT, watcher.stop)
+    log(f"Watching {', '.join(source.__name__ for source in watcher.sources)} every {poll_interval} seconds.")
+    watcher.run()
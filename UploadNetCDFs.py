@@ -1,24 +1,87 @@
-import boto3
+import contextlib
 import json
 import netCDF4 as nc
 import os
 import pwinput
+import re
 import requests
-import subprocess
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
+from functools import partial
+from multiprocessing import resource_tracker, shared_memory
+from Downloader import DownloadError, download, download_to_memory, remote_changed
+from ForecastCache import CacheManifest
+from GridFeatures import feature_row_blocks, format_band_polygons, format_feature_chunks, format_serialized_features, format_serialized_packed_features, grid_to_band_polygons, grid_to_features, iter_feature_chunks, iter_packed_feature_chunks, packed_attribute, packed_grid_to_features, write_geojson_seq, write_geojson_text
+from GridPyramid import PyramidChunks, chunk_options, file_options, pyramid_formatter
+from MBTiles import write_packed_vector_mbtiles, write_vector_mbtiles
+from MapboxUpload import get_upload_engine, get_upload_session, mapbox_credentials
+from Metrics import RunMetrics, annotate, item_label
+from Pipeline import in_executor, map_in_executor, run_pipeline
+from RasterTiles import write_raster_mbtiles
+from RunJournal import RunJournal
+from Tippecanoe import get_scheduler, pipe_features
 
 
 # URL of the website where files are located
 base_url = 'https://home.chpc.utah.edu/~u1260390/TA/latest_forecast/'
 # Path to the folder containing the input .nc files
 folder_path = 'ncfiles/'
-
-# Function to clear old files in the ncfiles directory
-def clear_directory():
+# Record of downloaded files and uploaded hours, kept between runs
+forecast_cache = CacheManifest('ncfiles_cache.json')
+# Number of worker processes for the CPU-bound conversion stage
+conversion_workers = os.cpu_count() or 1
+# Blocks of grid rows each hour's point features are split into for the GeoJSON stage.
+# The blocks convert on several workers at once, so a single large hour uses every core
+# instead of one. 1 converts each hour as one job. Applies to per-hour points without a
+# zoom pyramid.
+hour_blocks = conversion_workers
+# 'tippecanoe' tiles GeoJSON with tippecanoe, 'native' writes mbtiles straight from the grid,
+# 'raster' writes a PNG raster tileset of the grid with RasterTiles, one hour per tileset
+tile_engine = 'tippecanoe'
+# With the tippecanoe engine, write features straight into tippecanoe's stdin instead of
+# to a GeoJSON file for it to read, so only the mbtiles outputs touch scratch disk
+pipe_geojson = False
+# 'points' writes a feature per grid cell, 'bands' merges neighbouring cells of the same
+# GridFeatures.PM25_bands band into polygons. Bands apply to per-hour tippecanoe tilesets.
+feature_mode = 'points'
+# 'max' or 'mean' gives point features a zoom pyramid: every zoom below the full grid's
+# gets a grid coarsened by that block reduction instead of tippecanoe thinning the full
+# grid. None tiles every zoom from the full grid. Applies to the tippecanoe engine.
+pyramid_reduction = None
+# Per-file, per-stage metrics; upload_forecast replaces this with a run that writes trace_path
+# as JSON lines and prometheus_path for the node_exporter textfile collector
+run_metrics = RunMetrics('ncfiles')
+trace_path = 'ncfiles_trace.jsonl'
+prometheus_path = 'ncfiles_metrics.prom'
+# Threads handing files to the upload engine, each waiting for its upload job to finish
+upload_workers = 32
+# Forecast hours per tileset. Above 1, hours share one point layer with a PM25_NN
+# attribute per hour, and pack_index_path maps each hour to its tileset and attribute.
+# The index is written locally only; whatever serves the map has to publish it.
+hours_per_tileset = 1
+pack_index_path = 'ncfiles_pack_index.json'
+# Forecast hours of each tileset name in this run, filled in by forecast_packs
+packed_hours = {}
+# Prefix of this source's tileset names on Mapbox. Run on its own the script publishes
+# plain names; UploadDaemon sets different prefixes for sources sharing an account, so
+# neither replaces or sweeps away the other's tilesets.
+tileset_prefix = ''
+# Zero-disk mode: downloaded .nc files stay in memory and are opened from there by the
+# conversion stage, so nothing is written to folder_path before the tiles
+in_memory = False
+# Crash-safe record of each item's finished stages, so an interrupted run resumes where it
+# stopped. upload_forecast opens it at journal_path.
+run_journal = None
+journal_path = 'ncfiles_journal.sqlite'
+
+# Function to clear old files in the ncfiles directory, except those in keep
+def clear_directory(keep: set = frozenset()):
     for file in os.listdir(folder_path):
+        # Keep partial downloads so they can resume
+        if file.endswith(('.part', '.part.json')) or file in keep:
+            continue
         delete_file_path = os.path.join(folder_path, file)
         os.remove(delete_file_path)
 
@@ -33,35 +96,75 @@ def verify_credentials(mapbox_username, mapbox_access_token):
         print("Invalid Mapbox username or token. Please try again.")
         return False
         
-# Parent function, schedules individial download jobs.
-def download_files() -> list:
+# Lists the 120 hourly forecast files, from 06:00 today to 05:00 five days out.
+def forecast_filenames() -> list:
     dates = [datetime.now() + timedelta(days=i) for i in range(6)]
     first_date = dates[0]
     last_date = dates[-1]
+    net_cdf_filenames = []
+    for date in dates:
+        datestring = date.strftime('%Y-%m-%d')
+        if date == first_date:
+            hours = range(6, 24)
+        elif date == last_date:
+            hours = range(0, 6)
+        else:
+            hours = range(0, 24)
+        for i in hours:
+            time = str(i).zfill(2)
+            net_cdf_filenames.append(f'{datestring}_{time}.nc')
+    return net_cdf_filenames
+
+# Groups forecast hours in time order into tilesets of hours_per_tileset hours.
+# Returns {tileset name: hours}; with one hour per tileset the name is the hour.
+# The packs are recorded in packed_hours unless record is unset.
+def forecast_packs(hours: list, record: bool = True) -> dict:
+    packs = {}
+    for start in range(0, len(hours), hours_per_tileset):
+        pack = hours[start:start + hours_per_tileset]
+        packs[pack[0] if hours_per_tileset == 1 else f'{pack[0]}_{len(pack)}h'] = pack
+    if record:
+        packed_hours.update(packs)
+    return packs
+
+# Name on Mapbox of a tileset from forecast_packs, as forecast_cache records it
+def mapbox_tileset_name(tileset_name: str) -> str:
+    return tileset_prefix + tileset_name
+
+# Whether a tileset id on the account is one of this source's forecast tilesets
+def own_tileset(tileset_id: str, mapbox_username: str) -> bool:
+    name_pattern = rf'{re.escape(mapbox_username)}\.{re.escape(tileset_prefix)}\d{{4}}-\d{{2}}-\d{{2}}_\d{{2}}(_\d+h)?'
+    return re.fullmatch(name_pattern, tileset_id) is not None
+
+# Version of a pipeline item's input for run_journal: the hashes of the forecast hours of
+# the tileset it becomes. Items are .nc filenames, or packs labelled by tileset name.
+def item_version(label: str) -> (str | None):
+    return forecast_cache.input_hash(packed_hours.get(label.removesuffix('.nc'), []))
+
+# Writes the index that tells map clients where each forecast hour lives:
+# {hour: {tileset, layer, attribute}}. It goes to pack_index_path on local disk and is not
+# uploaded to Mapbox, which only hosts tilesets.
+def write_pack_index(packs: dict, mapbox_username: str):
+    pack_index = {}
+    for tileset_name, hours in packs.items():
+        for position, hour in enumerate(hours):
+            attribute = 'PM25' if hours_per_tileset == 1 else packed_attribute(position)
+            pack_index[hour] = {'tileset': f'{mapbox_username}.{mapbox_tileset_name(tileset_name)}', 'layer': 'PM25', 'attribute': attribute}
+    with open(pack_index_path, 'w') as f:
+        json.dump(pack_index, f, indent=1)
+
+# Parent function, schedules individial download jobs.
+def download_files() -> list:
     net_cdfs_filenames = []
     futures = []
     completed_jobs = 0
-    total_jobs = sum(24 if date not in (first_date, last_date) else (18 if date == first_date else 6) for date in dates)
+    forecast_net_cdf_filenames = forecast_filenames()
+    total_jobs = len(forecast_net_cdf_filenames)
     print(f"\r({completed_jobs}/{total_jobs}) .nc forecast files downloaded.", end="")
     
     with ThreadPoolExecutor(max_workers=8) as executor:  # Adjust max_workers as needed
-        for date in dates:
-            datestring = date.strftime('%Y-%m-%d')
-            if date == first_date:
-                for i in range(6, 24):
-                    time = str(i).zfill(2)
-                    net_cdf_filename = f'{datestring}_{time}.nc'
-                    futures.append(executor.submit(download_file, net_cdf_filename))
-            elif date == last_date:
-                for i in range(0, 6):
-                    time = str(i).zfill(2)
-                    net_cdf_filename = f'{datestring}_{time}.nc'
-                    futures.append(executor.submit(download_file, net_cdf_filename)) 
-            else:
-                for i in range(0, 24):
-                    time = str(i).zfill(2)
-                    net_cdf_filename = f'{datestring}_{time}.nc'
-                    futures.append(executor.submit(download_file, net_cdf_filename))
+        for net_cdf_filename in forecast_net_cdf_filenames:
+            futures.append(executor.submit(download_file, net_cdf_filename))
 
         for future in as_completed(futures):
             try:
@@ -77,27 +180,88 @@ def download_files() -> list:
     return net_cdfs_filenames
 
 # Child function, downloads a single forecast file.
-def download_file(net_cdf_filename: str) -> (str | None):
+# Returns the filename, or in zero-disk mode a (filename, bytes) pair, of the downloaded
+# file. Returns None when the file failed to download or its hour is already uploaded
+# unchanged to tileset, a name from forecast_packs (the hour's own if not given). With
+# skip_unchanged unset the file is always downloaded and kept. With resume set, or unless
+# given when run_journal holds progress on the file, an unchanged file is not downloaded
+# again and its filename is returned for the journal to resume the item from its later
+# stages.
+def download_file(net_cdf_filename: str, tileset: str = None, skip_unchanged: bool = True, resume: bool = None) -> (str | tuple | None):
     file_url = base_url + net_cdf_filename
-    response = requests.get(file_url)
     net_cdf_file_path = os.path.join(folder_path, net_cdf_filename)
-    if response.status_code == 200:
-        with open(net_cdf_file_path, 'wb') as f:
-            f.write(response.content)
-        return net_cdf_filename
-    else:
+    hour = net_cdf_filename.removesuffix('.nc')
+    tileset = mapbox_tileset_name(tileset or hour)
+    skip_unchanged = skip_unchanged and forecast_cache.hour_uploaded(hour, tileset)
+    if resume is None:
+        resume = run_journal is not None and run_journal.has_progress(net_cdf_filename)
+    # Only ask for changes when the hour's current tileset, or the journaled progress,
+    # came from the cached version
+    validators = forecast_cache.file_validators(net_cdf_filename) if skip_unchanged or resume else None
+    try:
+        if in_memory:
+            downloaded = download_to_memory(file_url, validators)
+            net_cdf_bytes, download_info = downloaded if downloaded else (None, None)
+        else:
+            download_info = download(file_url, net_cdf_file_path, validators)
+    except DownloadError as e:
+        annotate(error=f'DownloadError: {e}')
         print(f'Failed to download: {net_cdf_filename}')
         return None
+    if download_info is None:
+        return net_cdf_filename if resume and not skip_unchanged else None
+    forecast_cache.record_file(net_cdf_filename, download_info)
+    forecast_cache.record_hour(hour, download_info['sha256'])
+    # New headers but identical content, the uploaded tileset is still current
+    if skip_unchanged and forecast_cache.hour_uploaded(hour, tileset):
+        if not in_memory:
+            os.remove(net_cdf_file_path)
+        return None
+    if in_memory:
+        annotate(disk_bytes_avoided=len(net_cdf_bytes))
+        return net_cdf_filename, net_cdf_bytes
+    return net_cdf_filename
+
+# Downloads the forecast files of a (tileset name, .nc filenames) pack and returns the pack
+# with download_file's result for each file. Returns None when a file failed to download
+# or every hour is already uploaded unchanged to the tileset.
+def download_pack(pack: tuple) -> (tuple | None):
+    tileset_name, net_cdf_filenames = pack
+    resume = run_journal is not None and run_journal.has_progress(tileset_name)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        downloaded_files = list(executor.map(partial(download_file, tileset=tileset_name, resume=resume), net_cdf_filenames))
+    if not any(downloaded_files):
+        return None
+    # A changed hour also outdates the journaled progress, so unchanged hours that were not
+    # downloaded again are fetched for the rebuild
+    rebuilt = resume and not run_journal.has_progress(tileset_name)
+    # Part of the pack changed, so the whole tileset is rebuilt from every hour
+    for index, net_cdf_filename in enumerate(net_cdf_filenames):
+        if downloaded_files[index] is None or (rebuilt and not downloaded_file_available(downloaded_files[index])):
+            downloaded_files[index] = download_file(net_cdf_filename, skip_unchanged=False)
+            if downloaded_files[index] is None:
+                return None
+    return tileset_name, tuple(downloaded_files)
+
+# Whether a download_file result holds the file, in memory or in folder_path
+def downloaded_file_available(net_cdf_file) -> bool:
+    return isinstance(net_cdf_file, tuple) or os.path.exists(os.path.join(folder_path, net_cdf_file))
 
 # Parent function, schedules individial nc to geojson jobs.
-def ncs_to_geojsons(net_cdf_filenames: list) -> list:
+def ncs_to_geojsons(net_cdf_filenames: list, max_workers: int = None, use_processes: bool = True) -> list:
     geojson_filenames = []
     futures = []
     completed_jobs = 0
     total_jobs = len(net_cdf_filenames)
     print(f"\r({completed_jobs}/{total_jobs}) .nc files converted to .geojson.", end="")
     
-    with ThreadPoolExecutor(max_workers=8) as executor:  # Adjust max_workers as needed
+    geojson_bytes = 0
+    start_time = time.perf_counter()
+    # Worker processes sidestep the GIL. They are handed file names and open the data
+    # themselves, so no arrays are pickled between processes. In zero-disk mode they are
+    # handed the file's bytes instead, which are no larger than the file.
+    pool_executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool_executor(max_workers=max_workers or conversion_workers) as executor:
         for net_cdf_filename in net_cdf_filenames:
             futures.append(executor.submit(nc_to_geojson, net_cdf_filename))
 
@@ -106,73 +270,190 @@ def ncs_to_geojsons(net_cdf_filenames: list) -> list:
                 geojson_filename = future.result()  # Retrieve the result from the future
                 if geojson_filename:
                     geojson_filenames.append(geojson_filename)
+                    geojson_bytes += os.path.getsize(os.path.join(folder_path, geojson_filename))
             except Exception as e:
                 print(f"Exception occurred: {e}")
             completed_jobs += 1
             print(f"\r({completed_jobs}/{total_jobs}) .nc files converted to .geojson.", end="")
             sys.stdout.flush()
+    geojson_mb = geojson_bytes / (1024 * 1024)
+    elapsed_time = time.perf_counter() - start_time
+    print(f"\nWrote {geojson_mb:.1f} MB of GeoJSON at {geojson_mb / elapsed_time:.1f} MB/s.")
 
     return geojson_filenames
             
-# Child function, converts individual nc files to geojson.
-def nc_to_geojson(net_cdf_filename: str) -> str:
-    geojson_filename = net_cdf_filename.replace('.nc', '.geojson')
-    net_cdf_file_path = os.path.join(folder_path, net_cdf_filename)
-    geojson_file_path = os.path.join(folder_path, geojson_filename)
+# Opens a file from download_file: a filename in folder_path, or a (filename, bytes) pair
+# opened straight from memory. Returns the filename and the open dataset.
+def open_nc(net_cdf_file) -> tuple:
+    if isinstance(net_cdf_file, tuple):
+        net_cdf_filename, net_cdf_bytes = net_cdf_file
+        return net_cdf_filename, nc.Dataset(net_cdf_filename, 'r', memory=net_cdf_bytes)
+    return net_cdf_file, nc.Dataset(os.path.join(folder_path, net_cdf_file), 'r')
+
+# Records the bytes read from a file from download_file once it is converted, and deletes
+# it if it is in folder_path.
+def finish_nc(net_cdf_file):
+    if isinstance(net_cdf_file, tuple):
+        annotate(bytes_in=len(net_cdf_file[1]), disk_bytes_avoided=len(net_cdf_file[1]))
+    else:
+        net_cdf_file_path = os.path.join(folder_path, net_cdf_file)
+        annotate(bytes_in=os.path.getsize(net_cdf_file_path))
+        os.remove(net_cdf_file_path)
 
-    # Open the NetCDF file
-    ds = nc.Dataset(net_cdf_file_path, 'r')
+# Reads the lon, lat and PM25 grids of a file from download_file, which is deleted once
+# read if it is in folder_path. Returns the filename and the grids.
+def read_nc(net_cdf_file) -> tuple:
+    net_cdf_filename, ds = open_nc(net_cdf_file)
 
     # Extract longitude, latitude, and PM25 data
     lon = ds.variables['lon'][:]
     lat = ds.variables['lat'][:]
     pm25 = ds.variables['PM25'][:]
-
-    features = []
-    feature_id = 1
-    # Iterate over the lon, lat, and PM25 arrays and combine them into features
-    for i in range(len(lon)):
-        for j in range(len(lat)):
-            pm25_value = float(pm25[j, i])
-            # Filter PM25 values between 8 and 200
-            if 5 <= pm25_value:
-                feature = {
-                    "type": "Feature",
-                    "properties": {
-                        "id": str(feature_id),
-                        "PM25": pm25_value
-                    },
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": [float(lon[i]), float(lat[j]), 0]
-                    }
-                }
-                features.append(feature)
-                feature_id += 1
-
-    # Start writing the JSON file
-    with open(geojson_file_path, 'w') as f:
-        f.write('{\n')
-        f.write('"type": "FeatureCollection",\n')
-        f.write('"crs": { "type": "name", "properties": { "name": "urn:ogc:def:crs:OGC:1.3:CRS84" } },\n')
-        f.write('"features": [\n')
-
-        # Write each feature in one line
-        for idx, feature in enumerate(features):
-            feature_str = json.dumps(feature)
-            if idx < len(features) - 1:
-                feature_str += ','
-            f.write(feature_str + '\n')
-
-        # End the JSON file
-        f.write(']\n')
-        f.write('}\n')
-
-    # Close the NetCDF file
     ds.close()
-    os.remove(net_cdf_file_path)
+
+    finish_nc(net_cdf_file)
+    return net_cdf_filename, lon, lat, pm25
+
+# Reads a downloaded nc file and returns its filename, feature chunks and their formatter
+# for feature_mode.
+def nc_features(net_cdf_file) -> tuple:
+    net_cdf_filename, lon, lat, pm25 = read_nc(net_cdf_file)
+    if feature_mode == 'bands':
+        return net_cdf_filename, [grid_to_band_polygons(lon, lat, pm25)], format_band_polygons
+    if pyramid_reduction:
+        return net_cdf_filename, PyramidChunks(lon, lat, pm25, pyramid_reduction, lon_major=True, serialized=True), pyramid_formatter(format_serialized_features)
+    # Select every cell above the PM25 threshold, lon outer and lat inner
+    return net_cdf_filename, iter_feature_chunks(lon, lat, pm25, lon_major=True, serialized=True), format_serialized_features
+
+# Child function, converts individual nc files to geojson.
+def nc_to_geojson(net_cdf_file) -> str:
+    net_cdf_filename, feature_chunks, formatter = nc_features(net_cdf_file)
+    geojson_filename = net_cdf_filename.replace('.nc', '.geojson')
+    write_geojson_seq(os.path.join(folder_path, geojson_filename), feature_chunks, formatter)
     return geojson_filename
 
+# Opens the file a row block reads: a filename in folder_path, or a (filename, shared
+# memory name, size) triple for a file nc_blocks_to_geojson holds in shared memory.
+@contextlib.contextmanager
+def open_block_nc(block_file):
+    if not isinstance(block_file, tuple):
+        with nc.Dataset(os.path.join(folder_path, block_file), 'r') as ds:
+            yield ds
+        return
+    net_cdf_filename, shared_memory_name, size = block_file
+    shared_bytes = shared_memory.SharedMemory(shared_memory_name)
+    # Attaching registers the memory for cleanup as if this process owned it, but
+    # nc_blocks_to_geojson unlinks it once every block is done
+    resource_tracker.unregister(shared_bytes._name, 'shared_memory')
+    view = shared_bytes.buf[:size]
+    try:
+        with nc.Dataset(net_cdf_filename, 'r', memory=view) as ds:
+            yield ds
+    finally:
+        # The shared memory can only be closed once nothing points into it
+        view.release()
+        shared_bytes.close()
+
+# Child function, splits the point features of a block file into up to blocks row blocks
+# with feature_row_blocks. The file is left for the blocks to read.
+def nc_row_blocks(block_file, blocks: int) -> list:
+    with open_block_nc(block_file) as ds:
+        lon = ds.variables['lon'][:]
+        lat = ds.variables['lat'][:]
+        pm25 = ds.variables['PM25'][:]
+    return feature_row_blocks(lon, lat, pm25, lon_major=True, blocks=blocks)
+
+# Child function, formats the point features of a (block file, rows) block, rows being a
+# row block from nc_row_blocks. Features run lon first, so the block's rows are lon
+# columns, and only those columns of PM25 are read.
+def nc_block_to_geojson(block: tuple) -> str:
+    block_file, rows = block
+    with open_block_nc(block_file) as ds:
+        lon = ds.variables['lon'][:]
+        lat = ds.variables['lat'][:]
+        pm25 = ds.variables['PM25'][:, rows[0]:rows[1]]
+    return format_feature_chunks(iter_feature_chunks(lon, lat, pm25, lon_major=True, serialized=True, rows=rows, slab=True), format_serialized_features)
+
+# Converts an nc file to geojson in hour_blocks row blocks that convert on conversion_pool
+# at once and are written in order as they finish. Workers are handed the file's name and
+# read their own part of it, so neither arrays nor the file are pickled. In zero-disk mode
+# the file is copied into shared memory once for the blocks to open.
+def nc_blocks_to_geojson(conversion_pool, net_cdf_file) -> str:
+    shared_bytes = None
+    if isinstance(net_cdf_file, tuple):
+        net_cdf_filename, net_cdf_bytes = net_cdf_file
+        shared_bytes = shared_memory.SharedMemory(create=True, size=len(net_cdf_bytes))
+        shared_bytes.buf[:len(net_cdf_bytes)] = net_cdf_bytes
+        block_file = (net_cdf_filename, shared_bytes.name, len(net_cdf_bytes))
+    else:
+        net_cdf_filename = block_file = net_cdf_file
+    try:
+        blocks = in_executor(conversion_pool, partial(nc_row_blocks, blocks=hour_blocks))(block_file)
+        geojson_filename = net_cdf_filename.replace('.nc', '.geojson')
+        write_geojson_text(os.path.join(folder_path, geojson_filename), map_in_executor(conversion_pool, nc_block_to_geojson, [(block_file, rows) for rows in blocks]))
+    finally:
+        if shared_bytes is not None:
+            shared_bytes.close()
+            shared_bytes.unlink()
+    finish_nc(net_cdf_file)
+    return geojson_filename
+
+# Child function, converts individual nc files to mbtiles by piping their features into tippecanoe.
+def nc_to_tippecanoe(net_cdf_file) -> dict:
+    net_cdf_filename, feature_chunks, formatter = nc_features(net_cdf_file)
+    return pipe_features(os.path.join(folder_path, net_cdf_filename.replace('.nc', '.mbtiles')), feature_chunks, formatter, options=chunk_options(feature_chunks))
+
+# Child function, converts individual nc files straight to mbtiles without tippecanoe.
+def nc_to_mbtiles(net_cdf_file) -> str:
+    net_cdf_filename, lon, lat, pm25 = read_nc(net_cdf_file)
+    mbtiles_filename = net_cdf_filename.replace('.nc', '.mbtiles')
+    mbtiles_file_path = os.path.join(folder_path, mbtiles_filename)
+    write_vector_mbtiles(mbtiles_file_path, grid_to_features(lon, lat, pm25, lon_major=True), lon, lat)
+    return mbtiles_filename
+
+# Child function, converts individual nc files to raster mbtiles.
+def nc_to_raster_mbtiles(net_cdf_file) -> str:
+    net_cdf_filename, lon, lat, pm25 = read_nc(net_cdf_file)
+    mbtiles_filename = net_cdf_filename.replace('.nc', '.mbtiles')
+    write_raster_mbtiles(os.path.join(folder_path, mbtiles_filename), lon, lat, pm25)
+    return mbtiles_filename
+
+# Reads the lon, lat and hourly PM25 grids of a pack's downloaded .nc files.
+def read_nc_pack(net_cdf_files: tuple) -> tuple:
+    pm25_stack = []
+    for net_cdf_file in net_cdf_files:
+        _, lon, lat, pm25 = read_nc(net_cdf_file)
+        pm25_stack.append(pm25)
+    return lon, lat, pm25_stack
+
+# Returns the feature chunks of a pack's hourly grids and their formatter.
+def packed_features(lon, lat, pm25_stack) -> tuple:
+    if pyramid_reduction:
+        return PyramidChunks(lon, lat, pm25_stack, pyramid_reduction, lon_major=True, serialized=True, packed=True), pyramid_formatter(format_serialized_packed_features)
+    return iter_packed_feature_chunks(lon, lat, pm25_stack, lon_major=True, serialized=True), format_serialized_packed_features
+
+# Child function, converts the .nc files of a pack to one geojson with an attribute per hour.
+def nc_pack_to_geojson(pack: tuple) -> str:
+    tileset_name, net_cdf_files = pack
+    geojson_filename = tileset_name + '.geojson'
+    feature_chunks, formatter = packed_features(*read_nc_pack(net_cdf_files))
+    write_geojson_seq(os.path.join(folder_path, geojson_filename), feature_chunks, formatter)
+    return geojson_filename
+
+# Child function, converts the .nc files of a pack to one mbtiles by piping their features into tippecanoe.
+def nc_pack_to_tippecanoe(pack: tuple) -> dict:
+    tileset_name, net_cdf_files = pack
+    feature_chunks, formatter = packed_features(*read_nc_pack(net_cdf_files))
+    return pipe_features(os.path.join(folder_path, tileset_name + '.mbtiles'), feature_chunks, formatter, options=chunk_options(feature_chunks))
+
+# Child function, converts the .nc files of a pack straight to one mbtiles without tippecanoe.
+def nc_pack_to_mbtiles(pack: tuple) -> str:
+    tileset_name, net_cdf_files = pack
+    mbtiles_filename = tileset_name + '.mbtiles'
+    lon, lat, pm25_stack = read_nc_pack(net_cdf_files)
+    write_packed_vector_mbtiles(os.path.join(folder_path, mbtiles_filename), packed_grid_to_features(lon, lat, pm25_stack, lon_major=True), lon, lat)
+    return mbtiles_filename
+
 # Parent function, schedules individial geojson to mbtile jobs.
 def geojsons_to_mbtiles(geojson_filenames: list) -> list:
     mbtile_filenames = []
@@ -181,9 +462,12 @@ def geojsons_to_mbtiles(geojson_filenames: list) -> list:
     total_jobs = len(geojson_filenames)
     print(f"\r({completed_jobs}/{total_jobs}) .geojson files converted to .mbtiles.", end="")
 
-    with ThreadPoolExecutor(max_workers=8) as executor:  # Adjust max_workers as needed
-        for geojson_filename in geojson_filenames:
-            futures.append(executor.submit(geojson_to_mbtiles, geojson_filename))
+    scheduler = get_scheduler()
+    geojson_file_paths = scheduler.largest_first([os.path.join(folder_path, geojson_filename) for geojson_filename in geojson_filenames])
+    tile = run_metrics.traced('tiled', geojson_to_mbtiles)
+    with ThreadPoolExecutor(max_workers=scheduler.max_jobs) as executor:
+        for geojson_file_path in geojson_file_paths:
+            futures.append(executor.submit(tile, os.path.basename(geojson_file_path)))
 
         for future in as_completed(futures):
             try:
@@ -203,21 +487,20 @@ def geojson_to_mbtiles(geojson_filename: str) -> str:
     geojson_file_path = os.path.join(folder_path, geojson_filename)
     mbtiles_filename = geojson_filename.replace('.geojson', '.mbtiles')
     mbtiles_file_path = os.path.join(folder_path, mbtiles_filename)
-    tippe_canoe_command = f"tippecanoe -o {mbtiles_file_path} -l PM25 -zg --drop-fraction-as-needed {geojson_file_path}"
-    subprocess.run(tippe_canoe_command, shell=True, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    get_scheduler().run(geojson_file_path, mbtiles_file_path, options=file_options(geojson_file_path))
+    annotate(bytes_out=os.path.getsize(mbtiles_file_path))
     os.remove(geojson_file_path)
     return mbtiles_filename
 
-# Parent function, schedules individial mbtile upload jobs.
+# Parent function, hands every mbtiles file to the upload engine and waits for them all.
 def upload_mbtiles_to_mapbox(mbtiles_filenames: list, mapbox_username: str, mapbox_access_token: str):
-    futures = []
     completed_jobs = 0
     total_jobs = len(mbtiles_filenames)
     print(f"\r({completed_jobs}/{total_jobs}) .mbtiles uploaded to MapBox.", end="")
 
-    with ThreadPoolExecutor(max_workers=8) as executor:  # Adjust max_workers as needed
-        for mbtiles_filename in mbtiles_filenames:
-            futures.append(executor.submit(upload_mbtile_file_to_mapbox, mbtiles_filename, mapbox_username, mapbox_access_token))
+    upload = run_metrics.traced('uploaded', upload_mbtile_file_to_mapbox)
+    with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+        futures = [executor.submit(upload, mbtiles_filename, mapbox_username, mapbox_access_token) for mbtiles_filename in mbtiles_filenames]
 
         for future in as_completed(futures):
             try:
@@ -227,93 +510,140 @@ def upload_mbtiles_to_mapbox(mbtiles_filenames: list, mapbox_username: str, mapb
             completed_jobs += 1
             print(f"\r({completed_jobs}/{total_jobs}) .mbtiles uploaded to MapBox.", end="")
             sys.stdout.flush()
+    print()
 
-# Child function, uploads individual mbtile files to Mapbox.
-def upload_mbtile_file_to_mapbox(mbtiles_filename: str, mapbox_username: str, mapbox_access_token: str):
-    max_retries = 3
-    retry_delay = 5  # seconds
+# Child function, uploads an mbtiles file to Mapbox and waits until its tileset is processed.
+# Failed upload jobs are retried by the engine. Returns None if every attempt failed.
+def upload_mbtile_file_to_mapbox(mbtiles_filename: str, mapbox_username: str, mapbox_access_token: str) -> (str | None):
+    mbtiles_file_path = os.path.join(folder_path, mbtiles_filename)
+    tileset_name = mbtiles_filename.removesuffix('.mbtiles')
+    tileset_id = f"{mapbox_username}.{mapbox_tileset_name(tileset_name)}"
+    annotate(bytes_in=os.path.getsize(mbtiles_file_path))
+    try:
+        upload = get_upload_engine(mapbox_username, mapbox_access_token).submit(mbtiles_file_path, tileset_id, mapbox_tileset_name(tileset_name)).result()
+    except Exception as e:
+        annotate(upload_attempts=getattr(e, 'upload_attempts', 1), error=f'{type(e).__name__}: {e}')
+        print(f"\nError uploading {mbtiles_filename} to Mapbox: {e}")
+        return None
+    annotate(upload_attempts=upload['attempts'], staging_seconds=upload['staging_seconds'], processing_seconds=upload['processing_seconds'])
+    os.remove(mbtiles_file_path)
+    for hour in packed_hours.get(tileset_name, [tileset_name]):
+        forecast_cache.mark_uploaded(hour, mapbox_tileset_name(tileset_name))
+    return mbtiles_filename
 
-    for attempt in range(max_retries):
-        try:
-            mbtiles_file_path = os.path.join(folder_path, mbtiles_filename)
-            # Delete existing tileset if it exists
-            tileset_id = f"{mapbox_username}.{mbtiles_filename.removesuffix('.mbtiles')}"
-            mapbox_delete_tileset_url = f'https://api.mapbox.com/tilesets/v1/{tileset_id}?access_token={mapbox_access_token}'
-            requests.delete(mapbox_delete_tileset_url)
-
-            # Get Mapbox credentials
-            mapbox_credentials_url = f'https://api.mapbox.com/uploads/v1/{mapbox_username}/credentials?access_token={mapbox_access_token}'
-            mapbox_credentials_response = requests.post(mapbox_credentials_url)
-            mapbox_credentials = mapbox_credentials_response.json()
-
-            # Upload the tileset to AWS S3
-            s3 = boto3.client(
-                's3',
-                aws_access_key_id=mapbox_credentials['accessKeyId'],
-                aws_secret_access_key=mapbox_credentials['secretAccessKey'],
-                aws_session_token=mapbox_credentials['sessionToken'],
-            )
-            bucket = mapbox_credentials['bucket']
-            key = mapbox_credentials['key']
-            s3.upload_file(mbtiles_file_path, bucket, key)
-
-            # Upload S3 tileset to Mapbox Studio
-            upload_url = f'https://api.mapbox.com/uploads/v1/{mapbox_username}?access_token={mapbox_access_token}'
-            upload_payload = {
-                "url": f"https://{bucket}.s3.amazonaws.com/{key}",
-                "tileset": tileset_id,
-                "name": f"{mbtiles_filename.removesuffix('.mbtiles')}"
-            }
-            response = requests.post(upload_url, json=upload_payload)
-            upload_response = response.json()
-            if upload_response.get('error'):
-                print("Error uploading tileset to Mapbox.")
-            else:
-                os.remove(mbtiles_file_path)
-                break
-        except requests.exceptions.SSLError as e:
-            if attempt < max_retries - 1:
-                print(f"SSL error occurred, retrying in {retry_delay} seconds... (attempt {attempt + 1}/{max_retries})")
-                time.sleep(retry_delay)
-            else:
-                print(f"SSL error occurred, all retries failed. Error: {e}")
-        except Exception as e:
-            print(f"Exception occurred: {e}")
-            break
-
-# Deletes tilesets that are older than 5 hours
+# Pipeline stages that turn a downloaded .nc file, or pack of them, into an .mbtiles file
+def conversion_stages(conversion_pool) -> list:
+    packed = hours_per_tileset > 1
+    if tile_engine == 'native':
+        return [('tiled', in_executor(conversion_pool, nc_pack_to_mbtiles if packed else nc_to_mbtiles), conversion_workers)]
+    if tile_engine == 'raster':
+        if packed:
+            raise ValueError("Raster tilesets hold one forecast hour each, set hours_per_tileset to 1")
+        return [('tiled', in_executor(conversion_pool, nc_to_raster_mbtiles), conversion_workers)]
+    if pipe_geojson:
+        scheduler = get_scheduler()
+        return [('tiled', scheduler.piped(in_executor(conversion_pool, nc_pack_to_tippecanoe if packed else nc_to_tippecanoe)), scheduler.max_jobs)]
+    if hour_blocks > 1 and not packed and feature_mode == 'points' and not pyramid_reduction:
+        convert = partial(nc_blocks_to_geojson, conversion_pool)
+    else:
+        convert = in_executor(conversion_pool, nc_pack_to_geojson if packed else nc_to_geojson)
+    return [
+        ('converted', convert, conversion_workers),
+        ('tiled', geojson_to_mbtiles, get_scheduler().max_jobs),
+    ]
+
+# Lists .mbtiles files left behind by failed uploads
+def pending_mbtiles() -> list:
+    return [file for file in os.listdir(folder_path) if file.endswith('.mbtiles')]
+
+# Of the files pending_mbtiles listed before this run's pipeline, those still waiting to
+# upload that are not one of this run's tilesets, which the pipeline already uploaded and
+# retried itself
+def leftover_mbtiles(pending: list) -> list:
+    return [file for file in pending if file.removesuffix('.mbtiles') not in packed_hours and os.path.exists(os.path.join(folder_path, file))]
+
+# Deletes this source's forecast tilesets that are older than 5 hours and no longer current
 def clear_depreciated_tilesets(mapbox_username: str, mapbox_access_token: str):
     print("Removing depriciated tilesets.")
-    all_tilesets_url = f'https://api.mapbox.com/tilesets/v1/{mapbox_username}?access_token={mapbox_access_token}&limit=500&sortby=modified'
-    response = requests.get(all_tilesets_url)
-    tilesets = json.loads(response.text)
-    current_time = datetime.now(timezone.utc)
-    for i in range(len(tilesets) - 1, -1, -1):
-        index = int("{:03}".format(i))
-        tileset = tilesets[index]
-        date_modified = datetime.strptime(tileset['modified'], '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
-        time_threshold = current_time - timedelta(hours=5)
-        # Tileset is older than 5 hours, delete
-        if date_modified < time_threshold:
-            tileset_id = tilesets[index]['id']
-            mapbox_delete_tileset_url = f'https://api.mapbox.com/tilesets/v1/{tileset_id}?access_token={mapbox_access_token}'
-            requests.delete(mapbox_delete_tileset_url)
-        # Tileset is too new to delete
-        else:
-            break
+    inventory = get_upload_session(mapbox_username, mapbox_access_token).inventory
+    time_threshold = datetime.now(timezone.utc) - timedelta(hours=5)
+    # Skipped unchanged hours keep their older tilesets, which are still current
+    current_tileset_ids = {f"{mapbox_username}.{tileset_name}" for tileset_name in forecast_cache.uploaded_tilesets()}
+    with run_metrics.stage('cleaned', 'stale tilesets') as fields:
+        # Stale tilesets wait for the next run if Mapbox cannot be reached, as the uploads
+        # are done either way
+        try:
+            # Tilesets of other sources on the account are theirs to sweep
+            stale_tileset_ids = [tileset_id for tileset_id in inventory.stale_tileset_ids(current_tileset_ids, time_threshold.timestamp())
+                                 if own_tileset(tileset_id, mapbox_username)]
+            fields['deleted'] = len(stale_tileset_ids)
+            inventory.delete_tilesets(stale_tileset_ids)
+        except requests.exceptions.RequestException as e:
+            annotate(error=f'{type(e).__name__}: {e}')
+            print(f"Error removing depriciated tilesets: {e}")
     print("All files processed and uploaded.")
 
+# Whether a forecast file is new or changed since it was last downloaded, asked with a HEAD
+# request per file. Files that are not published yet count as unchanged.
+def forecast_changed() -> bool:
+    def file_changed(net_cdf_filename: str) -> bool:
+        try:
+            return remote_changed(base_url + net_cdf_filename, forecast_cache.file_validators(net_cdf_filename))
+        except DownloadError:
+            return False
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return any(executor.map(file_changed, forecast_filenames()))
+
+# Whether every hour of the current forecast is uploaded unchanged to its tileset.
+def forecast_uploaded() -> bool:
+    hours = [net_cdf_filename.removesuffix('.nc') for net_cdf_filename in forecast_filenames()]
+    packs = forecast_packs(hours, record=False)
+    return all(forecast_cache.hour_uploaded(hour, mapbox_tileset_name(tileset_name)) for tileset_name, pack in packs.items() for hour in pack)
+
+# Runs the upload once: every forecast hour, or pack of hours, is downloaded, converted,
+# tiled and uploaded, then stale tilesets are deleted. Conversion runs on conversion_pool,
+# or on a pool of its own if not given.
+def upload_forecast(mapbox_username: str, mapbox_access_token: str, conversion_pool=None):
+    global run_metrics, run_journal
+    run_metrics = RunMetrics('ncfiles', trace_path, prometheus_path)
+    # The upload session is kept between runs, but the account's tilesets may have changed
+    get_upload_session(mapbox_username, mapbox_access_token).inventory.reset()
+    net_cdf_filenames = forecast_filenames()
+    hours = [net_cdf_filename.removesuffix('.nc') for net_cdf_filename in net_cdf_filenames]
+    forecast_cache.prune(hours, net_cdf_filenames)
+    packed_hours.clear()
+    packs = forecast_packs(hours)
+    write_pack_index(packs, mapbox_username)
+    if hours_per_tileset > 1:
+        pipeline_items = [(tileset_name, tuple(f'{hour}.nc' for hour in pack)) for tileset_name, pack in packs.items()]
+    else:
+        pipeline_items = net_cdf_filenames
+    # Files of stages an interrupted run finished from current input are kept to resume from
+    run_journal = RunJournal(journal_path, folder_path, item_version, recheck_stages=('downloaded',))
+    run_journal.prune([item_label(item) for item in pipeline_items])
+    clear_directory(keep=run_journal.artifact_files())
+    # Listed now, so this run's own failed uploads are not uploaded again after the pipeline
+    pending_mbtiles_before = pending_mbtiles()
+    # Each forecast hour, or pack of hours, moves to its next stage as soon as it is ready.
+    # Hours whose input is unchanged since their last upload stop after the download stage,
+    # and hours an interrupted run left tiled or converted pick up from there.
+    with contextlib.nullcontext(conversion_pool) if conversion_pool else ProcessPoolExecutor(max_workers=conversion_workers) as conversion_pool:
+        run_pipeline(pipeline_items, [
+            ('downloaded', download_pack if hours_per_tileset > 1 else download_file, 8),
+            *conversion_stages(conversion_pool),
+            ('uploaded', partial(upload_mbtile_file_to_mapbox, mapbox_username=mapbox_username, mapbox_access_token=mapbox_access_token), upload_workers),
+        ], metrics=run_metrics, journal=run_journal)
+    # Files left over from an earlier run that stopped before uploading them
+    retry_mbtiles = leftover_mbtiles(pending_mbtiles_before)
+    if len(retry_mbtiles) > 0:
+        upload_mbtiles_to_mapbox(retry_mbtiles, mapbox_username, mapbox_access_token)
+    clear_depreciated_tilesets(mapbox_username, mapbox_access_token)
+    run_journal.close()
+    run_metrics.finish()
+
 if __name__ == '__main__':
-    mapbox_username = input('Input Mapbox username: ')
-    mapbox_access_token = pwinput.pwinput('Input Mapbox access token: ')
-    clear_directory()
+    # Credentials from the environment let cron run the script without a terminal
+    mapbox_username, mapbox_access_token = mapbox_credentials() or (input('Input Mapbox username: '), pwinput.pwinput('Input Mapbox access token: '))
     valid_auth = verify_credentials(mapbox_username, mapbox_access_token)
     if valid_auth:
-        net_cdf_filenames = download_files()
-        geojson_filenames = ncs_to_geojsons(net_cdf_filenames)
-        mbtile_filenames = geojsons_to_mbtiles(geojson_filenames)
-        upload_mbtiles_to_mapbox(mbtile_filenames, mapbox_username, mapbox_access_token)
-        while len(os.listdir(folder_path)) > 0:
-            upload_mbtiles_to_mapbox(os.listdir(folder_path), mapbox_username, mapbox_access_token)
-        clear_depreciated_tilesets(mapbox_username, mapbox_access_token)
-    
\ No newline at end of file
+        upload_forecast(mapbox_username, mapbox_access_token)
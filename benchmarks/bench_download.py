@@ -0,0 +1,52 @@
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Downloader
+from local_services import serve_directory
+
+# Benchmarks Downloader against a local HTTP server: many small hourly files through the
+# shared connection pool, then one large file split into Range requests.
+# Usage: python benchmarks/bench_download.py [small_files] [small_mb] [large_mb]
+def main():
+    small_files = int(sys.argv[1]) if len(sys.argv) > 1 else 120
+    small_mb = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+    large_mb = float(sys.argv[3]) if len(sys.argv) > 3 else 256
+
+    with tempfile.TemporaryDirectory() as source_dir, tempfile.TemporaryDirectory() as target_dir:
+        small_filenames = [f'{i:03}.nc' for i in range(small_files)]
+        for filename in small_filenames:
+            with open(os.path.join(source_dir, filename), 'wb') as f:
+                f.write(os.urandom(int(small_mb * 1024 * 1024)))
+        with open(os.path.join(source_dir, 'large.npy'), 'wb') as f:
+            for _ in range(int(large_mb)):
+                f.write(os.urandom(1024 * 1024))
+
+        server, url = serve_directory(source_dir)
+        try:
+            tracemalloc.start()
+            start_time = time.perf_counter()
+            for filename in small_filenames:
+                Downloader.download(url + filename, os.path.join(target_dir, filename))
+            report('small files', small_files * small_mb, time.perf_counter() - start_time)
+
+            tracemalloc.reset_peak()
+            start_time = time.perf_counter()
+            Downloader.download(url + 'large.npy', os.path.join(target_dir, 'large.npy'))
+            report('large file', int(large_mb), time.perf_counter() - start_time)
+        finally:
+            server.shutdown()
+
+def report(name: str, total_mb: float, elapsed_time: float):
+    peak_python_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+    print(f"{name}: {total_mb:.0f} MB in {elapsed_time:.2f} s, {total_mb / elapsed_time:.1f} MB/s, "
+          f"peak Python allocations {peak_python_mb:.1f} MB, peak RSS {peak_rss_mb:.1f} MB")
+
+if __name__ == '__main__':
+    main()
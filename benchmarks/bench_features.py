@@ -0,0 +1,63 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from GridFeatures import format_band_polygons, format_serialized_features, grid_to_band_polygons, iter_feature_chunks, write_geojson_seq
+from GridPyramid import PyramidChunks, file_options, pyramid_formatter
+from Tippecanoe import tippecanoe_options
+from synthetic_forecasts import smoke_plumes
+
+# Compares point features, formatted in full or from the grid's serialized geometries, a
+# max zoom pyramid of them and band polygons on one synthetic smoke hour, reporting feature count, GeoJSON size and the
+# time of each stage side by side. The tippecanoe stage is
+# skipped if it is not installed.
+# Usage: python benchmarks/bench_features.py [lat_cells] [lon_cells] [plumes]
+def main():
+    lat_cells = int(sys.argv[1]) if len(sys.argv) > 1 else 265
+    lon_cells = int(sys.argv[2]) if len(sys.argv) > 2 else 442
+    plumes = int(sys.argv[3]) if len(sys.argv) > 3 else 12
+    lon = np.linspace(-125, -66, lon_cells)
+    lat = np.linspace(24, 50, lat_cells)
+    pm25 = smoke_plumes(lon, lat, plumes)
+
+    modes = {
+        'points': lambda path: write_geojson_seq(path, iter_feature_chunks(lon, lat, pm25)),
+        # The first hour on a grid also builds its cache, as every run does
+        'serialized': lambda path: write_geojson_seq(path, iter_feature_chunks(lon, lat, pm25, serialized=True), format_serialized_features),
+        'pyramid': lambda path: write_geojson_seq(path, PyramidChunks(lon, lat, pm25, 'max', serialized=True), pyramid_formatter(format_serialized_features)),
+        'bands': lambda path: write_geojson_seq(path, [grid_to_band_polygons(lon, lat, pm25)], format_band_polygons),
+    }
+    tippecanoe = shutil.which('tippecanoe') is not None
+    print(f"{lat_cells}x{lon_cells} grid, {plumes} plumes")
+    print(f"{'mode':<10} {'features':>9} {'GeoJSON MB':>11} {'convert s':>10} {'tile s':>8} {'mbtiles MB':>11} {'total s':>8}")
+    with tempfile.TemporaryDirectory() as folder:
+        for mode, write in modes.items():
+            geojson_file_path = os.path.join(folder, f'{mode}.geojson')
+            mbtiles_file_path = os.path.join(folder, f'{mode}.mbtiles')
+            start_time = time.perf_counter()
+            write(geojson_file_path)
+            convert_time = time.perf_counter() - start_time
+            with open(geojson_file_path) as f:
+                feature_count = sum(1 for _ in f)
+            geojson_mb = os.path.getsize(geojson_file_path) / (1024 * 1024)
+            if tippecanoe:
+                start_time = time.perf_counter()
+                options = file_options(geojson_file_path) or tippecanoe_options
+                subprocess.run(['tippecanoe', '-o', mbtiles_file_path, '-l', 'PM25', *options, geojson_file_path],
+                               check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                tile_time = time.perf_counter() - start_time
+                tile_columns = f"{tile_time:>8.2f} {os.path.getsize(mbtiles_file_path) / (1024 * 1024):>11.1f}"
+            else:
+                tile_time = 0
+                tile_columns = f"{'-':>8} {'-':>11}"
+            print(f"{mode:<10} {feature_count:>9} {geojson_mb:>11.1f} {convert_time:>10.2f} {tile_columns} {convert_time + tile_time:>8.2f}")
+    if not tippecanoe:
+        print("tippecanoe: not installed, tile stage skipped")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import filecmp
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import UploadCMAQ
+from synthetic_forecasts import write_cmaq_cube
+
+# Times the conversion of one synthetic CMAQ hour to GeoJSON as a single job and split
+# into 2, 4, ... up to cpu_count row blocks converting at once, and checks every split
+# writes the same file as the single job.
+# Usage: python benchmarks/bench_hour_blocks.py [lat_cells] [lon_cells] [coverage]
+def main():
+    lat_cells = int(sys.argv[1]) if len(sys.argv) > 1 else 1060
+    lon_cells = int(sys.argv[2]) if len(sys.argv) > 2 else 1768
+    coverage = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    start_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        # folder_path is relative, so the workers find the cube too
+        os.chdir(folder)
+        try:
+            os.makedirs(UploadCMAQ.folder_path)
+            write_cmaq_cube(UploadCMAQ.folder_path, 1, lat_cells, lon_cells, coverage)
+            time_blocks(lat_cells, lon_cells)
+        finally:
+            os.chdir(start_directory)
+
+def time_blocks(lat_cells: int, lon_cells: int):
+    cpus = os.cpu_count() or 1
+    block_counts = sorted({1, cpus} | {2 ** power for power in range(1, cpus.bit_length()) if 2 ** power < cpus})
+    print(f"{lat_cells}x{lon_cells} grid, {cpus} cpus")
+    with ProcessPoolExecutor(max_workers=cpus) as conversion_pool:
+        # Warm the workers' forecast cube and grid cache, as every hour after a run's first finds them
+        list(conversion_pool.map(UploadCMAQ.array_to_geojson, [0] * cpus))
+        for blocks in block_counts:
+            UploadCMAQ.hour_blocks = blocks
+            start_time = time.perf_counter()
+            if blocks == 1:
+                geojson_filename = conversion_pool.submit(UploadCMAQ.array_to_geojson, 0).result()
+            else:
+                geojson_filename = UploadCMAQ.array_blocks_to_geojson(conversion_pool, 0)
+            elapsed_time = time.perf_counter() - start_time
+            geojson_file_path = os.path.join(UploadCMAQ.folder_path, geojson_filename)
+            if blocks == 1:
+                os.replace(geojson_file_path, 'single.geojson')
+                detail = ''
+            elif not filecmp.cmp(geojson_file_path, 'single.geojson', shallow=False):
+                detail = ', output differs from 1 block'
+            else:
+                detail = ', same output'
+            print(f"{blocks:>3} blocks: {elapsed_time:.2f} s{detail}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+benchmarks_path = os.path.dirname(os.path.abspath(__file__))
+repository_path = os.path.dirname(benchmarks_path)
+sys.path.insert(0, repository_path)
+import MapboxUpload
+import UploadCMAQ
+import UploadNetCDFs
+from ForecastCache import CacheManifest
+from Metrics import peak_rss_mb
+from local_services import MockMapbox, serve_directory
+from synthetic_forecasts import write_cmaq_cube, write_nc_hours
+
+# Runs both upload scripts stage by stage on synthetic forecasts, with a local HTTP server
+# standing in for base_url and the Mapbox/S3 stand-ins for uploads. Every stage reports
+# time, items, throughput, output bytes and peak RSS, and the results are written as JSON
+# with the commit they were measured on, so runs can be compared across commits. Without
+# tippecanoe, mbtiles come from the native engine instead and the tippecanoe stage is
+# marked skipped. Each source then runs upload_forecast end to end on the same forecast,
+# so the streaming pipeline is compared with the batch stages it replaced.
+# Usage: python benchmarks/bench_pipeline.py [hours] [lat_cells] [lon_cells] [coverage] [results_json]
+def main():
+    hours = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+    lat_cells = int(sys.argv[2]) if len(sys.argv) > 2 else 265
+    lon_cells = int(sys.argv[3]) if len(sys.argv) > 3 else 442
+    coverage = float(sys.argv[4]) if len(sys.argv) > 4 else 0.2
+    results_path = os.path.abspath(sys.argv[5] if len(sys.argv) > 5 else 'bench_pipeline.json')
+
+    results = {
+        'commit': git_commit(),
+        'time': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'tippecanoe': shutil.which('tippecanoe') is not None,
+        'config': {'hours': hours, 'lat_cells': lat_cells, 'lon_cells': lon_cells, 'coverage': coverage},
+        'sources': {},
+    }
+    start_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        source_directory = os.path.join(folder, 'source')
+        os.makedirs(source_directory)
+        server, url = serve_directory(source_directory)
+        mock = MockMapbox()
+        MapboxUpload.mapbox_api_url = mock.url
+        MapboxUpload.s3_endpoint_url = mock.url
+        try:
+            # The scripts work relative to the current directory
+            os.chdir(folder)
+            net_cdf_filenames = UploadNetCDFs.forecast_filenames()[:hours]
+            write_nc_hours(source_directory, net_cdf_filenames, lat_cells, lon_cells, coverage)
+            write_cmaq_cube(source_directory, hours, lat_cells, lon_cells, coverage)
+            results['sources']['netcdf'] = bench_netcdf(url, mock, net_cdf_filenames)
+            results['sources']['cmaq'] = bench_cmaq(url, mock)
+        finally:
+            os.chdir(start_directory)
+            server.shutdown()
+            mock.shutdown()
+
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=1)
+    for source, stages in results['sources'].items():
+        for stage, result in stages.items():
+            if result.get('skipped'):
+                print(f"{source} {stage}: skipped ({result['skipped']})")
+            else:
+                print(f"{source} {stage}: {result['seconds']:.2f} s, {result['items']} items ({result['items_per_second']:.1f}/s), "
+                      f"{result['output_mb']:.1f} MB out ({result['mb_per_second']:.1f} MB/s), peak RSS {result['peak_rss_mb']:.0f} MB, "
+                      f"largest worker {result['peak_child_rss_mb']:.0f} MB")
+            if 'batch_seconds' in result:
+                # The ratio depends on the cores the stages overlap on, so it is only quoted with them
+                print(f"{source} {stage}: {result['batch_seconds'] / result['seconds']:.2f}x the speed of the batch stages ({result['batch_seconds']:.2f} s) "
+                      f"on {results['cpus']} CPUs, {'tippecanoe' if results['tippecanoe'] else 'native'} tiles")
+    print(f"Results written to {results_path}")
+
+def bench_netcdf(url: str, mock: MockMapbox, net_cdf_filenames: list) -> dict:
+    UploadNetCDFs.base_url = url
+    os.makedirs(UploadNetCDFs.folder_path, exist_ok=True)
+    # Only the generated hours are served
+    UploadNetCDFs.forecast_filenames = lambda: net_cdf_filenames
+    stages = {}
+    downloaded = run_stage(stages, 'download_files', UploadNetCDFs.download_files, UploadNetCDFs.folder_path, '.nc')
+    # nc_to_geojson deletes its input, so keep a copy for the native engine
+    snapshot = os.path.join(UploadNetCDFs.folder_path, 'snapshot')
+    os.makedirs(snapshot)
+    for net_cdf_filename in downloaded:
+        shutil.copy(os.path.join(UploadNetCDFs.folder_path, net_cdf_filename), snapshot)
+    geojson_filenames = run_stage(stages, 'ncs_to_geojsons', lambda: UploadNetCDFs.ncs_to_geojsons(downloaded), UploadNetCDFs.folder_path, '.geojson')
+    if shutil.which('tippecanoe'):
+        mbtiles_filenames = run_stage(stages, 'geojsons_to_mbtiles', lambda: UploadNetCDFs.geojsons_to_mbtiles(geojson_filenames), UploadNetCDFs.folder_path, '.mbtiles')
+    else:
+        stages['geojsons_to_mbtiles'] = {'skipped': 'tippecanoe not installed'}
+        for geojson_filename in geojson_filenames:
+            os.remove(os.path.join(UploadNetCDFs.folder_path, geojson_filename))
+        for net_cdf_filename in downloaded:
+            shutil.move(os.path.join(snapshot, net_cdf_filename), UploadNetCDFs.folder_path)
+        mbtiles_filenames = run_stage(stages, 'native_mbtiles', lambda: convert_in_processes(UploadNetCDFs.nc_to_mbtiles, downloaded), UploadNetCDFs.folder_path, '.mbtiles')
+    shutil.rmtree(snapshot)
+    run_upload_stage(stages, mock, UploadNetCDFs, mbtiles_filenames)
+    tiling_stages = ['ncs_to_geojsons', 'geojsons_to_mbtiles'] if shutil.which('tippecanoe') else ['native_mbtiles']
+    run_forecast_stage(stages, mock, UploadNetCDFs, ['download_files', *tiling_stages, 'upload_mbtiles_to_mapbox'])
+    return stages
+
+def bench_cmaq(url: str, mock: MockMapbox) -> dict:
+    UploadCMAQ.base_url = url
+    os.makedirs(UploadCMAQ.folder_path, exist_ok=True)
+    stages = {}
+    forecast_filenames = [UploadCMAQ.PM25_path, UploadCMAQ.time_path, UploadCMAQ.lat_path, UploadCMAQ.lon_path]
+    run_stage(stages, 'download_files', lambda: forecast_filenames if UploadCMAQ.download_files() else [], UploadCMAQ.folder_path, '.npy')
+    # numpy_to_geojsons deletes the forecast files, so keep a copy for the native engine
+    snapshot = os.path.join(UploadCMAQ.folder_path, 'snapshot')
+    os.makedirs(snapshot)
+    for forecast_filename in forecast_filenames:
+        shutil.copy(os.path.join(UploadCMAQ.folder_path, forecast_filename), snapshot)
+    geojson_filenames = run_stage(stages, 'numpy_to_geojsons', UploadCMAQ.numpy_to_geojsons, UploadCMAQ.folder_path, '.geojson')
+    if shutil.which('tippecanoe'):
+        mbtiles_filenames = run_stage(stages, 'geojsons_to_mbtiles', lambda: UploadCMAQ.geojsons_to_mbtiles(geojson_filenames), UploadCMAQ.folder_path, '.mbtiles')
+    else:
+        stages['geojsons_to_mbtiles'] = {'skipped': 'tippecanoe not installed'}
+        for geojson_filename in geojson_filenames:
+            os.remove(os.path.join(UploadCMAQ.folder_path, geojson_filename))
+        for forecast_filename in forecast_filenames:
+            shutil.move(os.path.join(snapshot, forecast_filename), UploadCMAQ.folder_path)
+        time_indexes = list(range(UploadCMAQ.load_forecast_cube()[1].size))
+        mbtiles_filenames = run_stage(stages, 'native_mbtiles', lambda: convert_in_processes(UploadCMAQ.array_to_mbtiles, time_indexes), UploadCMAQ.folder_path, '.mbtiles')
+        UploadCMAQ.remove_forecast_files()
+    shutil.rmtree(snapshot)
+    run_upload_stage(stages, mock, UploadCMAQ, mbtiles_filenames)
+    tiling_stages = ['numpy_to_geojsons', 'geojsons_to_mbtiles'] if shutil.which('tippecanoe') else ['native_mbtiles']
+    run_forecast_stage(stages, mock, UploadCMAQ, ['download_files', *tiling_stages, 'upload_mbtiles_to_mapbox'])
+    return stages
+
+# Times function as a stage and records its results. Output bytes are the files in folder
+# ending in output_suffix once the stage is done. Returns what function returned.
+def run_stage(stages: dict, name: str, function, folder: str, output_suffix: str):
+    start_time = time.perf_counter()
+    outputs = function()
+    elapsed_time = time.perf_counter() - start_time
+    print()
+    output_bytes = sum(os.path.getsize(os.path.join(folder, file)) for file in os.listdir(folder) if file.endswith(output_suffix))
+    stages[name] = stage_result(elapsed_time, len(outputs), output_bytes)
+    return outputs
+
+# Times the upload stage, counting the bytes staged on the S3 stand-in as its output.
+def run_upload_stage(stages: dict, mock: MockMapbox, script, mbtiles_filenames: list):
+    staged_bytes = mock.staged_bytes
+    start_time = time.perf_counter()
+    script.upload_mbtiles_to_mapbox(mbtiles_filenames, 'bench', 'token')
+    elapsed_time = time.perf_counter() - start_time
+    stages['upload_mbtiles_to_mapbox'] = stage_result(elapsed_time, len(mbtiles_filenames), mock.staged_bytes - staged_bytes)
+
+# Times script.upload_forecast from download to upload on the streaming pipeline, with the
+# tile engine the batch stages used. It gets a cache and journal of its own, so every hour
+# goes through again instead of counting as uploaded by the batch stages. Recorded with
+# the summed time of batch_stages, which did the same work one stage after another.
+def run_forecast_stage(stages: dict, mock: MockMapbox, script, batch_stages: list):
+    batch_seconds = sum(stages[stage]['seconds'] for stage in batch_stages)
+    if not shutil.which('tippecanoe'):
+        script.tile_engine = 'native'
+    script.forecast_cache = CacheManifest('streaming_' + script.forecast_cache.manifest_path)
+    for setting in ('journal_path', 'trace_path', 'prometheus_path'):
+        setattr(script, setting, 'streaming_' + getattr(script, setting))
+    uploads = len(mock.uploads)
+    staged_bytes = mock.staged_bytes
+    start_time = time.perf_counter()
+    script.upload_forecast('bench', 'token')
+    elapsed_time = time.perf_counter() - start_time
+    assert script.forecast_uploaded(), f"{script.__name__}.upload_forecast left hours not uploaded"
+    stages['upload_forecast'] = stage_result(elapsed_time, len(mock.uploads) - uploads, mock.staged_bytes - staged_bytes)
+    stages['upload_forecast']['batch_seconds'] = batch_seconds
+
+def stage_result(elapsed_time: float, items: int, output_bytes: int) -> dict:
+    output_mb = output_bytes / (1024 * 1024)
+    return {
+        'seconds': elapsed_time,
+        'items': items,
+        'items_per_second': items / elapsed_time if elapsed_time else 0,
+        'output_mb': output_mb,
+        'mb_per_second': output_mb / elapsed_time if elapsed_time else 0,
+        # Peak RSS only grows, so each stage reports the high-water mark so far
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_child_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+# Runs a script's per-item native conversion over items in a process pool, like its pipeline does.
+def convert_in_processes(function, items: list) -> list:
+    with ProcessPoolExecutor(max_workers=UploadNetCDFs.conversion_workers) as executor:
+        return list(executor.map(function, items))
+
+def git_commit() -> (str | None):
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repository_path, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    main()
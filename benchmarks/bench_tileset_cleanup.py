@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import requests
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import MapboxUpload
+from local_services import MockMapbox
+
+# Compares the Mapbox tileset calls of one run before and after MapboxUpload.TilesetInventory,
+# against the local Mapbox stand-in. The account starts with stale tilesets from earlier
+# runs plus tilesets for some of this run's hours. Each of this run's uploads first clears
+# its tileset, then the stale tilesets are swept.
+# Usage: python benchmarks/bench_tileset_cleanup.py [stale_tilesets] [uploads] [existing_uploads]
+def main():
+    stale_tilesets = int(sys.argv[1]) if len(sys.argv) > 1 else 1200
+    uploads = int(sys.argv[2]) if len(sys.argv) > 2 else 120
+    existing_uploads = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    upload_ids = [f'bench.2024-08-02_{i:03}' for i in range(uploads)]
+
+    for name, run in (('before', legacy_run), ('after', inventory_run)):
+        mock = MockMapbox()
+        now = time.time()
+        for i in range(stale_tilesets):
+            mock.tilesets[f'bench.2024-07-{1 + i // 120:02}_{i % 120:03}'] = now - 6 * 3600 - i * 60
+        for tileset_id in upload_ids[:existing_uploads]:
+            mock.tilesets[tileset_id] = now - 3600
+        MapboxUpload.mapbox_api_url = mock.url
+        MapboxUpload.upload_sessions.clear()
+        start_time = time.perf_counter()
+        run(mock.url, upload_ids)
+        elapsed_time = time.perf_counter() - start_time
+        remaining = sum(1 for tileset_id in mock.tilesets if tileset_id not in upload_ids)
+        mock.shutdown()
+        print(f"{name}: {len(mock.calls)} API requests ({mock.count('GET', '/tilesets')} listing, "
+              f"{mock.count('DELETE', '/tilesets')} DELETE) in {elapsed_time:.2f} s, {remaining}/{stale_tilesets} stale tilesets left")
+
+# The calls clear_depreciated_tilesets and upload_mbtile_file_to_mapbox made before the
+# inventory: a blind DELETE per upload, one listing page and one DELETE at a time
+def legacy_run(mock_url: str, upload_ids: list):
+    for tileset_id in upload_ids:
+        requests.delete(f'{mock_url}/tilesets/v1/{tileset_id}?access_token=token')
+    tilesets = requests.get(f'{mock_url}/tilesets/v1/bench?access_token=token&limit=500&sortby=modified').json()
+    time_threshold = datetime.now(timezone.utc) - timedelta(hours=5)
+    for tileset in reversed(tilesets):
+        if tileset['id'] in upload_ids:
+            continue
+        if datetime.strptime(tileset['modified'], '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc) >= time_threshold:
+            break
+        requests.delete(f"{mock_url}/tilesets/v1/{tileset['id']}?access_token=token")
+
+def inventory_run(mock_url: str, upload_ids: list):
+    upload_session = MapboxUpload.get_upload_session('bench', 'token')
+    inventory = upload_session.inventory
+    for tileset_id in upload_ids:
+        if inventory.contains(tileset_id):
+            upload_session.delete_tileset(tileset_id)
+        inventory.record_upload(tileset_id)
+    time_threshold = datetime.now(timezone.utc) - timedelta(hours=5)
+    inventory.delete_tilesets(inventory.stale_tileset_ids(set(upload_ids), time_threshold.timestamp()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import RasterTiles
+from GridFeatures import grid_to_features, iter_feature_chunks, write_geojson_seq
+from MBTiles import write_vector_mbtiles
+
+# Compares the vector tilesets of the native MBTiles writer and GeoJSON + tippecanoe with
+# RasterTiles' colour and value encoded raster tilesets on one synthetic hour, reporting
+# time and output size. The tippecanoe path is skipped if it is not installed.
+# Usage: python benchmarks/bench_tiling.py [lat_cells] [lon_cells] [smoke_fraction]
+def main():
+    lat_cells = int(sys.argv[1]) if len(sys.argv) > 1 else 265
+    lon_cells = int(sys.argv[2]) if len(sys.argv) > 2 else 442
+    smoke_fraction = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    lon = np.linspace(-125, -66, lon_cells)
+    lat = np.linspace(24, 50, lat_cells)
+    rng = np.random.default_rng(0)
+    pm25 = np.where(rng.random((lat_cells, lon_cells)) < smoke_fraction, 5 + rng.random((lat_cells, lon_cells)) * 100, 1)
+    print(f"{lat_cells}x{lon_cells} grid, {int(np.sum(pm25 >= 5))} features")
+
+    with tempfile.TemporaryDirectory() as folder:
+        mbtiles_file_path = os.path.join(folder, 'native.mbtiles')
+        start_time = time.perf_counter()
+        tile_count = write_vector_mbtiles(mbtiles_file_path, grid_to_features(lon, lat, pm25), lon, lat)
+        report('native', time.perf_counter() - start_time, mbtiles_file_path, f"{tile_count} tiles")
+
+        for encoding in ('color', 'value'):
+            RasterTiles.raster_encoding = encoding
+            mbtiles_file_path = os.path.join(folder, f'raster_{encoding}.mbtiles')
+            start_time = time.perf_counter()
+            tile_count = RasterTiles.write_raster_mbtiles(mbtiles_file_path, lon, lat, pm25)
+            report(f'raster {encoding}', time.perf_counter() - start_time, mbtiles_file_path, f"{tile_count} tiles")
+
+        if shutil.which('tippecanoe') is None:
+            print("tippecanoe: not installed, skipped")
+            return
+        geojson_file_path = os.path.join(folder, 'tippecanoe.geojson')
+        mbtiles_file_path = os.path.join(folder, 'tippecanoe.mbtiles')
+        start_time = time.perf_counter()
+        write_geojson_seq(geojson_file_path, iter_feature_chunks(lon, lat, pm25))
+        subprocess.run(['tippecanoe', '-o', mbtiles_file_path, '-l', 'PM25', '-zg', '-P', '--drop-fraction-as-needed', geojson_file_path],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        report('tippecanoe', time.perf_counter() - start_time, mbtiles_file_path, f"{os.path.getsize(geojson_file_path) / (1024 * 1024):.1f} MB GeoJSON")
+
+def report(name: str, elapsed_time: float, mbtiles_file_path: str, detail: str):
+    print(f"{name}: {elapsed_time:.2f} s, {os.path.getsize(mbtiles_file_path) / (1024 * 1024):.1f} MB mbtiles ({detail})")
+
+if __name__ == '__main__':
+    main()
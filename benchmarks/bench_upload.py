@@ -0,0 +1,73 @@
+import os
+import sys
+import tempfile
+import time
+import boto3
+import requests
+from botocore.config import Config
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import MapboxUpload
+from local_services import MockMapbox
+
+# Compares per-upload overhead of the original upload code (fresh requests calls and a new
+# boto3 client per file) with MapboxUpload.UploadSession, against local Mapbox/S3 stand-ins.
+# What the session sends is checked by tests/test_mapbox_upload.py.
+# Usage: python benchmarks/bench_upload.py [uploads] [file_kb]
+def main():
+    uploads = int(sys.argv[1]) if len(sys.argv) > 1 else 120
+    file_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    with tempfile.TemporaryDirectory() as folder:
+        mbtiles_filenames = [f'2024-08-01_{i:03}.mbtiles' for i in range(uploads)]
+        for mbtiles_filename in mbtiles_filenames:
+            with open(os.path.join(folder, mbtiles_filename), 'wb') as f:
+                f.write(os.urandom(file_kb * 1024))
+
+        for name, upload, shared_staging_keys in (('before', legacy_upload, False), ('after', session_upload, False),
+                                                  ('after, shared staging keys', session_upload, True)):
+            for exact_staging_keys in (False, True):
+                mock = MockMapbox(exact_staging_keys=exact_staging_keys)
+                MapboxUpload.mapbox_api_url = mock.url
+                MapboxUpload.s3_endpoint_url = mock.url
+                MapboxUpload.shared_staging_keys = shared_staging_keys
+                MapboxUpload.upload_sessions.clear()
+                start_time = time.perf_counter()
+                for mbtiles_filename in mbtiles_filenames:
+                    upload(mock.url, os.path.join(folder, mbtiles_filename), mbtiles_filename)
+                elapsed_time = time.perf_counter() - start_time
+                mock.shutdown()
+                policy = 'exact staging keys' if exact_staging_keys else 'prefix staging keys'
+                print(f"{name} ({policy}): {elapsed_time / uploads * 1000:.1f} ms per upload, "
+                      f"{mock.count('POST', '/uploads/v1/bench/credentials')} credential requests, "
+                      f"{len(mock.calls) / uploads:.1f} HTTP requests per upload")
+
+# The upload steps of upload_mbtile_file_to_mapbox before UploadSession
+def legacy_upload(mock_url: str, mbtiles_file_path: str, mbtiles_filename: str):
+    tileset_id = f"bench.{mbtiles_filename.removesuffix('.mbtiles')}"
+    requests.delete(f'{mock_url}/tilesets/v1/{tileset_id}?access_token=token')
+    mapbox_credentials = requests.post(f'{mock_url}/uploads/v1/bench/credentials?access_token=token').json()
+    s3 = boto3.client(
+        's3',
+        aws_access_key_id=mapbox_credentials['accessKeyId'],
+        aws_secret_access_key=mapbox_credentials['secretAccessKey'],
+        aws_session_token=mapbox_credentials['sessionToken'],
+        endpoint_url=mock_url,
+        config=Config(s3={'addressing_style': 'path'}),
+    )
+    s3.upload_file(mbtiles_file_path, mapbox_credentials['bucket'], mapbox_credentials['key'])
+    requests.post(f'{mock_url}/uploads/v1/bench?access_token=token', json={
+        "url": f"https://{mapbox_credentials['bucket']}.s3.amazonaws.com/{mapbox_credentials['key']}",
+        "tileset": tileset_id,
+        "name": mbtiles_filename.removesuffix('.mbtiles'),
+    })
+
+def session_upload(mock_url: str, mbtiles_file_path: str, mbtiles_filename: str):
+    upload_session = MapboxUpload.get_upload_session('bench', 'token')
+    tileset_id = f"bench.{mbtiles_filename.removesuffix('.mbtiles')}"
+    upload_session.delete_tileset(tileset_id)
+    bucket, key = upload_session.stage_file(mbtiles_file_path, mbtiles_filename)
+    upload_session.create_upload(bucket, key, tileset_id, mbtiles_filename.removesuffix('.mbtiles'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import MapboxUpload
+from local_services import MockMapbox
+
+# Compares a fixed pool of 8 blocking upload threads with MapboxUpload.UploadEngine against
+# the local Mapbox/S3 stand-ins. Every upload job takes processing_s to process and is
+# polled until it finishes. Scenarios run without throttling, with an API rate limit, and
+# with a share of failing jobs that must be retried. The engine's polling, back-off and
+# retries are checked by tests/test_mapbox_upload.py.
+# Usage: python benchmarks/bench_upload_engine.py [uploads] [processing_s] [rate_limit]
+def main():
+    uploads = int(sys.argv[1]) if len(sys.argv) > 1 else 120
+    processing_time = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    rate_limit = int(sys.argv[3]) if len(sys.argv) > 3 else 40
+    MapboxUpload.upload_poll_interval = processing_time / 4
+    MapboxUpload.upload_retry_delay = processing_time / 4
+
+    scenarios = [
+        ('unthrottled', {}),
+        (f'{rate_limit} requests/s', {'rate_limit': rate_limit}),
+        (f'{rate_limit} requests/s, 10% failing', {'rate_limit': rate_limit, 'failure_rate': 0.1}),
+    ]
+    with tempfile.TemporaryDirectory() as folder:
+        mbtiles_file_paths = []
+        for i in range(uploads):
+            mbtiles_file_paths.append(os.path.join(folder, f'2024-08-01_{i:03}.mbtiles'))
+            with open(mbtiles_file_paths[-1], 'wb') as f:
+                f.write(os.urandom(16 * 1024))
+
+        for scenario, mock_options in scenarios:
+            for name, upload_all in (('8 threads', thread_pool_uploads), ('engine', engine_uploads)):
+                mock = MockMapbox(processing_time=processing_time, **mock_options)
+                MapboxUpload.mapbox_api_url = mock.url
+                MapboxUpload.s3_endpoint_url = mock.url
+                MapboxUpload.upload_sessions.clear()
+                MapboxUpload.upload_engines.clear()
+                start_time = time.perf_counter()
+                completed, detail = upload_all(mbtiles_file_paths)
+                elapsed_time = time.perf_counter() - start_time
+                mock.shutdown()
+                print(f"{scenario}, {name}: {completed}/{uploads} tilesets in {elapsed_time:.1f} s "
+                      f"({completed / elapsed_time:.1f}/s), {len(mock.calls)} requests, {mock.throttled} throttled{detail}")
+
+def upload_name(mbtiles_file_path: str) -> str:
+    return os.path.basename(mbtiles_file_path).removesuffix('.mbtiles')
+
+# The upload loop before UploadEngine: 8 threads, each blocking on one upload at a time,
+# retrying any error, 429s included, after a fixed delay
+def thread_pool_uploads(mbtiles_file_paths: list) -> tuple:
+    def upload(mbtiles_file_path: str) -> bool:
+        upload_session = MapboxUpload.get_upload_session('bench', 'token')
+        name = upload_name(mbtiles_file_path)
+        for _ in range(MapboxUpload.max_upload_attempts):
+            try:
+                upload_session.delete_tileset(f'bench.{name}')
+                bucket, key = upload_session.stage_file(mbtiles_file_path, os.path.basename(mbtiles_file_path))
+                upload = upload_session.create_upload(bucket, key, f'bench.{name}', name)
+                while not upload.get('complete') and not upload.get('error'):
+                    time.sleep(MapboxUpload.upload_poll_interval)
+                    upload = upload_session.upload_status(upload['id'])
+                if upload.get('complete'):
+                    return True
+            except Exception:
+                pass
+            time.sleep(MapboxUpload.upload_retry_delay)
+        return False
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return sum(executor.map(upload, mbtiles_file_paths)), ''
+
+def engine_uploads(mbtiles_file_paths: list) -> tuple:
+    upload_engine = MapboxUpload.get_upload_engine('bench', 'token')
+    futures = [upload_engine.submit(mbtiles_file_path, f'bench.{upload_name(mbtiles_file_path)}', upload_name(mbtiles_file_path))
+               for mbtiles_file_path in mbtiles_file_paths]
+    completed = 0
+    for future in futures:
+        try:
+            future.result()
+            completed += 1
+        except Exception:
+            pass
+    return completed, (f", {upload_engine.retried} jobs retried, API concurrency {upload_engine.api_limit.lowest_limit} at lowest"
+                       f" and {upload_engine.api_limit.limit} at the end")
+
+if __name__ == '__main__':
+    main()
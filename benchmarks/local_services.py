@@ -0,0 +1,242 @@
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from functools import partial
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Static file handler that also answers HTTP Range requests, standing in for base_url
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def send_head(self):
+        range_header = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if not range_header or not os.path.isfile(path):
+            return super().send_head()
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', range_header.strip())
+        size = os.path.getsize(path)
+        if not match or int(match.group(1)) >= size:
+            self.send_error(416)
+            return None
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Last-Modified', self.date_time_string(int(os.path.getmtime(path))))
+        self.end_headers()
+        self.range_remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = getattr(self, 'range_remaining', None)
+        if remaining is None:
+            return super().copyfile(source, outputfile)
+        while remaining > 0:
+            chunk = source.read(min(1024 * 1024, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+
+# Serves directory over HTTP on a free local port in a background thread.
+# Returns the server and its base URL; call server.shutdown() when done.
+def serve_directory(directory: str) -> tuple:
+    handler = partial(RangeRequestHandler, directory=directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+# Stand-in for the Mapbox uploads/tilesets API and the S3 staging bucket, served from
+# one local server. Records every request in calls so benchmarks can count round-trips.
+# With exact_staging_keys set, S3 only accepts the exact key handed out with each set
+# of credentials, like a strictly scoped Mapbox policy. Upload jobs complete
+# processing_time seconds after they are created, and failure_rate of them end with an
+# error instead. With rate_limit set, API requests beyond rate_limit per rate_interval
+# seconds get a 429 with Mapbox's X-Rate-Limit headers. tilesets maps tileset ids to
+# their modified time in epoch seconds; it is listed newest first in pages with a Link
+# header, and uploads and deletes update it.
+class MockMapbox:
+    def __init__(self, exact_staging_keys: bool = False, processing_time: float = 0, failure_rate: float = 0,
+                 rate_limit: int = None, rate_interval: float = 1.0):
+        self.exact_staging_keys = exact_staging_keys
+        self.processing_time = processing_time
+        self.failure_rate = failure_rate
+        self.rate_limit = rate_limit
+        self.rate_interval = rate_interval
+        self.window_start = time.time()
+        self.window_requests = 0
+        self.throttled = 0
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.issued_keys = set()
+        self.staged_bytes = 0
+        self.uploads = {}
+        self.tilesets = {}
+        self.next_id = 0
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are separate writes on a kept-alive connection
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                mock.handle(self)
+
+            do_POST = do_PUT = do_DELETE = do_HEAD = do_GET
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def new_id(self) -> str:
+        with self.lock:
+            self.next_id += 1
+            return f'{self.next_id:06}'
+
+    def count(self, method: str, prefix: str) -> int:
+        return sum(1 for call_method, path in self.calls if call_method == method and path.startswith(prefix))
+
+    def respond(self, handler, status: int, body=b'', headers: dict = None, content_type: str = 'application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            handler.wfile.write(body)
+
+    def handle(self, handler):
+        url = urlsplit(handler.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        body = handler.rfile.read(int(handler.headers.get('Content-Length', 0) or 0))
+        with self.lock:
+            self.calls.append((handler.command, url.path))
+        parts = url.path.strip('/').split('/')
+        if parts[0] in ('uploads', 'tilesets'):
+            self.handle_api(handler, handler.command, parts, query, body)
+        else:
+            self.handle_s3(handler, handler.command, parts, query, body)
+
+    # Counts an API request against the rate limit. Returns the 429 headers if it is over.
+    def rate_limited(self) -> (dict | None):
+        if self.rate_limit is None:
+            return None
+        with self.lock:
+            now = time.time()
+            if now >= self.window_start + self.rate_interval:
+                self.window_start = now
+                self.window_requests = 0
+            self.window_requests += 1
+            if self.window_requests <= self.rate_limit:
+                return None
+            self.throttled += 1
+            return {
+                'X-Rate-Limit-Interval': str(self.rate_interval),
+                'X-Rate-Limit-Limit': str(self.rate_limit),
+                'X-Rate-Limit-Reset': str(self.window_start + self.rate_interval),
+            }
+
+    # Upload job as the API reports it, completing or failing once processing_time has passed
+    def upload_status(self, upload: dict) -> dict:
+        status = {key: value for key, value in upload.items() if key not in ('created', 'fails')}
+        if time.time() >= upload['created'] + self.processing_time:
+            status['progress'] = 1
+            if upload['fails']:
+                status['error'] = 'Simulated processing failure'
+            else:
+                status['complete'] = True
+        return status
+
+    def handle_api(self, handler, method: str, parts: list, query: dict, body: bytes):
+        rate_limit_headers = self.rate_limited()
+        if rate_limit_headers is not None:
+            return self.respond(handler, 429, {'message': 'Too Many Requests'}, headers=rate_limit_headers)
+        if method == 'POST' and parts[:2] == ['uploads', 'v1'] and parts[-1] == 'credentials':
+            key = f'staging/{self.new_id()}'
+            with self.lock:
+                self.issued_keys.add(key)
+            return self.respond(handler, 200, {
+                'accessKeyId': 'test', 'secretAccessKey': 'test', 'sessionToken': 'test',
+                'bucket': 'staging-bucket', 'key': key, 'url': f'{self.url}/staging-bucket/{key}',
+            })
+        if method == 'POST' and parts[:2] == ['uploads', 'v1']:
+            payload = json.loads(body or b'{}')
+            upload = {'id': self.new_id(), 'complete': False, 'error': None, 'progress': 0, 'tileset': payload.get('tileset'), 'name': payload.get('name'), 'created': time.time()}
+            with self.lock:
+                upload['fails'] = self.random.random() < self.failure_rate
+                self.uploads[upload['id']] = upload
+                self.tilesets[upload['tileset']] = upload['created']
+            return self.respond(handler, 201, self.upload_status(upload))
+        if method == 'GET' and parts[:2] == ['uploads', 'v1'] and len(parts) == 4:
+            with self.lock:
+                upload = self.uploads.get(parts[3])
+            if upload is None:
+                return self.respond(handler, 404, {'message': 'Not Found'})
+            return self.respond(handler, 200, self.upload_status(upload))
+        if method == 'DELETE' and parts[:2] == ['tilesets', 'v1']:
+            with self.lock:
+                self.tilesets.pop(parts[2], None)
+            return self.respond(handler, 204)
+        if method == 'GET' and parts[:2] == ['tilesets', 'v1'] and len(parts) == 3:
+            return self.list_tilesets(handler, parts[2], query)
+        return self.respond(handler, 404, {'message': 'Not Found'})
+
+    # One page of tilesets, newest first, starting at the tileset id in start
+    def list_tilesets(self, handler, username: str, query: dict):
+        limit = int(query.get('limit', ['100'])[0])
+        with self.lock:
+            tileset_ids = sorted(self.tilesets, key=lambda tileset_id: (-self.tilesets[tileset_id], tileset_id))
+            modified = dict(self.tilesets)
+        start = query.get('start', [None])[0]
+        offset = tileset_ids.index(start) if start in tileset_ids else 0
+        page = [{
+            'id': tileset_id,
+            'modified': datetime.fromtimestamp(modified[tileset_id], timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+        } for tileset_id in tileset_ids[offset:offset + limit]]
+        headers = {}
+        if offset + limit < len(tileset_ids):
+            headers['Link'] = f'<{self.url}/tilesets/v1/{username}?start={tileset_ids[offset + limit]}&limit={limit}>; rel="next"'
+        return self.respond(handler, 200, page, headers=headers)
+
+    def handle_s3(self, handler, method: str, parts: list, query: dict, body: bytes):
+        key = '/'.join(parts[1:])
+        if self.exact_staging_keys and key not in self.issued_keys:
+            error = b'<?xml version="1.0" encoding="UTF-8"?><Error><Code>AccessDenied</Code><Message>Access Denied</Message></Error>'
+            return self.respond(handler, 403, error, content_type='application/xml')
+        staged_bytes = int(handler.headers.get('x-amz-decoded-content-length', len(body)))
+        if method == 'PUT':
+            with self.lock:
+                self.staged_bytes += staged_bytes
+            return self.respond(handler, 200, headers={'ETag': '"00000000000000000000000000000000"'})
+        if method == 'POST' and 'uploads' in query:
+            result = f'<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult><Bucket>{parts[0]}</Bucket><Key>{key}</Key><UploadId>{self.new_id()}</UploadId></InitiateMultipartUploadResult>'
+            return self.respond(handler, 200, result.encode(), content_type='application/xml')
+        if method == 'POST' and 'uploadId' in query:
+            result = f'<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult><Bucket>{parts[0]}</Bucket><Key>{key}</Key><ETag>"00000000000000000000000000000000-1"</ETag></CompleteMultipartUploadResult>'
+            return self.respond(handler, 200, result.encode(), content_type='application/xml')
+        return self.respond(handler, 404, b'', content_type='application/xml')
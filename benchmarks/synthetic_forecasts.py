@@ -0,0 +1,79 @@
+import os
+import sys
+from datetime import datetime, timedelta
+import numpy as np
+
+# Smooth synthetic PM25 field on a lon/lat grid, indexed [lat, lon]: Gaussian plumes over a
+# clean background. With coverage set, the field is scaled so that share of the cells
+# reaches the PM25 threshold of 5.
+def smoke_plumes(lon, lat, plumes: int = 12, coverage: float = None, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    lon_grid, lat_grid = np.meshgrid(lon, lat)
+    pm25 = np.full(lon_grid.shape, 2.0)
+    for _ in range(plumes):
+        center_lon, center_lat = rng.uniform(lon[0], lon[-1]), rng.uniform(lat[0], lat[-1])
+        width = rng.uniform(1, 5)
+        pm25 += rng.uniform(20, 300) * np.exp(-((lon_grid - center_lon) ** 2 + (lat_grid - center_lat) ** 2) / (2 * width ** 2))
+    if coverage is not None:
+        if coverage <= 0:
+            return np.zeros_like(pm25)
+        pm25 *= 5 / np.quantile(pm25, 1 - min(coverage, 1))
+    return pm25
+
+# CONUS-like lon and lat cell centers for a lat_cells x lon_cells grid
+def forecast_grid(lat_cells: int, lon_cells: int) -> tuple:
+    return np.linspace(-125, -66, lon_cells), np.linspace(24, 50, lat_cells)
+
+# Writes one NetCDF file per name with lon, lat and PM25[lat, lon] variables, the layout
+# UploadNetCDFs reads. Each hour gets its own plumes. Returns the bytes written.
+def write_nc_hours(folder: str, net_cdf_filenames: list, lat_cells: int, lon_cells: int, coverage: float) -> int:
+    import netCDF4 as nc
+    lon, lat = forecast_grid(lat_cells, lon_cells)
+    total_bytes = 0
+    for seed, net_cdf_filename in enumerate(net_cdf_filenames):
+        net_cdf_file_path = os.path.join(folder, net_cdf_filename)
+        ds = nc.Dataset(net_cdf_file_path, 'w')
+        ds.createDimension('lat', lat_cells)
+        ds.createDimension('lon', lon_cells)
+        ds.createVariable('lat', 'f4', ('lat',))[:] = lat
+        ds.createVariable('lon', 'f4', ('lon',))[:] = lon
+        ds.createVariable('PM25', 'f4', ('lat', 'lon'))[:] = smoke_plumes(lon, lat, coverage=coverage, seed=seed)
+        ds.close()
+        total_bytes += os.path.getsize(net_cdf_file_path)
+    return total_bytes
+
+# Writes a CMAQ forecast of hours hourly slabs starting at first_hour: the PM25[time, lat, lon]
+# cube, forecast times and the lat/lon axes, under the names UploadCMAQ reads.
+# Returns the bytes written.
+def write_cmaq_cube(folder: str, hours: int, lat_cells: int, lon_cells: int, coverage: float, first_hour: datetime = None) -> int:
+    first_hour = first_hour or datetime.now().replace(minute=0, second=0, microsecond=0)
+    lon, lat = forecast_grid(lat_cells, lon_cells)
+    pm25 = np.lib.format.open_memmap(os.path.join(folder, 'aq_PM25_array.npy'), mode='w+', dtype=np.float32, shape=(hours, lat_cells, lon_cells))
+    for time_index in range(hours):
+        pm25[time_index] = smoke_plumes(lon, lat, coverage=coverage, seed=time_index)
+    pm25.flush()
+    del pm25
+    forecast_time = np.array([(first_hour + timedelta(hours=i)).strftime('%Y-%m-%d %H:%M:%S UTC') for i in range(hours)])
+    np.save(os.path.join(folder, 'forecast_time.npy'), forecast_time)
+    np.save(os.path.join(folder, 'forecast_lat.npy'), lat)
+    np.save(os.path.join(folder, 'forecast_lon.npy'), lon)
+    return sum(os.path.getsize(os.path.join(folder, filename)) for filename in
+               ('aq_PM25_array.npy', 'forecast_time.npy', 'forecast_lat.npy', 'forecast_lon.npy'))
+
+# Writes a synthetic forecast of both kinds to a folder, for serving by hand.
+# Usage: python benchmarks/synthetic_forecasts.py folder [hours] [lat_cells] [lon_cells] [coverage]
+def main():
+    folder = sys.argv[1]
+    hours = int(sys.argv[2]) if len(sys.argv) > 2 else 120
+    lat_cells = int(sys.argv[3]) if len(sys.argv) > 3 else 265
+    lon_cells = int(sys.argv[4]) if len(sys.argv) > 4 else 442
+    coverage = float(sys.argv[5]) if len(sys.argv) > 5 else 0.2
+    os.makedirs(folder, exist_ok=True)
+    first_hour = datetime.now().replace(hour=6, minute=0, second=0, microsecond=0)
+    net_cdf_filenames = [(first_hour + timedelta(hours=i)).strftime('%Y-%m-%d_%H.nc') for i in range(hours)]
+    nc_bytes = write_nc_hours(folder, net_cdf_filenames, lat_cells, lon_cells, coverage)
+    npy_bytes = write_cmaq_cube(folder, hours, lat_cells, lon_cells, coverage, first_hour)
+    print(f"Wrote {hours} .nc hours ({nc_bytes / (1024 * 1024):.1f} MB) and a CMAQ cube ({npy_bytes / (1024 * 1024):.1f} MB) to {folder}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,8 @@
+#!/bin/bash
+
+# Activate the virtual environment
+source bin/activate
+
+# Run the upload service, reading Mapbox credentials from MAPBOX_USERNAME and
+# MAPBOX_ACCESS_TOKEN, or from the JSON file MAPBOX_CREDENTIALS_FILE points to
+python UploadDaemon.py
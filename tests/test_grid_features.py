@@ -0,0 +1,155 @@
+import json
+import os
+import sys
+import warnings
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import GridFeatures
+from GridFeatures import (feature_row_blocks, format_features, format_packed_features, format_serialized_features, format_serialized_packed_features,
+                          grid_to_features, iter_feature_chunks, iter_packed_feature_chunks)
+
+# Checks the NumPy feature kernel against the per-cell loops it replaced, on grids shaped
+# like both sources' data: a masked float32 NetCDF grid walked lon first, and a CMAQ grid
+# with NaN cells walked lat first. Both have cells exactly at, just below and far above the
+# threshold.
+
+# The loop of the original nc_to_geojson: lon outer, lat inner
+def netcdf_loop_features(lon, lat, pm25) -> list:
+    features = []
+    feature_id = 1
+    with warnings.catch_warnings():
+        # Masked cells convert to NaN with a warning, and then fail the threshold
+        warnings.simplefilter('ignore', UserWarning)
+        for i in range(len(lon)):
+            for j in range(len(lat)):
+                pm25_value = float(pm25[j, i])
+                if 5 <= pm25_value:
+                    features.append(loop_feature(feature_id, pm25_value, float(lon[i]), float(lat[j])))
+                    feature_id += 1
+    return features
+
+# The loop of the original array_to_geojson: lat outer, lon inner
+def cmaq_loop_features(lon, lat, pm25) -> list:
+    features = []
+    feature_id = 1
+    for j in range(lat.size):
+        for k in range(lon.size):
+            pm25_value = float(pm25[j][k])
+            if 5 <= pm25_value:
+                features.append(loop_feature(feature_id, pm25_value, float(lon[k]), float(lat[j])))
+                feature_id += 1
+    return features
+
+def loop_feature(feature_id: int, pm25_value: float, lon_value: float, lat_value: float) -> dict:
+    return {
+        "type": "Feature",
+        "properties": {"id": str(feature_id), "PM25": pm25_value},
+        "geometry": {"type": "Point", "coordinates": [lon_value, lat_value, 0]},
+    }
+
+# Features of the kernel's columns, parsed back from format_features
+def kernel_features(columns) -> list:
+    return [json.loads(line) for line in format_features(*columns).splitlines()]
+
+def pm25_values(shape: tuple, seed: int):
+    rng = np.random.default_rng(seed)
+    pm25 = rng.uniform(0, 60, shape)
+    pm25.flat[::7] = 5
+    pm25.flat[1::11] = np.nextafter(5, 0)
+    return pm25
+
+def netcdf_grid() -> tuple:
+    lon = np.linspace(-125, -66, 23, dtype=np.float32)
+    lat = np.linspace(24, 50, 17, dtype=np.float32)
+    pm25 = pm25_values((lat.size, lon.size), 0).astype(np.float32)
+    mask = np.zeros(pm25.shape, dtype=bool)
+    mask[::3, ::4] = True
+    # Masked cells hold a fill value above the threshold, which must never become a feature
+    pm25[mask] = 9.96921e36
+    return lon, lat, np.ma.masked_array(pm25, mask=mask, fill_value=np.float32(9.96921e36))
+
+def cmaq_grid() -> tuple:
+    lon = np.linspace(-125, -66, 19)
+    # CMAQ latitudes may run north to south
+    lat = np.linspace(50, 24, 13)
+    pm25 = pm25_values((lat.size, lon.size), 1)
+    pm25[::2, ::5] = np.nan
+    return lon, lat, pm25
+
+def test_netcdf_kernel_matches_loop():
+    lon, lat, pm25 = netcdf_grid()
+    expected = netcdf_loop_features(lon, lat, pm25)
+    assert len(expected) > 0
+    assert kernel_features(grid_to_features(lon, lat, pm25, lon_major=True)) == expected
+
+def test_cmaq_kernel_matches_loop():
+    lon, lat, pm25 = cmaq_grid()
+    expected = cmaq_loop_features(lon, lat, pm25)
+    assert len(expected) > 0
+    assert kernel_features(grid_to_features(lon, lat, pm25)) == expected
+
+def test_lon_major_orders_like_netcdf_loop():
+    lon, lat, pm25 = cmaq_grid()
+    lat_major = kernel_features(grid_to_features(lon, lat, pm25))
+    lon_major = kernel_features(grid_to_features(lon, lat, pm25, lon_major=True))
+    assert lon_major == netcdf_loop_features(lon, lat, pm25)
+    # Same cells, numbered in a different order
+    assert sorted(feature['geometry']['coordinates'] for feature in lon_major) == sorted(feature['geometry']['coordinates'] for feature in lat_major)
+    assert [feature['geometry']['coordinates'] for feature in lon_major] != [feature['geometry']['coordinates'] for feature in lat_major]
+
+def test_chunks_and_row_blocks_match_loop():
+    for (lon, lat, pm25), lon_major, loop_features in ((netcdf_grid(), True, netcdf_loop_features), (cmaq_grid(), False, cmaq_loop_features)):
+        expected = loop_features(lon, lat, pm25)
+        chunked = [feature for columns in iter_feature_chunks(lon, lat, pm25, lon_major=lon_major, chunk_rows=2) for feature in kernel_features(columns)]
+        assert chunked == expected
+        blocked = [feature for rows in feature_row_blocks(lon, lat, pm25, lon_major=lon_major, blocks=4)
+                   for columns in iter_feature_chunks(lon, lat, pm25, lon_major=lon_major, chunk_rows=3, rows=rows) for feature in kernel_features(columns)]
+        assert blocked == expected
+        # Workers given only their block's rows of the oriented grid, as nc_block_to_geojson reads them
+        slabbed = [feature for rows in feature_row_blocks(lon, lat, pm25, lon_major=lon_major, blocks=4)
+                   for columns in iter_feature_chunks(lon, lat, pm25[:, rows[0]:rows[1]] if lon_major else pm25[rows[0]:rows[1]], lon_major=lon_major, chunk_rows=3, rows=rows, slab=True)
+                   for feature in kernel_features(columns)]
+        assert slabbed == expected
+
+# Text of every chunk of a grid, as format_serialized_features or format_features writes it
+def formatted_chunks(lon, lat, pm25, lon_major: bool, serialized: bool) -> str:
+    formatter = format_serialized_features if serialized else format_features
+    return ''.join(formatter(*columns) for columns in iter_feature_chunks(lon, lat, pm25, lon_major=lon_major, chunk_rows=3, serialized=serialized))
+
+def formatted_packed_chunks(lon, lat, pm25_stack, lon_major: bool, serialized: bool) -> str:
+    formatter = format_serialized_packed_features if serialized else format_packed_features
+    return ''.join(formatter(*columns) for columns in iter_packed_feature_chunks(lon, lat, pm25_stack, lon_major=lon_major, chunk_rows=3, serialized=serialized))
+
+# Two hours of a grid, the second with other cells passing the threshold
+def pm25_stack(pm25) -> list:
+    return [pm25, pm25[::-1]]
+
+def test_serialized_formatters_match_format_features_unrounded(monkeypatch):
+    monkeypatch.setattr(GridFeatures, 'coordinate_decimals', None)
+    monkeypatch.setattr(GridFeatures, 'PM25_decimals', None)
+    for lon, lat, pm25 in (netcdf_grid(), cmaq_grid()):
+        for lon_major in (True, False):
+            expected = formatted_chunks(lon, lat, pm25, lon_major, serialized=False)
+            assert expected
+            assert formatted_chunks(lon, lat, pm25, lon_major, serialized=True) == expected
+            expected = formatted_packed_chunks(lon, lat, pm25_stack(pm25), lon_major, serialized=False)
+            assert expected
+            assert formatted_packed_chunks(lon, lat, pm25_stack(pm25), lon_major, serialized=True) == expected
+
+def test_serialized_formatters_round_by_default():
+    assert (GridFeatures.coordinate_decimals, GridFeatures.PM25_decimals) == (5, 2)
+    for lon, lat, pm25 in (netcdf_grid(), cmaq_grid()):
+        for lon_major in (True, False):
+            features = [json.loads(line) for line in formatted_chunks(lon, lat, pm25, lon_major, serialized=True).splitlines()]
+            unrounded = [json.loads(line) for line in formatted_chunks(lon, lat, pm25, lon_major, serialized=False).splitlines()]
+            assert len(features) == len(unrounded) > 0
+            for feature, expected in zip(features, unrounded):
+                assert feature['properties'] == {'id': expected['properties']['id'], 'PM25': round(expected['properties']['PM25'], 2)}
+                assert feature['geometry']['coordinates'] == [round(expected['geometry']['coordinates'][0], 5), round(expected['geometry']['coordinates'][1], 5), 0]
+            packed = [json.loads(line) for line in formatted_packed_chunks(lon, lat, pm25_stack(pm25), lon_major, serialized=True).splitlines()]
+            unrounded = [json.loads(line) for line in formatted_packed_chunks(lon, lat, pm25_stack(pm25), lon_major, serialized=False).splitlines()]
+            assert len(packed) == len(unrounded) > 0
+            for feature, expected in zip(packed, unrounded):
+                assert feature['properties'] == {name: value if name == 'id' else round(value, 2) for name, value in expected['properties'].items()}
+                assert feature['geometry']['coordinates'] == [round(expected['geometry']['coordinates'][0], 5), round(expected['geometry']['coordinates'][1], 5), 0]
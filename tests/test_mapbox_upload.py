@@ -0,0 +1,156 @@
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+repository_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_path)
+sys.path.insert(0, os.path.join(repository_path, 'benchmarks'))
+import MapboxUpload
+from local_services import MockMapbox
+
+# Checks UploadSession and UploadEngine against the local Mapbox/S3 stand-in: how often
+# the session asks for staging credentials, which keys it stages files at and how it falls
+# back when S3 refuses a shared staging key, and how the engine polls upload jobs, backs
+# off from a rate limit and retries failed jobs.
+
+# Starts MockMapbox with the given options and points MapboxUpload at it, with no
+# sessions left over from another test. Mocks are shut down after the test.
+@pytest.fixture
+def start_mock(monkeypatch):
+    mocks = []
+    def start(**options) -> MockMapbox:
+        mock = MockMapbox(**options)
+        mocks.append(mock)
+        monkeypatch.setattr(MapboxUpload, 'mapbox_api_url', mock.url)
+        monkeypatch.setattr(MapboxUpload, 's3_endpoint_url', mock.url)
+        monkeypatch.setattr(MapboxUpload, 'upload_sessions', {})
+        monkeypatch.setattr(MapboxUpload, 'upload_engines', {})
+        return mock
+    yield start
+    for mock in mocks:
+        mock.shutdown()
+
+def mbtiles_files(folder, count: int, size: int = 4096) -> list:
+    file_paths = []
+    for i in range(count):
+        file_paths.append(os.path.join(folder, f'2024-08-01_{i:02}.mbtiles'))
+        with open(file_paths[-1], 'wb') as f:
+            f.write(os.urandom(size))
+    return file_paths
+
+def stage_files(file_paths: list) -> list:
+    upload_session = MapboxUpload.get_upload_session('bench', 'token')
+    return [upload_session.stage_file(file_path, os.path.basename(file_path)) for file_path in file_paths]
+
+def credential_requests(mock: MockMapbox) -> int:
+    return mock.count('POST', '/uploads/v1/bench/credentials')
+
+def test_files_staged_at_issued_keys_by_default(start_mock, tmp_path, monkeypatch):
+    # S3 refuses any key Mapbox did not issue
+    mock = start_mock(exact_staging_keys=True)
+    s3_clients = []
+    real_s3_client = MapboxUpload.UploadSession.s3_client
+    def counted_s3_client(self, credentials: dict):
+        s3_clients.append(credentials)
+        return real_s3_client(self, credentials)
+    monkeypatch.setattr(MapboxUpload.UploadSession, 's3_client', counted_s3_client)
+    staged = stage_files(mbtiles_files(tmp_path, 5))
+    assert credential_requests(mock) == 5
+    assert {key for _, key in staged} <= mock.issued_keys
+    assert len({key for _, key in staged}) == 5
+    assert mock.staged_bytes == 5 * 4096
+    # The mock hands out the same AWS credentials with every key, so one client serves all
+    assert len(s3_clients) == 1
+
+def test_shared_staging_keys_reuse_credentials(start_mock, tmp_path, monkeypatch):
+    monkeypatch.setattr(MapboxUpload, 'shared_staging_keys', True)
+    mock = start_mock()
+    staged = stage_files(mbtiles_files(tmp_path, 5))
+    assert credential_requests(mock) == 1
+    assert len({key for _, key in staged}) == 5
+    assert mock.staged_bytes == 5 * 4096
+
+def test_shared_credentials_refreshed_near_expiry(start_mock, tmp_path, monkeypatch):
+    monkeypatch.setattr(MapboxUpload, 'shared_staging_keys', True)
+    mock = start_mock()
+    file_paths = mbtiles_files(tmp_path, 2)
+    stage_files(file_paths[:1])
+    upload_session = MapboxUpload.get_upload_session('bench', 'token')
+    upload_session.credentials_expire_at = time.time() + MapboxUpload.credential_refresh_margin / 2
+    stage_files(file_paths[1:])
+    assert credential_requests(mock) == 2
+
+def test_access_denied_falls_back_to_issued_keys(start_mock, tmp_path, monkeypatch):
+    monkeypatch.setattr(MapboxUpload, 'shared_staging_keys', True)
+    mock = start_mock(exact_staging_keys=True)
+    staged = stage_files(mbtiles_files(tmp_path, 5))
+    # The shared key's first upload is denied, then every file gets credentials of its own
+    assert not MapboxUpload.get_upload_session('bench', 'token').shared_staging_keys
+    assert credential_requests(mock) == 1 + 5
+    assert {key for _, key in staged} <= mock.issued_keys
+    assert mock.staged_bytes == 5 * 4096
+
+def test_concurrent_uploads_share_one_credentials_request(start_mock, monkeypatch):
+    monkeypatch.setattr(MapboxUpload, 'shared_staging_keys', True)
+    mock = start_mock()
+    upload_session = MapboxUpload.get_upload_session('bench', 'token')
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        credentials = list(executor.map(lambda _: upload_session.shared_credentials()[0], range(32)))
+    assert credential_requests(mock) == 1
+    assert all(credential == credentials[0] for credential in credentials)
+
+# Uploads every file through the engine. Returns the engine and each tileset's result,
+# the completed upload job or the exception of its last attempt.
+def engine_uploads(file_paths: list) -> tuple:
+    upload_engine = MapboxUpload.get_upload_engine('bench', 'token')
+    tileset_ids = [f"bench.{os.path.basename(file_path).removesuffix('.mbtiles')}" for file_path in file_paths]
+    futures = [upload_engine.submit(file_path, tileset_id, tileset_id) for file_path, tileset_id in zip(file_paths, tileset_ids)]
+    return upload_engine, {tileset_id: future.exception() or future.result() for tileset_id, future in zip(tileset_ids, futures)}
+
+# Whether each of a tileset's upload jobs failed, in the order they were started
+def tileset_jobs(mock: MockMapbox) -> dict:
+    jobs = defaultdict(list)
+    for upload_id in sorted(mock.uploads):
+        jobs[mock.uploads[upload_id]['tileset']].append(mock.uploads[upload_id]['fails'])
+    return jobs
+
+def test_engine_polls_jobs_until_complete(start_mock, tmp_path, monkeypatch):
+    monkeypatch.setattr(MapboxUpload, 'upload_poll_interval', 0.05)
+    mock = start_mock(processing_time=0.3)
+    _, results = engine_uploads(mbtiles_files(tmp_path, 4))
+    for upload in results.values():
+        assert upload['complete']
+        assert upload['processing_seconds'] >= 0.3
+    for upload_id in mock.uploads:
+        assert mock.count('GET', f'/uploads/v1/bench/{upload_id}') >= 3
+
+def test_engine_backs_off_on_rate_limit(start_mock, tmp_path, monkeypatch):
+    monkeypatch.setattr(MapboxUpload, 'upload_poll_interval', 0.05)
+    mock = start_mock(processing_time=0.1, rate_limit=10, rate_interval=0.5)
+    upload_engine, results = engine_uploads(mbtiles_files(tmp_path, 12))
+    assert all(not isinstance(upload, Exception) for upload in results.values())
+    assert mock.throttled > 0
+    # Listing tilesets and requesting credentials wait out their 429s outside the limit
+    assert 0 < upload_engine.api_limit.throttled <= mock.throttled
+    assert upload_engine.api_limit.lowest_limit < MapboxUpload.initial_api_concurrency
+    # A 429 delays the request that got it, and never fails or restarts an upload
+    assert upload_engine.retried == 0
+    assert all(jobs == [False] for jobs in tileset_jobs(mock).values())
+
+def test_engine_retries_only_failed_jobs(start_mock, tmp_path, monkeypatch):
+    monkeypatch.setattr(MapboxUpload, 'upload_poll_interval', 0.02)
+    monkeypatch.setattr(MapboxUpload, 'upload_retry_delay', 0.02)
+    mock = start_mock(processing_time=0.05, failure_rate=0.3)
+    upload_engine, results = engine_uploads(mbtiles_files(tmp_path, 12))
+    jobs = tileset_jobs(mock)
+    assert len(jobs) == 12
+    assert any(any(fails) for fails in jobs.values())
+    for tileset_id, fails in jobs.items():
+        # Every job before a tileset's last failed, and the last failed only on the final attempt
+        assert all(fails[:-1])
+        assert not fails[-1] or len(fails) == MapboxUpload.max_upload_attempts
+        assert isinstance(results[tileset_id], Exception) == fails[-1]
+    assert upload_engine.retried == sum(len(fails) - 1 for fails in jobs.values())
@@ -0,0 +1,49 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import RunJournal
+
+# Checks that RunJournal resumes from intact files without hashing them again, and still
+# notices files that were changed or removed since they were recorded.
+
+def journal_with_artifact(tmp_path) -> RunJournal.RunJournal:
+    with open(tmp_path / 'hour.mbtiles', 'wb') as f:
+        f.write(b'tiles' * 100)
+    run_journal = RunJournal.RunJournal(str(tmp_path / 'journal.sqlite'), str(tmp_path), lambda label: 'v1')
+    run_journal.record('hour', 'converted', 'hour.mbtiles')
+    return run_journal
+
+def counted_hashes(monkeypatch) -> list:
+    hashed = []
+    real_file_sha256 = RunJournal.file_sha256
+    def counted_file_sha256(file_path: str) -> str:
+        hashed.append(file_path)
+        return real_file_sha256(file_path)
+    monkeypatch.setattr(RunJournal, 'file_sha256', counted_file_sha256)
+    return hashed
+
+def test_unchanged_artifacts_are_not_rehashed(tmp_path, monkeypatch):
+    run_journal = journal_with_artifact(tmp_path)
+    hashed = counted_hashes(monkeypatch)
+    for _ in range(3):
+        assert run_journal.has_progress('hour')
+        assert run_journal.resume_stage('hour', 'v1', ['converted', 'uploaded']) == 'converted'
+    assert hashed == []
+    run_journal.close()
+
+def test_changed_artifacts_are_rehashed(tmp_path, monkeypatch):
+    run_journal = journal_with_artifact(tmp_path)
+    hashed = counted_hashes(monkeypatch)
+    file_path = tmp_path / 'hour.mbtiles'
+    # Touched but the same bytes is still intact
+    os.utime(file_path, ns=(0, 0))
+    assert run_journal.has_progress('hour')
+    assert hashed == [str(file_path)]
+    with open(file_path, 'wb') as f:
+        f.write(b'other' * 100)
+    os.utime(file_path, ns=(0, 0))
+    assert not run_journal.has_progress('hour')
+    os.remove(file_path)
+    assert not run_journal.has_progress('hour')
+    run_journal.close()